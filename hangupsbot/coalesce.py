@@ -0,0 +1,142 @@
+import asyncio, copy, logging
+
+
+logger = logging.getLogger(__name__)
+
+
+_defaults = { "window": 0.0, # seconds, 0 disables coalescing
+              "messages": 10, # most lines merged into one message
+              "length": 2000 } # most characters merged into one message
+
+
+class RelayCoalescer:
+    """merges relayed messages for the same conversation and source that arrive within
+    a short window into one multi-line message, to save round trips under burst load
+
+    config.json "relay_coalesce" overrides the keys of _defaults
+
+    * messages are sent in the order they were submitted, per conversation
+    * only messages with the same key are merged, use None for messages that must be
+      sent on their own (images, edits, executable passthrus, ...)
+    * the merged message carries the passthru of the first message, with the combined text
+      as original_request["message"] and original_request["segments"] = None, consumers fall
+      back to the message text; passthru["norelay"] lists every bridge of any merged message
+    """
+    def __init__(self, bot, name):
+        self.bot = bot
+        self.name = name
+
+        self._pending = {} # conv_id: batch being collected
+        self._sending = {} # conv_id: asyncio.Future of the last flush
+
+        self.submitted = 0
+        self.sent = 0
+
+    def _options(self):
+        options = dict(_defaults)
+        options.update(self.bot.get_config_option("relay_coalesce") or {})
+        return options
+
+    @asyncio.coroutine
+    def send(self, conv_id, message, passthru, key=None, original=None, image_id=None):
+        """send a relayed message, possibly merged with others
+        returns once the message is queued if coalescing is enabled, otherwise once it is sent
+        * original: text of the message without relay formatting, for passthru["original_request"]
+        """
+        self.submitted = self.submitted + 1
+
+        if image_id:
+            key = None
+
+        options = self._options()
+        if not options["window"] and conv_id not in self._pending and conv_id not in self._sending:
+            self.sent = self.sent + 1
+            yield from self.bot.coro_send_message( conv_id,
+                                                   message,
+                                                   image_id = image_id,
+                                                   context = { "passthru": passthru })
+            return
+
+        batch = self._pending.get(conv_id)
+        if batch and ( key is None
+                       or batch["key"] != key
+                       or len(batch["messages"]) >= options["messages"]
+                       or batch["length"] + len(message) > options["length"] ):
+            self._flush(conv_id)
+            batch = None
+
+        if batch is None:
+            batch = { "key": key,
+                      "messages": [],
+                      "originals": [],
+                      "passthrus": [],
+                      "image_id": image_id,
+                      "length": 0,
+                      "timer": None }
+            self._pending[conv_id] = batch
+
+        batch["messages"].append(message)
+        batch["originals"].append(original)
+        batch["passthrus"].append(passthru)
+        batch["length"] = batch["length"] + len(message)
+
+        if key is None or not options["window"]:
+            self._flush(conv_id)
+        elif batch["timer"] is None:
+            batch["timer"] = asyncio.get_event_loop().call_later(options["window"], self._flush, conv_id)
+
+    def _flush(self, conv_id):
+        batch = self._pending.pop(conv_id, None)
+        if not batch:
+            return
+        if batch["timer"] is not None:
+            batch["timer"].cancel()
+
+        previous = self._sending.get(conv_id)
+        done = self._sending[conv_id] = asyncio.ensure_future(self._send_batch(conv_id, batch, previous))
+        done.add_done_callback(lambda future: self._sent(conv_id, future))
+
+    def _sent(self, conv_id, future):
+        if self._sending.get(conv_id) is future:
+            del self._sending[conv_id]
+        if not future.cancelled() and future.exception():
+            logger.error("{}: failed to relay to {}".format(self.name, conv_id), exc_info=future.exception())
+
+    @asyncio.coroutine
+    def _send_batch(self, conv_id, batch, previous):
+        if previous is not None:
+            # batches for a conversation are sent one after the other, in order
+            yield from asyncio.wait([previous])
+
+        if len(batch["messages"]) == 1:
+            message = batch["messages"][0]
+            passthru = batch["passthrus"][0]
+        else:
+            message = "\n".join(batch["messages"])
+            passthru = copy.copy(batch["passthrus"][0])
+
+            norelay = []
+            for single in batch["passthrus"]:
+                for uid in single.get("norelay") or []:
+                    if uid not in norelay:
+                        norelay.append(uid)
+            if norelay:
+                passthru["norelay"] = norelay
+            if "original_request" in passthru:
+                passthru["original_request"] = dict(passthru["original_request"])
+                passthru["original_request"]["message"] = "\n".join(
+                    original if original is not None else line
+                    for original, line in zip(batch["originals"], batch["messages"]))
+                passthru["original_request"]["segments"] = None
+            logger.debug("{}: {} messages coalesced for {}".format(self.name, len(batch["messages"]), conv_id))
+
+        self.sent = self.sent + 1
+        yield from self.bot.coro_send_message( conv_id,
+                                               message,
+                                               image_id = batch["image_id"],
+                                               context = { "passthru": passthru })
+
+    def flush_all(self):
+        """send all pending batches now"""
+        for conv_id in list(self._pending):
+            self._flush(conv_id)
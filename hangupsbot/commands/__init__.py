@@ -5,6 +5,8 @@ import time
 
 import plugins
 
+from registry import ExpiringRegistry
+
 
 logger = logging.getLogger(__name__)
 
@@ -21,6 +23,11 @@ class CommandDispatcher(object):
 
         self.command_tagsets = {}
 
+        """compiled permissions for get_available_commands(), see invalidate_permissions()"""
+        self._permission_plans = {} # conv_id: per-conversation plan shared by all users
+        self._permissions = ExpiringRegistry("permissions") # (conv_id, chat_id): (admin, user)
+        self._permissions_generation = None # bot.config.generation the cache was built from
+
         """
         inbuilt argument preprocessors, recognises:
         * one_chat_id (also resolves #conv)
@@ -68,8 +75,14 @@ class CommandDispatcher(object):
             subtokens[-1] = internal_context.user.id_.chat_id
         else:
             user_memory = self.bot.get_memory_option("user_data")
+            candidates = self.bot.conversations.find_users(text)
             if all_users:
                 chat_ids = list(self.bot.conversations.catalog[internal_context.conv_id]["participants"])
+                if candidates is not None:
+                    chat_ids = [ chat_id for chat_id in chat_ids if chat_id in candidates ]
+            elif candidates is not None:
+                # only users that can possibly match, see permamem.find_users()
+                chat_ids = [ chat_id for chat_id in candidates if chat_id in user_memory ]
             else:
                 chat_ids = list(user_memory.keys())
 
@@ -298,6 +311,7 @@ class CommandDispatcher(object):
             tagsets = set([tagsets])
 
         self.command_tagsets[command] = self.command_tagsets[command] | tagsets
+        self.invalidate_permissions()
 
 
     @property
@@ -310,20 +324,26 @@ class CommandDispatcher(object):
         config_tags_escalate = self.bot.get_config_option('commands.tags.escalate') or False
         return config_tags_escalate
 
-    def get_available_commands(self, bot, chat_id, conv_id):
-        start_time = time.time()
+    def invalidate_permissions(self):
+        """forget compiled permissions, call after changes to commands, tags or config
+        * config changes are also detected automatically through bot.config.generation"""
+        self._permission_plans.clear()
+        self._permissions.clear()
+
+    def _permission_plan(self, bot, conv_id):
+        """user-independent part of get_available_commands() for conv_id"""
 
         config_tags_deny_prefix = self.deny_prefix
         config_tags_escalate = self.escalate_tagged
 
-        config_admins = bot.get_config_suboption(conv_id, 'admins')
-        is_admin = False
-        if chat_id in config_admins:
-            is_admin = True
+        config_options = bot.get_config_suboptions(
+            conv_id, ['admins', 'commands_admin', 'commands_user', 'commands_tagged'])
+
+        config_admins = set(config_options['admins'] or [])
 
-        commands_admin = bot.get_config_suboption(conv_id, 'commands_admin') or []
-        commands_user = bot.get_config_suboption(conv_id, 'commands_user') or []
-        commands_tagged = bot.get_config_suboption(conv_id, 'commands_tagged') or {}
+        commands_admin = config_options['commands_admin'] or []
+        commands_user = config_options['commands_user'] or []
+        commands_tagged = config_options['commands_tagged'] or {}
 
         # convert commands_tagged tag list into a set of (frozen)sets
         commands_tagged = { key: set([ frozenset(value if isinstance(value, list) else [value])
@@ -358,49 +378,88 @@ class CommandDispatcher(object):
             admin_commands = set(commands_admin) | set(self.admin_commands)
             user_commands = all_commands - admin_commands
 
-        # make admin commands unavailable to non-admin user
-        if not is_admin:
-            admin_commands = set()
+        # compile tag matches into (allow, deny) pairs of tag sets
+        tagged = {}
+        for command, tags in commands_tagged.items():
+            if command not in all_commands:
+                # optimisation: don't check commands that aren't loaded into framework
+                continue
 
-        if commands_tagged:
-            _set_user_tags = set(bot.tags.useractive(chat_id, conv_id))
+            # raise tagged command access level if escalation required
+            if config_tags_escalate and command in user_commands:
+                user_commands = user_commands - set([command])
+
+            tagged[command] = []
+            for _match in tags:
+                _set_allow = frozenset([_match] if isinstance(_match, str) else _match)
+                _set_deny = frozenset(config_tags_deny_prefix + x for x in _set_allow)
+                tagged[command].append((_set_allow, _set_deny))
+
+        return config_admins, frozenset(admin_commands), frozenset(user_commands), tagged
+
+    def _user_permissions(self, bot, chat_id, conv_id, plan):
+        """apply admin status and user tags to a per-conversation plan"""
+
+        config_admins, admin_commands, user_commands, tagged = plan
 
-            for command, tags in commands_tagged.items():
-                if command not in all_commands:
-                    # optimisation: don't check commands that aren't loaded into framework
-                    continue
+        is_admin = chat_id in config_admins
 
-                # raise tagged command access level if escalation required
-                if config_tags_escalate and command in user_commands:
-                    user_commands.remove(command)
+        # make admin commands unavailable to non-admin user
+        admin_commands = set(admin_commands) if is_admin else set()
+        user_commands = set(user_commands)
+
+        if tagged:
+            _set_user_tags = set(bot.tags.useractive(chat_id, conv_id))
 
+            for command, matches in tagged.items():
                 # is tagged command generally available (in user_commands)?
                 # admins always get access, other users need appropriate tag(s)
-                # XXX: optimisation: check admin_commands to avoid unnecessary scanning
-                if command not in user_commands|admin_commands:
-                    for _match in tags:
-                        _set_allow = set([_match] if isinstance(_match, str) else _match)
+                if command not in user_commands and command not in admin_commands:
+                    for _set_allow, _set_deny in matches:
                         if is_admin or _set_allow <= _set_user_tags:
-                            admin_commands.update([command])
+                            admin_commands.add(command)
                             break
 
             if not is_admin:
                 # tagged commands can be explicitly denied
                 _denied = set()
-                for command in user_commands|admin_commands:
-                    if command in commands_tagged:
-                        tags = commands_tagged[command]
-                        for _match in tags:
-                            _set_allow = set([_match] if isinstance(_match, str) else _match)
-                            _set_deny = { config_tags_deny_prefix + x for x in _set_allow }
+                for command, matches in tagged.items():
+                    if command in user_commands or command in admin_commands:
+                        for _set_allow, _set_deny in matches:
                             if _set_deny <= _set_user_tags:
-                                _denied.update([command])
+                                _denied.add(command)
                                 break
                 admin_commands = admin_commands - _denied
                 user_commands = user_commands - _denied
 
         user_commands = user_commands - admin_commands # ensure no overlap
 
+        return frozenset(admin_commands), frozenset(user_commands)
+
+    def get_available_commands(self, bot, chat_id, conv_id):
+        """commands available to chat_id in conv_id, compiled once per conversation and user
+        until invalidate_permissions() is called or the config changes"""
+        start_time = time.time()
+
+        if self._permissions_generation != bot.config.generation:
+            self.invalidate_permissions()
+            self._permissions_generation = bot.config.generation
+
+        try:
+            admin_commands, user_commands = self._permissions[conv_id, chat_id]
+
+        except KeyError:
+            if conv_id not in self._permission_plans:
+                self._permission_plans[conv_id] = self._permission_plan(bot, conv_id)
+
+            admin_commands, user_commands = self._user_permissions(
+                bot, chat_id, conv_id, self._permission_plans[conv_id])
+
+            # XXX: tags of unknown users and conversations resolve differently once they are known
+            if( conv_id in bot.conversations.catalog
+                    and bot.memory.exists(["user_data", chat_id]) ):
+                self._permissions[conv_id, chat_id] = (admin_commands, user_commands)
+
         interval = time.time() - start_time
         logger.debug("get_available_commands() - {}".format(interval))
 
@@ -458,6 +517,7 @@ class CommandDispatcher(object):
                 self.commands[func_name] = func
                 if admin:
                     self.admin_commands.append(func_name)
+                self.invalidate_permissions()
 
             else:
                 # just register and return the same function
@@ -288,6 +288,30 @@ def resourcememory(bot, event, *args):
     yield from bot.coro_send_message(event.conv,  "<b>" + message + "</b>")
 
 
+@command.register(admin=True)
+def outbound(bot, event, *args):
+    """show the queue depth and counters of the outbound api scheduler and of the bridge relay queues"""
+
+    stats = bot.outbound.stats()
+
+    lines = [ _("<b>outbound queue:</b> {} waiting, {} running, peak {}").format(
+                stats["queued"], stats["running"], stats["peak"]) ]
+    lines.append( ", ".join([ "{}: {}".format(label, count)
+                              for label, count in sorted(stats["depth"].items()) ]) )
+    lines.append( _("sent {}, retried {}, failed {}, throttled {}").format(
+                      stats["sent"], stats["retried"], stats["failed"], stats["throttled"]) )
+    lines.append( _("average wait {:.2f}s, {} throttled conversation(s)").format(
+                      stats["average wait"], stats["throttled conversations"]) )
+
+    for uid, bridge in sorted(bot.bridges.items()):
+        status = bridge.relay_status()
+        lines.append( _("<b>{}:</b> {} waiting, sent {}, retried {}, failed {}, dropped {}").format(
+                          uid, status["waiting"], status["sent"], status["retried"],
+                          status["failed"], status["dropped"]) )
+
+    yield from bot.coro_send_message(event.conv, "\n".join(lines))
+
+
 @command.register_unknown
 def unknown_command(bot, event, *args):
     """handle unknown commands"""
@@ -1,23 +1,57 @@
-import collections, datetime, functools, json, glob, logging, os, shutil, sys, time
+import asyncio, collections, datetime, functools, json, glob, logging, os, shutil, sqlite3, sys, time
 
-from threading import Timer
+from threading import Lock
 
 
 logger = logging.getLogger(__name__)
 
 
+def _snapshot(data):
+    """structural copy of nested dicts and lists, scalar leaves are immutable and shared"""
+    if isinstance(data, dict):
+        return { key: _snapshot(value) for key, value in data.items() }
+    elif isinstance(data, list):
+        return [ _snapshot(value) for value in data ]
+    return data
+
+
 class Config(collections.MutableMapping):
-    """Configuration JSON storage class"""
-    def __init__(self, filename, default=None, failsafe_backups=0, save_delay=0):
+    """Configuration JSON storage class
+    journal=True: path-level changes made via set_by_path(), pop_by_path() and item assignment
+      are appended to <filename>.journal on save instead of rewriting the whole file, the journal
+      is folded back into a full snapshot once it holds more than journal_compact entries
+    * in-place changes to nested values are not journalled, call force_taint() after them
+      to force a full snapshot on the next save
+    cache_suboptions=True: resolved get_suboption() values are remembered until the next change
+      made through set_by_path(), pop_by_path(), item assignment, load(), loads() or force_taint()
+    generation is incremented on each of these changes, callers can compare it to decide
+      whether values they derived from the config are still current
+    """
+    def __init__(self, filename, default=None, failsafe_backups=0, save_delay=0,
+                 journal=False, journal_compact=1000, cache_suboptions=False):
         self.filename = filename
         self.default = None
         self.config = {}
         self.changed = False
         self.failsafe_backups = failsafe_backups
         self.save_delay = save_delay
-        self.load()
 
-        self._timer_save = False
+        self.journal = journal
+        self.journal_compact = journal_compact
+        self._journal_filename = filename + ".journal"
+        self._journal_pending = []
+        self._journal_entries = 0
+        self._journal_snapshot = False
+
+        self._suboptions = {} if cache_suboptions else None
+        self.generation = 0
+
+        self._loop = asyncio.get_event_loop()
+        self._handle_save = None
+        self._save_lock = asyncio.Lock()
+        self._write_lock = Lock()
+
+        self.load()
 
     def _make_failsafe_backup(self):
         try:
@@ -31,11 +65,18 @@ class Config(collections.MutableMapping):
 
         existing = sorted(glob.glob(self.filename + ".*.bak"))
         while len(existing) > (self.failsafe_backups - 1):
-            os.remove(existing.pop(0))
+            expired = existing.pop(0)
+            os.remove(expired)
+            if os.path.isfile(expired + ".journal"):
+                os.remove(expired + ".journal")
 
         backup_file = self.filename + "." + datetime.datetime.now().strftime("%Y%m%d%H%M%S") + ".bak"
         shutil.copy2(self.filename, backup_file)
 
+        if self.journal and os.path.isfile(self._journal_filename):
+            # the snapshot is only complete with the changes journalled on top of it
+            shutil.copy2(self._journal_filename, backup_file + ".journal")
+
         return True
 
     def _recover_from_failsafe(self):
@@ -48,6 +89,15 @@ class Config(collections.MutableMapping):
                     json.load(f)
 
                 shutil.copy2(recovery_filename, self.filename)
+
+                if self.journal:
+                    # the current journal belongs to the corrupted file, keep it aside and
+                    #   replay the journal of the backup instead
+                    if os.path.isfile(self._journal_filename):
+                        os.replace(self._journal_filename, self._journal_filename + ".corrupted")
+                    if os.path.isfile(recovery_filename + ".journal"):
+                        shutil.copy2(recovery_filename + ".journal", self._journal_filename)
+
                 self.load(recovery=True)
                 logger.info("recovery successful: {}".format(recovery_filename))
                 return True
@@ -73,46 +123,191 @@ class Config(collections.MutableMapping):
 
             raise
 
+        self._journal_pending = []
+        self._journal_entries = 0
+        self._journal_snapshot = False
+        if self.journal:
+            self._journal_replay()
+
+        self._invalidate_suboptions()
+
         self.changed = False
 
+    def _journal_replay(self):
+        """apply journalled changes on top of the loaded snapshot"""
+        try:
+            with open(self._journal_filename) as f:
+                lines = f.readlines()
+        except IOError:
+            return
+
+        for line in lines:
+            try:
+                op, keys_list, value = json.loads(line)
+            except ValueError:
+                # partially written tail from an interrupted save, nothing valid follows it
+                logger.warning("{} truncated at entry {}".format(self._journal_filename, self._journal_entries))
+                self._journal_snapshot = True
+                break
+
+            try:
+                # resolve against the raw dict, replayed changes must not be journalled again
+                parent = functools.reduce(
+                    lambda d, k: d[int(k) if isinstance(d, list) else k], keys_list[:-1], self.config)
+                if op == "set":
+                    parent[keys_list[-1]] = value
+                else:
+                    parent.pop(keys_list[-1])
+            except (KeyError, IndexError, TypeError):
+                logger.warning("{} could not replay {} {}".format(self._journal_filename, op, keys_list))
+
+            self._journal_entries = self._journal_entries + 1
+
+        logger.info("{} replayed {}".format(self._journal_filename, self._journal_entries))
+
+    def _journal_append(self, op, keys_list, value=None):
+        if self.journal and not self._journal_snapshot:
+            # serialise immediately: later in-place changes to value must not leak into the entry
+            self._journal_pending.append(json.dumps([op, list(keys_list), value], separators=(',', ':')))
+
     def force_taint(self):
         self.changed = True
+        self._journal_snapshot = True
+        self._invalidate_suboptions()
 
     def loads(self, json_str):
         """Load config from JSON string"""
         self.config = json.loads(json_str)
         self.changed = True
+        self._journal_snapshot = True
+        self._invalidate_suboptions()
 
     def save(self, delay=True):
-        if self.save_delay:
-            if delay:
-                if self._timer_save and self._timer_save.is_alive():
-                    self._timer_save.cancel()
-                self._timer_save = Timer(self.save_delay, self.save, [], {"delay": False})
-                self._timer_save.start()
-                return False
+        """Save config to file (only if config has changed)
+        while the event loop is running, saving is handed to the loop: the write is (optionally)
+        delayed by save_delay and performed by save_async() in a worker thread
+        """
+        if self._loop.is_running():
+            # may be called from other threads, so always schedule via the loop
+            self._loop.call_soon_threadsafe(self._schedule_save, self.save_delay if delay else 0)
+            return False
 
-        """Save config to file (only if config has changed)"""
         if self.changed:
             start_time = time.time()
 
-            if self.failsafe_backups:
-                self._make_failsafe_backup()
+            if self._journal_ready():
+                self._write_journal(self._journal_take())
+                interval = time.time() - start_time
 
-            with open(self.filename, 'w') as f:
-                json.dump(self.config, f, indent=2, sort_keys=True)
-                self.changed = False
-            interval = time.time() - start_time
+                logger.info("{} append {}".format(self._journal_filename, interval))
+
+            else:
+                self._write_snapshot(self._snapshot_take())
+                interval = time.time() - start_time
+
+                logger.info("{} write {}".format(self.filename, interval))
+
+        return self.changed
+
+    def _schedule_save(self, delay):
+        if self._handle_save is not None:
+            self._handle_save.cancel()
+            self._handle_save = None
+
+        if delay:
+            self._handle_save = self._loop.call_later(delay, self._schedule_save, 0)
+        else:
+            asyncio.ensure_future(self.save_async()).add_done_callback(lambda future: future.result())
+
+    @asyncio.coroutine
+    def save_async(self):
+        """Save config to file (only if config has changed) without blocking the event loop
+        a consistent copy of the changes is taken on the loop, serialisation and disk i/o
+        happen in the default executor
+        """
+        yield from self._save_lock.acquire()
+        try:
+            if not self.changed:
+                return False
+
+            start_time = time.time()
+
+            if self._journal_ready():
+                write = functools.partial(self._write_journal, self._journal_take())
+                filename = self._journal_filename
+            else:
+                write = functools.partial(self._write_snapshot, self._snapshot_take())
+                filename = self.filename
 
-            logger.info("{} write {}".format(self.filename, interval))
+            try:
+                yield from self._loop.run_in_executor(None, write)
+            except:
+                # whatever was taken is lost to the file, make sure the next save is complete
+                self.changed = True
+                self._journal_snapshot = True
+                raise
+
+            interval = time.time() - start_time
+            logger.info("{} write {}".format(filename, interval))
+        finally:
+            self._save_lock.release()
 
         return self.changed
 
+    @asyncio.coroutine
     def flush(self):
-        if self._timer_save and self._timer_save.is_alive():
+        """Save any pending changes immediately, await during shutdown"""
+        if self._handle_save is not None:
             logger.info("flushing {}".format(self.filename))
-            self._timer_save.cancel()
-        self.save(delay=False)
+            self._handle_save.cancel()
+            self._handle_save = None
+        yield from self.save_async()
+
+    def _journal_ready(self):
+        return ( self.journal
+                    and not self._journal_snapshot
+                    and self._journal_entries + len(self._journal_pending) <= self.journal_compact )
+
+    def _journal_take(self):
+        pending, self._journal_pending = self._journal_pending, []
+        self.changed = False
+        return pending
+
+    def _snapshot_take(self):
+        snapshot = _snapshot(self.config)
+        self._journal_pending = []
+        self._journal_snapshot = False
+        self.changed = False
+        return snapshot
+
+    def _write_journal(self, pending):
+        if not pending:
+            return
+
+        with self._write_lock:
+            with open(self._journal_filename, 'a') as f:
+                f.write("\n".join(pending) + "\n")
+                f.flush()
+                os.fsync(f.fileno())
+            self._journal_entries = self._journal_entries + len(pending)
+
+    def _write_snapshot(self, snapshot):
+        with self._write_lock:
+            if self.failsafe_backups:
+                self._make_failsafe_backup()
+
+            # write aside and swap in, a crash never leaves a partial file behind
+            with open(self.filename + ".tmp", 'w') as f:
+                json.dump(snapshot, f, indent=2, sort_keys=True)
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(self.filename + ".tmp", self.filename)
+
+            if self.journal:
+                # compaction: the snapshot now contains everything journalled so far
+                if os.path.isfile(self._journal_filename):
+                    os.remove(self._journal_filename)
+                self._journal_entries = 0
 
     def get_by_path(self, keys_list):
         """Get item from config by path (list of keys)"""
@@ -122,10 +317,18 @@ class Config(collections.MutableMapping):
         """Set item in config by path (list of keys)"""
         self.get_by_path(keys_list[:-1])[keys_list[-1]] = value
         self.changed = True
+        self._invalidate_suboptions()
+        if len(keys_list) > 1:
+            # top-level keys are journalled by __setitem__
+            self._journal_append("set", keys_list, value)
 
     def pop_by_path(self, keys_list):
         popped_value = self.get_by_path(keys_list[:-1]).pop(keys_list[-1])
         self.changed = True
+        self._invalidate_suboptions()
+        if len(keys_list) > 1:
+            # top-level keys are journalled by __delitem__
+            self._journal_append("pop", keys_list)
         return popped_value
 
     def get_option(self, keyname):
@@ -136,12 +339,32 @@ class Config(collections.MutableMapping):
         return value
 
     def get_suboption(self, grouping, groupname, keyname):
+        if self._suboptions is not None:
+            try:
+                return self._suboptions[grouping, groupname, keyname]
+            except KeyError:
+                pass
+
         try:
             value = self.config[grouping][groupname][keyname]
         except KeyError:
             value = self.get_option(keyname)
+
+        if self._suboptions is not None:
+            self._suboptions[grouping, groupname, keyname] = value
+
         return value
 
+    def get_suboptions(self, grouping, groupname, keynames):
+        """bulk get_suboption(), returns dict of keyname: value"""
+        return { keyname: self.get_suboption(grouping, groupname, keyname)
+                 for keyname in keynames }
+
+    def _invalidate_suboptions(self):
+        self.generation = self.generation + 1
+        if self._suboptions:
+            self._suboptions.clear()
+
     def exists(self, keys_list):
         _exists = True
 
@@ -162,13 +385,209 @@ class Config(collections.MutableMapping):
     def __setitem__(self, key, value):
         self.config[key] = value
         self.changed = True
+        self._invalidate_suboptions()
+        self._journal_append("set", [key], value)
 
     def __delitem__(self, key):
         del self.config[key]
         self.changed = True
+        self._invalidate_suboptions()
+        self._journal_append("pop", [key])
 
     def __iter__(self):
         return iter(self.config)
 
     def __len__(self):
         return len(self.config)
+
+
+class _SQLiteBucket(collections.MutableMapping):
+    """top-level dict of SQLiteConfig, each key is a row that is only read on first access"""
+    def __init__(self, store, name, keys=()):
+        self._store = store
+        self.name = name
+        self._keys = dict.fromkeys(keys)
+        self._loaded = {}
+        self._dirty = set()
+
+    def touch(self, key):
+        self._dirty.add(key)
+        self._store.changed = True
+
+    def __getitem__(self, key):
+        if key not in self._loaded:
+            if key not in self._keys:
+                raise KeyError(key)
+            self._loaded[key] = self._store._read_entry(self.name, key)
+        return self._loaded[key]
+
+    def __setitem__(self, key, value):
+        self._keys[key] = None
+        self._loaded[key] = value
+        self.touch(key)
+
+    def __delitem__(self, key):
+        del self._keys[key]
+        self._loaded.pop(key, None)
+        self.touch(key)
+
+    def __iter__(self):
+        return iter(list(self._keys))
+
+    def __len__(self):
+        return len(self._keys)
+
+
+class SQLiteConfig(Config):
+    """Config-compatible storage in a local sqlite database
+    top-level dicts (user_data, conv_data, convmem, ...) are split into one row per key, rows are
+    loaded on first access and saving only writes changed rows inside a single transaction
+    * changes are tracked through set_by_path(), pop_by_path() and item assignment at the first
+      two levels, call force_taint() after changing deeper values in-place
+    """
+    def __init__(self, filename, default=None, save_delay=0, cache_suboptions=False, **kwargs):
+        self._connection = sqlite3.connect(filename, check_same_thread=False)
+        self._connection.executescript(
+            "CREATE TABLE IF NOT EXISTS toplevel (key TEXT PRIMARY KEY, value TEXT);"
+            "CREATE TABLE IF NOT EXISTS entries (bucket TEXT NOT NULL, key TEXT NOT NULL, value TEXT NOT NULL,"
+            " PRIMARY KEY (bucket, key));")
+        self._dirty = set()
+
+        super().__init__(filename, default=default, save_delay=save_delay, cache_suboptions=cache_suboptions)
+
+    def load(self, recovery=False):
+        """Load top-level keys from the database, rows of top-level dicts are read on demand"""
+        with self._write_lock:
+            toplevel = self._connection.execute("SELECT key, value FROM toplevel").fetchall()
+            entries = self._connection.execute("SELECT bucket, key FROM entries").fetchall()
+
+        keys = collections.defaultdict(list)
+        for bucket, key in entries:
+            keys[bucket].append(key)
+
+        self.config = {}
+        for key, value in toplevel:
+            if value is None:
+                self.config[key] = _SQLiteBucket(self, key, keys[key])
+            else:
+                self.config[key] = json.loads(value)
+
+        logger.info("{} read".format(self.filename))
+
+        self._dirty = set()
+        self._invalidate_suboptions()
+        self.changed = False
+
+    def _read_entry(self, bucket, key):
+        with self._write_lock:
+            row = self._connection.execute(
+                "SELECT value FROM entries WHERE bucket = ? AND key = ?", (bucket, key)).fetchone()
+        return json.loads(row[0])
+
+    def force_taint(self):
+        """mark everything that was read as changed"""
+        for key, value in self.config.items():
+            if isinstance(value, _SQLiteBucket):
+                value._dirty.update(value._loaded)
+            else:
+                self._dirty.add(key)
+        self._invalidate_suboptions()
+        self.changed = True
+
+    def loads(self, json_str):
+        """Load config from JSON string"""
+        for key in list(self.config):
+            del self[key]
+        for key, value in json.loads(json_str).items():
+            self[key] = value
+
+    def _snapshot_take(self):
+        """collect changed rows, values are serialised immediately so later changes cannot leak in"""
+        statements = []
+
+        for key in self._dirty:
+            statements.append(("DELETE FROM entries WHERE bucket = ?", (key,)))
+            if key not in self.config:
+                statements.append(("DELETE FROM toplevel WHERE key = ?", (key,)))
+            elif isinstance(self.config[key], _SQLiteBucket):
+                bucket = self.config[key]
+                statements.append(("INSERT OR REPLACE INTO toplevel VALUES (?, NULL)", (key,)))
+                for entry_key in bucket:
+                    statements.append(("INSERT INTO entries VALUES (?, ?, ?)",
+                                       (key, entry_key, json.dumps(bucket[entry_key]))))
+                bucket._dirty = set()
+            else:
+                statements.append(("INSERT OR REPLACE INTO toplevel VALUES (?, ?)",
+                                    (key, json.dumps(self.config[key]))))
+
+        for key, bucket in self.config.items():
+            if not isinstance(bucket, _SQLiteBucket) or not bucket._dirty:
+                continue
+            for entry_key in bucket._dirty:
+                if entry_key in bucket:
+                    statements.append(("INSERT OR REPLACE INTO entries VALUES (?, ?, ?)",
+                                       (key, entry_key, json.dumps(bucket[entry_key]))))
+                else:
+                    statements.append(("DELETE FROM entries WHERE bucket = ? AND key = ?", (key, entry_key)))
+            bucket._dirty = set()
+
+        self._dirty = set()
+        self.changed = False
+        return statements
+
+    def _write_snapshot(self, statements):
+        with self._write_lock:
+            with self._connection:
+                for statement, parameters in statements:
+                    self._connection.execute(statement, parameters)
+
+    def _touch_path(self, keys_list):
+        value = self.config.get(keys_list[0])
+        if isinstance(value, _SQLiteBucket):
+            if len(keys_list) > 1:
+                value.touch(keys_list[1])
+        else:
+            self._dirty.add(keys_list[0])
+
+    def set_by_path(self, keys_list, value):
+        """Set item in config by path (list of keys)"""
+        super().set_by_path(keys_list, value)
+        self._touch_path(keys_list)
+
+    def pop_by_path(self, keys_list):
+        popped_value = super().pop_by_path(keys_list)
+        if len(keys_list) > 1:
+            self._touch_path(keys_list)
+        return popped_value
+
+    def __setitem__(self, key, value):
+        if isinstance(value, dict):
+            bucket = _SQLiteBucket(self, key)
+            bucket._keys = dict.fromkeys(value)
+            bucket._loaded = dict(value)
+            value = bucket
+        self.config[key] = value
+        self._dirty.add(key)
+        self._invalidate_suboptions()
+        self.changed = True
+
+    def __delitem__(self, key):
+        del self.config[key]
+        self._dirty.add(key)
+        self._invalidate_suboptions()
+        self.changed = True
+
+
+def migrate_to_sqlite(json_filename, sqlite_filename):
+    """one-shot migration of a json memory file into a new sqlite database
+    * changes still in the journal of a memory-journal bot are replayed, not lost"""
+    source = Config(json_filename, journal=True)
+    target = SQLiteConfig(sqlite_filename)
+
+    for key, value in source.config.items():
+        target[key] = value
+    target.save(delay=False)
+
+    logger.info("migrated {} keys from {} to {}".format(len(source), json_filename, sqlite_filename))
+
+    return target
@@ -2,6 +2,7 @@ import logging
 import shlex
 import asyncio
 import inspect
+import re
 import time
 import uuid
 
@@ -9,6 +10,7 @@ import hangups
 
 import plugins
 from commands import command
+from registry import ExpiringRegistry
 
 
 logger = logging.getLogger(__name__)
@@ -20,14 +22,22 @@ class EventHandler:
     def __init__(self, bot, bot_command='/bot'):
         self.bot = bot
         self.bot_command = bot_command
+        self._command_prefix = None # (aliases, compiled alias prefix matcher), see handle_command()
 
         self._prefix_reprocessor = "uuid://"
-        self._reprocessors = {}
 
-        self._passthrus = {}
-        self._contexts = {}
-        self._image_ids = {}
-        self._executables = {}
+        # ids in these registries are only needed until a sent message returns from Google
+        _ttl = bot.get_config_option('handlers.registry.ttl') or 3600
+        _maxsize = bot.get_config_option('handlers.registry.maxsize') or 10000
+
+        self._reprocessors = ExpiringRegistry("reprocessors", _ttl, _maxsize)
+        self._passthrus = ExpiringRegistry("passthrus", _ttl, _maxsize)
+        self._contexts = ExpiringRegistry("contexts", _ttl, _maxsize)
+        self._image_ids = ExpiringRegistry("image_ids", _ttl, _maxsize)
+        self._executables = ExpiringRegistry("executables", _ttl, _maxsize)
+
+        self._image_waiters = {} # image_id: [ futures resolved with the image uri ]
+        self._image_uri_timeout = bot.get_config_option('handlers.image_uri.timeout') or 60
 
         self.pluggables = { "allmessages": [],
                             "call": [],
@@ -48,12 +58,56 @@ class EventHandler:
                              {},
                              forgiving=True )
 
-    def register_handler(self, function, type="message", priority=50, extra_metadata=None):
+        asyncio.ensure_future(self._sweep_registries()).add_done_callback(self._sweeper_done)
+
+    def registry_stats(self):
+        """size, hit, miss, expiry and eviction counts of the id registries"""
+        return { registry.name: registry.stats()
+                 for registry in ( self._reprocessors,
+                                   self._passthrus,
+                                   self._contexts,
+                                   self._image_ids,
+                                   self._executables ) }
+
+    def sweep_registries(self):
+        """drop expired ids from the registries"""
+        for registry in ( self._reprocessors,
+                          self._passthrus,
+                          self._contexts,
+                          self._image_ids,
+                          self._executables ):
+            removed = registry.sweep()
+            if removed:
+                logger.debug("{}: {} expired".format(registry.name, removed))
+        logger.debug("registries: {}".format(self.registry_stats()))
+
+    @asyncio.coroutine
+    def _sweep_registries(self, interval=60):
+        # a reconnect replaces the EventHandler, stop sweeping for the old one
+        while self.bot._handlers in (None, self):
+            yield from asyncio.sleep(interval)
+            self.sweep_registries()
+
+    def _sweeper_done(self, future):
+        # cancelled on shutdown, that is no error
+        if not future.cancelled() and future.exception():
+            logger.error("registry sweeper failed", exc_info=future.exception())
+
+    def register_handler(self, function, type="message", priority=50, extra_metadata=None,
+                         concurrent=False, timeout=None):
         """
         register hangouts event handler
         * extra_metadata is function-specific, and will be added along with standard plugin-defined metadata
         * depending on event type, may perform transparent conversion of function into coroutine for convenience
           * reference to original function is stored as part of handler metadata
+        * concurrent=True starts the handler and goes on with the next handlers of the same priority
+          while it runs, handlers of later priorities wait until it is done
+          * for independent (usually network-bound) handlers that do not rely on the event being
+            modified by, or suppressed by, other handlers of the same priority
+          * SuppressAllHandlers/SuppressEventHandling raised by a concurrent handler take effect
+            after all handlers of its priority have finished
+        * timeout (seconds) stops waiting for a coroutine handler that takes longer, the handler is
+          cancelled wherever it is: only use it for handlers that are safe to interrupt
         * returns actual handler that will be used
         """
 
@@ -68,6 +122,8 @@ class EventHandler:
         elif type in ["sending"]:
             if asyncio.iscoroutine(_handler):
                 raise RuntimeError("{} handler cannot be a coroutine".format(type))
+            if concurrent or timeout:
+                raise RuntimeError("{} handler cannot be concurrent or have a timeout".format(type))
         else:
             raise ValueError("unknown event type for handler: {}".format(type))
 
@@ -87,6 +143,13 @@ class EventHandler:
         if not _metadata.get("module.path"):
             raise ValueError("module.path not defined")
 
+        # dispatch plan: resolved once here instead of on every event
+        _metadata["dispatch.arity"] = len(inspect.signature(_handler).parameters)
+        _metadata["dispatch.coroutine"] = asyncio.iscoroutinefunction(_handler)
+        _metadata["dispatch.label"] = "{}: {}.{}".format(type, _metadata["module.path"], _handler.__name__)
+        _metadata["dispatch.concurrent"] = concurrent
+        _metadata["dispatch.timeout"] = timeout
+
         self.pluggables[type].append((_handler, priority, _metadata))
         self.pluggables[type].sort(key=lambda tup: tup[1])
 
@@ -192,29 +255,40 @@ class EventHandler:
     def image_uri_from(self, image_id, callback, *args, **kwargs):
         """XXX: there isn't a direct way to resolve an image_id to the public url without
         posting it first via the api. other plugins and functions can establish a short-lived
-        task to wait for the image id to be posted, and retrieve the url in an asyncronous way"""
-
-        ticks = 0
-        while True:
-            if image_id not in self._image_ids:
-                yield from asyncio.sleep(1)
-                ticks = ticks + 1
-                if ticks > 60:
-                    return False
-            else:
-                yield from callback(self._image_ids[image_id], *args, **kwargs)
-                return True
+        task to wait for the image id to be posted, and retrieve the url in an asyncronous way
+        * the wait ends as soon as handle_chat_message() associates the image id, or after
+          config.handlers.image_uri.timeout seconds (default: 60)"""
+
+        if image_id in self._image_ids:
+            image_uri = self._image_ids[image_id]
+
+        else:
+            waiter = asyncio.Future()
+            self._image_waiters.setdefault(image_id, []).append(waiter)
+            try:
+                image_uri = yield from asyncio.wait_for(waiter, self._image_uri_timeout)
+            except asyncio.TimeoutError:
+                return False
+            finally:
+                waiters = self._image_waiters.get(image_id, [])
+                if waiter in waiters:
+                    waiters.remove(waiter)
+                if not waiters:
+                    self._image_waiters.pop(image_id, None)
+
+        yield from callback(image_uri, *args, **kwargs)
+        return True
 
     @asyncio.coroutine
     def run_reprocessor(self, id, event, *args, **kwargs):
         if id in self._reprocessors:
-            is_coroutine = asyncio.iscoroutinefunction(self._reprocessors[id])
+            _reprocessor = self._reprocessors.pop(id)
+            is_coroutine = asyncio.iscoroutinefunction(_reprocessor)
             logger.info("reprocessor uuid found: {} coroutine={}".format(id, is_coroutine))
             if is_coroutine:
-                yield from self._reprocessors[id](self.bot, event, id, *args, **kwargs)
+                yield from _reprocessor(self.bot, event, id, *args, **kwargs)
             else:
-                self._reprocessors[id](self.bot, event, id, *args, **kwargs)
-            del self._reprocessors[id]
+                _reprocessor(self.bot, event, id, *args, **kwargs)
 
     @asyncio.coroutine
     def handle_chat_message(self, event):
@@ -235,12 +309,10 @@ class EventHandler:
                     yield from self.run_reprocessor(annotation.value, event)
                 elif annotation.type == 1026:
                     if annotation.value in self._passthrus:
-                        event.passthru = self._passthrus[annotation.value]
-                        del self._passthrus[annotation.value]
+                        event.passthru = self._passthrus.pop(annotation.value)
                 elif annotation.type == 1027:
                     if annotation.value in self._contexts:
-                        event.context = self._contexts[annotation.value]
-                        del self._contexts[annotation.value]
+                        event.context = self._contexts.pop(annotation.value)
 
             if len(event.conv_event.segments) > 0:
                 for segment in event.conv_event.segments:
@@ -258,8 +330,7 @@ class EventHandler:
                         logger.info("auto opt-in for {}".format(event.user.id_.chat_id))
                         return
 
-            """map image ids to their public uris in absence of any fixed server api
-               XXX: small memory leak over time as each id gets cached indefinitely"""
+            """map image ids to their public uris in absence of any fixed server api"""
 
             if( event.passthru
                     and "original_request" in event.passthru
@@ -274,8 +345,12 @@ class EventHandler:
                     self._image_ids[_image_id] = _image_uri
                     logger.info("associating image_id={} with {}".format(_image_id, _image_uri))
 
-            """first occurence of an actual executable id needs to be handled as an event
-               XXX: small memory leak over time as each id gets cached indefinitely"""
+                    # wake up anything waiting in image_uri_from()
+                    for waiter in self._image_waiters.pop(_image_id, []):
+                        if not waiter.done():
+                            waiter.set_result(_image_uri)
+
+            """first occurence of an actual executable id needs to be handled as an event"""
 
             if( event.passthru and "executable" in event.passthru and event.passthru["executable"] ):
                 if event.passthru["executable"] not in self._executables:
@@ -294,7 +369,33 @@ class EventHandler:
 
     @asyncio.coroutine
     def handle_command(self, event):
-        """Handle command messages"""
+        """Handle command messages
+        * fast path: only messages starting with a bot alias (or sent in one-to-ones with
+          auto_alias_one_to_one) go on to config, tag and permission checks"""
+
+        # ensure bot alias is always a list
+        if not isinstance(self.bot_command, list):
+            self.bot_command = [self.bot_command]
+
+        # check that a bot alias is used e.g. /bot
+        if self._command_prefix is None or self._command_prefix[0] != self.bot_command:
+            # aliases are compared with the lowercased first word, so mixed-case aliases never match
+            _aliases = [ re.escape(alias) for alias in self.bot_command if alias == alias.lower() ]
+            self._command_prefix = ( list(self.bot_command),
+                                     re.compile(r"\s*(?:{})(?:\s|$)".format("|".join(_aliases) or "(?!)"),
+                                                re.IGNORECASE) )
+
+        if not event.text.strip():
+            # nothing to parse, e.g. image-only messages
+            return
+
+        auto_alias = False
+        if not self._command_prefix[1].match(event.text):
+            if( self.bot.conversations.catalog[event.conv_id]["type"] == "ONE_TO_ONE"
+                    and self.bot.get_config_option('auto_alias_one_to_one') ):
+                auto_alias = True
+            else:
+                return
 
         # is commands_enabled?
 
@@ -307,16 +408,8 @@ class EventHandler:
             if event.user_id.chat_id not in admins_list:
                 return
 
-        # ensure bot alias is always a list
-        if not isinstance(self.bot_command, list):
-            self.bot_command = [self.bot_command]
-
-        # check that a bot alias is used e.g. /bot
-        if not event.text.split()[0].lower() in self.bot_command:
-            if self.bot.conversations.catalog[event.conv_id]["type"] == "ONE_TO_ONE" and self.bot.get_config_option('auto_alias_one_to_one'):
-                event.text = u" ".join((self.bot_command[0], event.text)) # Insert default alias if not already present
-            else:
-                return
+        if auto_alias:
+            event.text = u" ".join((self.bot_command[0], event.text)) # Insert default alias if not already present
 
         # Parse message
         event.text = event.text.replace(u'\xa0', u' ') # convert non-breaking space in Latin1 (ISO 8859-1)
@@ -396,51 +489,95 @@ class EventHandler:
     @asyncio.coroutine
     def run_pluggable_omnibus(self, name, *args, **kwargs):
         if name in self.pluggables:
+            _debug = logger.isEnabledFor(logging.DEBUG)
+            label = name
             try:
+                band = [] # tasks of the concurrent handlers of the current priority
+                band_priority = None
                 for function, priority, plugin_metadata in self.pluggables[name]:
-                    message = ["{}: {}.{}".format(
-                                name,
-                                plugin_metadata["module.path"],
-                                function.__name__)]
+                    if band and priority != band_priority:
+                        yield from self._finish_pluggable_band(band)
+                        band = []
+
+                    label = plugin_metadata["dispatch.label"]
+
+                    if plugin_metadata["dispatch.concurrent"]:
+                        # runs while the other handlers of its priority are processed
+                        band.append(asyncio.ensure_future(
+                            self._run_pluggable(function, plugin_metadata, args, _debug)))
+                        band_priority = priority
+                        continue
 
                     try:
-                        """accepted handler signatures:
-                        coroutine(bot, event, command)
-                        coroutine(bot, event)
-                        function(bot, event, context)
-                        function(bot, event)
-                        """
-                        _expected = list(inspect.signature(function).parameters)
-                        _passed = args[0:len(_expected)]
-                        if asyncio.iscoroutinefunction(function):
-                            message.append("coroutine")
-                            logger.debug(" : ".join(message))
-                            yield from function(*_passed)
-                        else:
-                            message.append("function")
-                            logger.debug(" : ".join(message))
-                            function(*_passed)
-                    except self.bot.Exceptions.SuppressHandler:
-                        # skip this pluggable, continue with next
-                        message.append("SuppressHandler")
-                        logger.debug(" : ".join(message))
-                        pass
+                        yield from self._run_pluggable(function, plugin_metadata, args, _debug)
                     except (self.bot.Exceptions.SuppressEventHandling,
-                            self.bot.Exceptions.SuppressAllHandlers):
-                        # skip all pluggables, decide whether to handle event at next level
+                            self.bot.Exceptions.SuppressAllHandlers) as e:
+                        if band:
+                            yield from self._finish_pluggable_band(band, e)
                         raise
-                    except:
-                        message = " : ".join(message)
-                        logger.exception(message)
+
+                if band:
+                    yield from self._finish_pluggable_band(band)
 
             except self.bot.Exceptions.SuppressAllHandlers:
                 # skip all other pluggables, but let the event continue
-                message.append("SuppressAllHandlers")
-                logger.debug(" : ".join(message))
+                if _debug:
+                    logger.debug("{} : SuppressAllHandlers".format(label))
 
             except:
                 raise
 
+    @asyncio.coroutine
+    def _finish_pluggable_band(self, band, suppressed=None):
+        """wait for the concurrent handlers of a priority, then raise the strongest suppression
+        raised by them or by a sequential handler of the same priority (suppressed)"""
+        results = yield from asyncio.gather(*band, return_exceptions=True)
+        if suppressed is not None:
+            results.append(suppressed)
+
+        for suppression in (self.bot.Exceptions.SuppressEventHandling,
+                            self.bot.Exceptions.SuppressAllHandlers):
+            for result in results:
+                if isinstance(result, suppression):
+                    raise result
+
+    @asyncio.coroutine
+    def _run_pluggable(self, function, plugin_metadata, args, _debug):
+        label = plugin_metadata["dispatch.label"]
+        timeout = plugin_metadata["dispatch.timeout"]
+
+        try:
+            """accepted handler signatures:
+            coroutine(bot, event, command)
+            coroutine(bot, event)
+            function(bot, event, context)
+            function(bot, event)
+            """
+            _passed = args[0:plugin_metadata["dispatch.arity"]]
+            if plugin_metadata["dispatch.coroutine"]:
+                if _debug:
+                    logger.debug("{} : coroutine".format(label))
+                if timeout:
+                    yield from asyncio.wait_for(function(*_passed), timeout)
+                else:
+                    yield from function(*_passed)
+            else:
+                if _debug:
+                    logger.debug("{} : function".format(label))
+                function(*_passed)
+        except self.bot.Exceptions.SuppressHandler:
+            # skip this pluggable, continue with next
+            if _debug:
+                logger.debug("{} : SuppressHandler".format(label))
+        except (self.bot.Exceptions.SuppressEventHandling,
+                self.bot.Exceptions.SuppressAllHandlers):
+            # skip all pluggables, decide whether to handle event at next level
+            raise
+        except asyncio.TimeoutError:
+            logger.warning("{} : timed out after {}s".format(label, timeout))
+        except:
+            logger.exception(label)
+
 class HandlerBridge:
     """shim for xmikosbot handler decorator"""
 
@@ -1,18 +1,22 @@
-import asyncio, logging, time
+import asyncio, logging, time, weakref
 
 from collections import namedtuple
 
 import hangups
 
 import hangups_shim
+import outbound
 
-from utils import ( simple_parse_to_segments,
-                    segment_to_html )
+from parsers import cached_parse_to_segments
+from utils import segment_to_html
 
 
 logger = logging.getLogger(__name__)
 
 
+_send_locks = weakref.WeakValueDictionary() # conv_id: asyncio.Lock, alive while a send is pending
+
+
 ConversationID = namedtuple('conversation_id', ['id', 'id_'])
 
 ClientConversation = namedtuple( 'client_conversation',
@@ -157,10 +161,12 @@ class FakeConversation(object):
         self.id_ = id_
 
     @asyncio.coroutine
-    def send_message(self, message, image_id=None, otr_status=None, context=None):
+    def send_message(self, message, image_id=None, otr_status=None, context=None, priority=None):
 
         """ChatMessageSegment: parse message"""
 
+        serialised_segments = None
+
         if message is None:
             # nothing to do if the message is blank
             segments = []
@@ -171,7 +177,10 @@ class FakeConversation(object):
             raw_message = message.replace("*", "\\*").replace("_", "\\_").replace("`", "\\`")
         elif isinstance(message, str):
             # preferred method: markdown-formatted message (or less preferable but OK: html)
-            segments = simple_parse_to_segments(message)
+            # relayed messages are sent to several conversations, parse each text only once
+            segments, serialised_segments = cached_parse_to_segments(message)
+            segments = list(segments)
+            serialised_segments = list(serialised_segments) or None
             raw_message = message
         elif isinstance(message, list):
             # who does this anymore?
@@ -183,10 +192,8 @@ class FakeConversation(object):
         else:
             raise TypeError("unknown message type supplied")
 
-        if segments:
+        if segments and serialised_segments is None:
             serialised_segments = [seg.serialize() for seg in segments]
-        else:
-            serialised_segments = None
 
         if "original_request" not in context["passthru"]:
             context["passthru"]["original_request"] = { "message": raw_message,
@@ -239,14 +246,30 @@ class FakeConversation(object):
 
         """send the message"""
 
-        with (yield from asyncio.Lock()):
-            yield from self._client.send_chat_message(
-                hangups.hangouts_pb2.SendChatMessageRequest(
-                    request_header = self._client.get_request_header(),
-                    message_content = hangups.hangouts_pb2.MessageContent( segment=serialised_segments ),
-                    existing_media = media_attachment,
-                    annotation = annotations,
-                    event_request_header = hangups.hangouts_pb2.EventRequestHeader(
-                        conversation_id=hangups.hangouts_pb2.ConversationId( id=self.id_ ),
-                        client_generated_id=self._client.get_client_generated_id(),
-                        expected_otr = otr_status )))
+        # one request in flight per conversation, waiters are served in arrival order
+        lock = _send_locks.get(self.id_)
+        if lock is None:
+            lock = _send_locks[self.id_] = asyncio.Lock()
+
+        # retries re-send the same request, the client generated id lets the server drop duplicates
+        request = hangups.hangouts_pb2.SendChatMessageRequest(
+            request_header = self._client.get_request_header(),
+            message_content = hangups.hangouts_pb2.MessageContent( segment=serialised_segments ),
+            existing_media = media_attachment,
+            annotation = annotations,
+            event_request_header = hangups.hangouts_pb2.EventRequestHeader(
+                conversation_id=hangups.hangouts_pb2.ConversationId( id=self.id_ ),
+                client_generated_id=self._client.get_client_generated_id(),
+                expected_otr = otr_status ))
+
+        if priority is None:
+            priority = outbound.PRIORITY_NORMAL
+
+        yield from lock.acquire()
+        try:
+            yield from self.bot.outbound.run( self._client.send_chat_message,
+                                              request,
+                                              conv_id = self.id_,
+                                              priority = priority )
+        finally:
+            lock.release()
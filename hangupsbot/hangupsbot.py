@@ -1,6 +1,8 @@
 #!/usr/bin/env python3
 import appdirs, argparse, asyncio, gettext, logging, logging.config, os, shutil, signal, sys, time
 
+from collections import OrderedDict
+
 import hangups
 
 import hangups_shim
@@ -13,6 +15,7 @@ import permamem
 import tagging
 
 import hooks
+import outbound
 import sinks
 import plugins
 
@@ -51,11 +54,15 @@ class HangupsBot(object):
 
         self._cache_event_id = {} # workaround for duplicate events
 
+        self._send_queues = {} # conv_id: asyncio.Future, resolved when the latest send to it is done
+        self._conversation_updates = {} # conv_id: hangups conversation, permamem updates deferred by _on_event()
+        self.outbound = outbound.OutboundScheduler(self) # rate limits calls to the hangouts api
+
         self._locales = {}
 
         # Load config file
         try:
-            self.config = config.Config(config_path)
+            self.config = config.Config(config_path, cache_suboptions=True)
         except ValueError:
             logging.exception("failed to load config, malformed json")
             sys.exit()
@@ -68,22 +75,47 @@ class HangupsBot(object):
         # load in previous memory, or create new one
         self.memory = None
         if memory_file:
+            _engine = (self.get_config_option('memory-engine') or "json").lower()
             _failsafe_backups = int(self.get_config_option('memory-failsafe_backups') or 3)
             _save_delay = int(self.get_config_option('memory-save_delay') or 1)
+            _journal = bool(self.get_config_option('memory-journal'))
+            _journal_compact = int(self.get_config_option('memory-journal_compact') or 1000)
 
-            logger.info("memory = {}, failsafe = {}, delay = {}".format(
-                memory_file, _failsafe_backups, _save_delay))
+            if _engine == "sqlite":
+                _sqlite_file = os.path.splitext(memory_file)[0] + ".sqlite"
 
-            self.memory = config.Config(memory_file, failsafe_backups=_failsafe_backups, save_delay=_save_delay)
-            if not os.path.isfile(memory_file):
-                try:
-                    logger.info("creating memory file: {}".format(memory_file))
-                    self.memory.force_taint()
-                    self.memory.save()
+                logger.info("memory = {}, engine = sqlite, delay = {}".format(
+                    _sqlite_file, _save_delay))
+
+                if not os.path.isfile(_sqlite_file) and os.path.isfile(memory_file):
+                    try:
+                        logger.info("migrating memory file: {}".format(memory_file))
+                        config.migrate_to_sqlite(memory_file, _sqlite_file)
 
-                except (OSError, IOError) as e:
-                    logger.exception('FAILED TO CREATE DEFAULT MEMORY FILE')
-                    sys.exit()
+                    except (OSError, IOError, ValueError) as e:
+                        logger.exception('FAILED TO MIGRATE MEMORY FILE')
+                        sys.exit()
+
+                self.memory = config.SQLiteConfig(_sqlite_file, save_delay=_save_delay)
+
+            else:
+                logger.info("memory = {}, failsafe = {}, delay = {}, journal = {}".format(
+                    memory_file, _failsafe_backups, _save_delay, _journal and _journal_compact))
+
+                self.memory = config.Config( memory_file,
+                                             failsafe_backups=_failsafe_backups,
+                                             save_delay=_save_delay,
+                                             journal=_journal,
+                                             journal_compact=_journal_compact )
+                if not os.path.isfile(memory_file):
+                    try:
+                        logger.info("creating memory file: {}".format(memory_file))
+                        self.memory.force_taint()
+                        self.memory.save()
+
+                    except (OSError, IOError) as e:
+                        logger.exception('FAILED TO CREATE DEFAULT MEMORY FILE')
+                        sys.exit()
 
         # Handle signals on Unix
         # (add_signal_handler is not implemented on Windows)
@@ -174,8 +206,8 @@ class HangupsBot(object):
                 finally:
                     loop.run_until_complete(plugins.unload_all(self))
 
-                    self.memory.flush()
-                    self.config.flush()
+                    loop.run_until_complete(self.memory.flush())
+                    loop.run_until_complete(self.config.flush())
 
                 logger.info('Waiting %s seconds...', 5 + retry * 5)
                 time.sleep(5 + retry * 5)
@@ -345,6 +377,10 @@ class HangupsBot(object):
     def get_config_suboption(self, conv_id, option):
         return self.config.get_suboption("conversations", conv_id, option)
 
+    def get_config_suboptions(self, conv_id, options):
+        """resolve several per-conversation options at once, returns dict of option: value"""
+        return self.config.get_suboptions("conversations", conv_id, options)
+
     def get_memory_option(self, option):
         return self.memory.get_option(option)
 
@@ -604,6 +640,29 @@ class HangupsBot(object):
             pass
 
 
+    def _defer_conversation_update(self, conv):
+        """batch permamem updates of known conversations, a burst of events in a conversation
+        is a single update, run after a delay instead of ahead of the event handlers"""
+        if not self._conversation_updates:
+            delay = self.get_config_option('permamem.update_delay') or 1
+            asyncio.get_event_loop().call_later(delay, self._start_conversation_updates)
+        self._conversation_updates[conv.id_] = conv
+
+    def _start_conversation_updates(self):
+        asyncio.ensure_future(
+            self._run_conversation_updates()
+        ).add_done_callback(lambda future: future.result())
+
+    @asyncio.coroutine
+    def _run_conversation_updates(self):
+        updates = self._conversation_updates
+        self._conversation_updates = {}
+        for conv in updates.values():
+            try:
+                yield from self.conversations.update(conv, source="event")
+            except Exception:
+                logger.exception("permamem update of {} failed".format(conv.id_))
+
     @asyncio.coroutine
     def _on_event(self, conv_event):
         """Handle conversation events"""
@@ -623,8 +682,13 @@ class HangupsBot(object):
 
         event = ConversationEvent(self, conv_event)
 
-        yield from self.conversations.update(self._conv_list.get(conv_event.conversation_id),
-                                             source="event")
+        conv = self._conv_list.get(conv_event.conversation_id)
+        if conv.id_ in self.conversations.catalog:
+            # known conversation: permamem bookkeeping waits until the handlers had the loop
+            self._defer_conversation_update(conv)
+        else:
+            # new conversation: handlers expect it in the catalog
+            yield from self.conversations.update(conv, source="event")
 
         if isinstance(conv_event, hangups.ChatMessageEvent):
             self._execute_hook("on_chat_message", event)
@@ -728,9 +792,11 @@ class HangupsBot(object):
 
     @asyncio.coroutine
     def coro_send_message(self, conversation, message, context=None, image_id=None):
+        """send a message to a conversation and to every target added by the sending handlers
+        returns dict of conv_id: hangups.NetworkError for targets that failed"""
         if not message and not image_id:
             # at least a message OR an image_id must be supplied
-            return
+            return {}
 
         # get the context
 
@@ -744,6 +810,9 @@ class HangupsBot(object):
             # default legacy context
             context["base"] = self._messagecontext_legacy()
 
+        # relays arrive with the original request already attached, queue them behind direct replies
+        relayed = "original_request" in context["passthru"]
+
         # get the conversation id
 
         if isinstance(conversation, (FakeConversation, hangups.conversation.Conversation)):
@@ -761,7 +830,7 @@ class HangupsBot(object):
             yield from self._handlers.run_pluggable_omnibus("sending", self, broadcast_list, context)
         except self.Exceptions.SuppressEventHandling:
             logger.info("message sending: SuppressEventHandling")
-            return
+            return {}
         except:
             raise
 
@@ -769,19 +838,75 @@ class HangupsBot(object):
 
         # begin message sending.. for REAL!
 
-        for response in broadcast_list:
-            logger.debug("message sending: {}".format(response[0]))
+        """group by conversation: each conversation gets one sender that keeps the message order,
+        distinct conversations are sent to concurrently, self.outbound bounds the concurrency"""
 
-            # send messages using FakeConversation as a workaround
+        targets = OrderedDict()
+        for response in broadcast_list:
+            targets.setdefault(response[0], []).append(response)
 
-            _fc = FakeConversation(self, response[0])
+        failed = {}
 
+        @asyncio.coroutine
+        def _send_to_conversation(target_id, responses):
+            # claim the place in the conversation queue before yielding to other tasks,
+            #   senders start in creation order, so earlier calls are always queued first
+            previous = self._send_queues.get(target_id)
+            done = self._send_queues[target_id] = asyncio.Future()
             try:
-                yield from _fc.send_message( response[1],
-                                             image_id = response[2],
-                                             context = context )
-            except hangups.NetworkError as e:
-                logger.exception("CORO_SEND_MESSAGE: error sending {}".format(response[0]))
+                if previous is not None:
+                    yield from asyncio.wait([previous])
+
+                # targets added by the sending handlers are relays as well
+                if "priority" in context:
+                    priority = context["priority"]
+                elif relayed or target_id != conversation_id:
+                    priority = outbound.PRIORITY_BULK
+                else:
+                    priority = outbound.PRIORITY_INTERACTIVE
+
+                # send messages using FakeConversation as a workaround
+                _fc = FakeConversation(self, target_id)
+
+                # send_message() fills in history and the original request, per target
+                _context = dict(context)
+                _context["passthru"] = dict(context["passthru"])
+
+                for response in responses:
+                    logger.debug("message sending: {}".format(target_id))
+                    try:
+                        yield from _fc.send_message( response[1],
+                                                     image_id = response[2],
+                                                     context = _context,
+                                                     priority = priority )
+                    except hangups.NetworkError as e:
+                        logger.exception("CORO_SEND_MESSAGE: error sending {}".format(target_id))
+                        failed[target_id] = e
+            finally:
+                done.set_result(None)
+                if self._send_queues.get(target_id) is done:
+                    del self._send_queues[target_id]
+
+        senders = [ asyncio.ensure_future(_send_to_conversation(target_id, responses))
+                    for target_id, responses in targets.items() ]
+
+        yield from asyncio.gather(*senders)
+
+        return failed
+
+
+    @asyncio.coroutine
+    def coro_upload_image(self, image_data, filename, priority=outbound.PRIORITY_NORMAL):
+        """upload a file-like object through self.outbound, returns the image id"""
+        start = image_data.tell()
+
+        @asyncio.coroutine
+        def upload_image():
+            # rewind, a retry must upload the whole image again
+            image_data.seek(start)
+            return (yield from self._client.upload_image(image_data, filename=filename))
+
+        return (yield from self.outbound.run(upload_image, priority=priority))
 
 
     @asyncio.coroutine
@@ -878,13 +1003,16 @@ class HangupsBot(object):
         if not conv._conversation.type == hangups.hangouts_pb2.CONVERSATION_TYPE_GROUP:
             raise TypeError('Conversation is not a group')
         try:
-            yield from self._client.add_user(
+            yield from self.outbound.run(
+                self._client.add_user,
                 hangups.hangouts_pb2.AddUserRequest(
                     request_header=self._client.get_request_header(),
                     event_request_header=conv._get_event_request_header(),
                     invitee_id=[hangups.hangouts_pb2.InviteeID(gaia_id=user_id)
                                 for user_id in user_ids],
-                )
+                ),
+                conv_id=chat_id,
+                retries=0,
             )
         except exceptions.NetworkError as e:
             logger.warning('Failed to add user: {}'.format(e))
@@ -0,0 +1,63 @@
+import re
+
+
+_word_character = re.compile(r"\w")
+
+
+def is_word_boundary(text, position):
+    """True if position in text is a regex word boundary (\\b)"""
+    before = position > 0 and bool(_word_character.match(text[position - 1]))
+    after = position < len(text) and bool(_word_character.match(text[position]))
+    return before != after
+
+
+class KeywordAutomaton:
+    """aho-corasick automaton: finds every (possibly overlapping) occurrence of a set of
+    literal keywords in a single pass over the text
+    * matching is exact, lowercase both keywords and text for case-insensitive matching
+    """
+    def __init__(self, keywords=()):
+        self.keywords = set(keyword for keyword in keywords if keyword)
+
+        self._goto = [{}] # state: { character: next state }
+        self._fail = [0] # state: fallback state on mismatch
+        self._output = [()] # state: keywords ending in this state
+
+        for keyword in self.keywords:
+            state = 0
+            for character in keyword:
+                if character not in self._goto[state]:
+                    self._goto.append({})
+                    self._fail.append(0)
+                    self._output.append(())
+                    self._goto[state][character] = len(self._goto) - 1
+                state = self._goto[state][character]
+            self._output[state] = (keyword,)
+
+        # breadth-first: failure links of shallower states are resolved first
+        queue = list(self._goto[0].values())
+        for state in queue:
+            for character, next_state in self._goto[state].items():
+                fallback = self._fail[state]
+                while fallback and character not in self._goto[fallback]:
+                    fallback = self._fail[fallback]
+                self._fail[next_state] = self._goto[fallback].get(character, 0)
+                self._output[next_state] = self._output[next_state] + self._output[self._fail[next_state]]
+                queue.append(next_state)
+
+    def __len__(self):
+        return len(self.keywords)
+
+    def find(self, text):
+        """yield (start, end, keyword) for every occurrence of a keyword in text"""
+        goto = self._goto
+        fail = self._fail
+        output = self._output
+
+        state = 0
+        for position, character in enumerate(text):
+            while state and character not in goto[state]:
+                state = fail[state]
+            state = goto[state].get(character, 0)
+            for keyword in output[state]:
+                yield position + 1 - len(keyword), position + 1, keyword
@@ -0,0 +1,186 @@
+import asyncio, base64, hashlib, io, logging, mimetypes, tempfile
+
+import aiohttp
+
+
+logger = logging.getLogger(__name__)
+
+
+_defaults = { "memory": 1048576, # bytes kept in memory, larger files are spooled to disk
+              "limit": 26214400, # bytes, larger files are rejected
+              "chunk": 65536 } # bytes read from the network at a time
+
+_signatures = [ ( 0, b"\xff\xd8\xff", "image/jpeg" ),
+                ( 0, b"\x89PNG\r\n\x1a\n", "image/png" ),
+                ( 0, b"GIF87a", "image/gif" ),
+                ( 0, b"GIF89a", "image/gif" ),
+                ( 8, b"WEBP", "image/webp" ),
+                ( 0, b"BM", "image/bmp" ),
+                ( 4, b"ftyp", "video/mp4" ),
+                ( 0, b"\x1a\x45\xdf\xa3", "video/webm" ) ]
+
+_sniff_length = max(offset + len(signature) for offset, signature, content_type in _signatures)
+
+
+class MediaTooLarge(Exception):
+    pass
+
+
+def sniff(head):
+    """content type from the first bytes of a file, None if unknown"""
+    for offset, signature, content_type in _signatures:
+        if head[offset:offset + len(signature)] == signature:
+            return content_type
+    return None
+
+
+def guess_extension(content_type):
+    """extension with a leading ".", mimetypes is inconsistent for jpeg"""
+    if content_type == "image/jpeg":
+        return ".jpg"
+    return mimetypes.guess_extension(content_type or "") or ""
+
+
+class Media:
+    """downloaded or decoded file, held in a spooled temporary file
+
+    config.json "media" overrides the keys of _defaults
+
+    * content_type is sniffed from the first bytes, header_type is what the sender claimed
+      * chunks can be shorter than a signature, the first bytes are collected until sniffed is True
+    * sha256 is hashed while the file is written
+    * close() when done, the file may live on disk
+    """
+    def __init__(self, bot, header_type=None):
+        self.options = dict(_defaults)
+        self.options.update(bot.get_config_option("media") or {})
+
+        self.file = tempfile.SpooledTemporaryFile(max_size=self.options["memory"])
+        self.size = 0
+        self.header_type = header_type
+        self.content_type = None
+        self.sha256 = hashlib.sha256()
+        self._head = b""
+
+    @property
+    def type(self):
+        return self.content_type or self.header_type
+
+    @property
+    def sniffed(self):
+        """True once enough bytes arrived for content_type to be final"""
+        return len(self._head) >= _sniff_length
+
+    @asyncio.coroutine
+    def write(self, chunk):
+        if not self.sniffed:
+            self._head = self._head + chunk[:_sniff_length - len(self._head)]
+            self.content_type = sniff(self._head)
+
+        self.size = self.size + len(chunk)
+        if self.size > self.options["limit"]:
+            raise MediaTooLarge("more than {} bytes".format(self.options["limit"]))
+
+        self.sha256.update(chunk)
+
+        if self.size > self.options["memory"]:
+            # spooled to disk, do not block the event loop on it
+            yield from asyncio.get_event_loop().run_in_executor(None, self.file.write, chunk)
+        else:
+            self.file.write(chunk)
+
+    def read(self):
+        """the whole file as bytes, only for consumers that cannot take a file"""
+        self.file.seek(0)
+        return self.file.read()
+
+    @asyncio.coroutine
+    def reader(self):
+        """a real file object at the start of the file, for aiohttp payloads and the like"""
+        self.file.seek(0)
+        if isinstance(self.file, io.IOBase):
+            return self.file
+        # older SpooledTemporaryFile is no io.IOBase: it has to be moved to disk, not on the loop
+        yield from asyncio.get_event_loop().run_in_executor(None, self.file.rollover)
+        self.file.seek(0)
+        return io.open(self.file.fileno(), "rb", closefd=False)
+
+    @asyncio.coroutine
+    def upload(self, bot, filename, **kwargs):
+        """upload to hangouts through bot.coro_upload_image(), returns the image id"""
+        self.file.seek(0)
+        return (yield from bot.coro_upload_image(self.file, filename=filename, **kwargs))
+
+    def close(self):
+        self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+@asyncio.coroutine
+def from_response(bot, response, accept=None):
+    """stream the body of an aiohttp response into a Media
+    * accept(media): called once the content type is sniffed (or the file ended before), the
+      download is stopped if it returns False
+    returns None if not accepted, raises MediaTooLarge"""
+    media = Media(bot, header_type=response.content_type)
+    try:
+        if response.content_length and response.content_length > media.options["limit"]:
+            raise MediaTooLarge("{} bytes announced".format(response.content_length))
+
+        accepted = accept is None
+        while True:
+            chunk = yield from response.content.read(media.options["chunk"])
+            if not chunk:
+                break
+            yield from media.write(chunk)
+            if not accepted and media.sniffed:
+                if not accept(media):
+                    media.close()
+                    return None
+                accepted = True
+
+        if not accepted and not accept(media):
+            media.close()
+            return None
+
+    except:
+        media.close()
+        raise
+
+    finally:
+        response.release()
+
+    logger.debug("{} bytes of {}".format(media.size, media.type))
+    return media
+
+
+@asyncio.coroutine
+def download(bot, url, session, headers=None, accept=None):
+    """stream url into a Media with an aiohttp.ClientSession, see from_response()"""
+    response = yield from session.get(url, headers=headers)
+    try:
+        response.raise_for_status()
+    except aiohttp.ClientResponseError:
+        response.release()
+        raise
+    return (yield from from_response(bot, response, accept=accept))
+
+
+@asyncio.coroutine
+def from_base64(bot, data):
+    """decode base64 data into a Media, a slice at a time, raises MediaTooLarge"""
+    media = Media(bot)
+    data = "".join(data.split())
+    step = media.options["chunk"] // 3 * 4 # whole base64 quanta
+    try:
+        for start in range(0, len(data), step):
+            yield from media.write(base64.b64decode(data[start:start + step]))
+    except:
+        media.close()
+        raise
+    return media
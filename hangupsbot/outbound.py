@@ -0,0 +1,262 @@
+import asyncio, heapq, itertools, logging, random, re, time
+
+import hangups
+
+
+logger = logging.getLogger(__name__)
+
+
+PRIORITY_INTERACTIVE = 0 # command replies and other direct responses
+PRIORITY_NORMAL = 1
+PRIORITY_BULK = 2 # relays, mass notifications, batch operations
+
+_priority_labels = { PRIORITY_INTERACTIVE: "interactive",
+                     PRIORITY_NORMAL: "normal",
+                     PRIORITY_BULK: "bulk" }
+
+_defaults = { "rate": 5.0, # global calls/second
+              "burst": 10,
+              "concurrency": 8, # calls in flight
+              "conversation-rate": 1.0, # calls/second into a single conversation
+              "conversation-burst": 5,
+              "retries": 3, # retries of a call that failed with a transient hangups.NetworkError
+              "backoff": 1.0 } # seconds, doubled for each retry and jittered
+
+"""hangups raises NetworkError for everything, only the message tells a timeout or a dropped
+connection from an error status returned by the api, e.g. adding a user who is already a member"""
+_transient = re.compile(r"Request timed out|Server disconnected error|Request connection error"
+                        r"|Request return unexpected status: (429|5\d\d)\b")
+
+
+def is_transient(error):
+    """True if a hangups.NetworkError may succeed when the call is repeated"""
+    return bool(_transient.match(str(error)))
+
+
+class TokenBucket:
+    """allow rate calls/second on average with bursts of up to burst calls
+    * rate <= 0 disables the limit"""
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = max(1, burst)
+        self.tokens = self.burst
+        self.updated = time.monotonic()
+
+    def _refill(self, now):
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def delay(self, now):
+        """seconds until a token is available, 0 if one is available now"""
+        if self.rate <= 0:
+            return 0
+        self._refill(now)
+        if self.tokens >= 1:
+            return 0
+        return (1 - self.tokens) / self.rate
+
+    def consume(self):
+        if self.rate > 0:
+            self.tokens = self.tokens - 1
+
+    def idle(self, now):
+        """True if the bucket is full again and can be discarded"""
+        return self.rate <= 0 or self.delay(now) == 0 and self.tokens >= self.burst
+
+
+class OutboundScheduler:
+    """central queue for hangouts api calls: the global and per-conversation token buckets
+    throttle the calls, waiting calls are dispatched by priority and then in order of arrival,
+    calls that raise a transient hangups.NetworkError are retried with jittered exponential backoff
+
+    config.json "outbound" overrides the keys of _defaults
+    """
+    def __init__(self, bot):
+        self.bot = bot
+
+        self._queue = [] # heap: [ priority, sequence, conv_id, job ]
+        self._sequence = itertools.count()
+        self._conversations = {} # conv_id: TokenBucket
+        self._bucket = None
+        self._options = None
+        self._wakeup = None
+        self._worker = None
+        self._running = 0
+
+        self.counters = { "sent": 0, "retried": 0, "failed": 0, "throttled": 0 }
+        self.peak = 0
+        self._dispatched = 0
+        self._waited = 0.0
+
+    def configure(self):
+        """(re)load the limits from config"""
+        options = dict(_defaults)
+        options.update(self.bot.get_config_option("outbound") or {})
+        self._options = options
+        self._bucket = TokenBucket(options["rate"], options["burst"])
+        self._conversations = {}
+
+    @asyncio.coroutine
+    def run(self, function, *args, conv_id=None, priority=PRIORITY_NORMAL, retries=None, **kwargs):
+        """queue function(*args, **kwargs) and return its result once it ran
+        function is called again for every retry, it must return a fresh coroutine each time
+        * retries: overrides config, use 0 for requests that must not be repeated, a timed out
+          request may still have been applied"""
+        if self._options is None:
+            self.configure()
+
+        job = { "function": function,
+                "args": args,
+                "kwargs": kwargs,
+                "attempt": 0,
+                "retries": self._options["retries"] if retries is None else retries,
+                "queued": time.monotonic(),
+                "future": asyncio.Future() }
+
+        self._enqueue([ priority, next(self._sequence), conv_id, job ])
+
+        return (yield from job["future"])
+
+    def _enqueue(self, entry):
+        heapq.heappush(self._queue, entry)
+        self.peak = max(self.peak, len(self._queue))
+
+        if self._worker is None or self._worker.done():
+            self._wakeup = asyncio.Event()
+            self._worker = asyncio.ensure_future(self._dispatcher())
+        self._wakeup.set()
+
+    def _next(self, now):
+        """pop the first queued entry that can run now, otherwise return the seconds to wait
+        * None: wait for a running call to finish"""
+        if self._running >= self._options["concurrency"]:
+            return None, None
+
+        delay = self._bucket.delay(now)
+        if delay:
+            return None, delay
+
+        skipped = []
+        found = None
+        delay = None
+        while self._queue:
+            entry = heapq.heappop(self._queue)
+            conv_id = entry[2]
+            if conv_id is None:
+                found = entry
+                break
+            if conv_id not in self._conversations:
+                self._conversations[conv_id] = TokenBucket( self._options["conversation-rate"],
+                                                            self._options["conversation-burst"] )
+            wait = self._conversations[conv_id].delay(now)
+            if not wait:
+                found = entry
+                break
+            skipped.append(entry)
+            delay = wait if delay is None else min(delay, wait)
+
+        for entry in skipped:
+            heapq.heappush(self._queue, entry)
+
+        if found:
+            self._bucket.consume()
+            if found[2] is not None:
+                self._conversations[found[2]].consume()
+
+        return found, delay
+
+    @asyncio.coroutine
+    def _dispatcher(self):
+        while self._queue:
+            self._wakeup.clear()
+            now = time.monotonic()
+
+            entry, delay = self._next(now)
+            if entry:
+                job = entry[3]
+                self._dispatched = self._dispatched + 1
+                self._running = self._running + 1
+                self._waited = self._waited + now - job["queued"]
+                asyncio.ensure_future(self._call(entry))
+                continue
+
+            if delay is None:
+                yield from self._wakeup.wait()
+                continue
+
+            self.counters["throttled"] = self.counters["throttled"] + 1
+            try:
+                # a new entry may be for a conversation that is not throttled
+                yield from asyncio.wait_for(self._wakeup.wait(), delay)
+            except asyncio.TimeoutError:
+                pass
+
+        # discard buckets that refilled completely, they hold no state
+        now = time.monotonic()
+        for conv_id in [ conv_id for conv_id, bucket in self._conversations.items() if bucket.idle(now) ]:
+            del self._conversations[conv_id]
+
+    @asyncio.coroutine
+    def _call(self, entry):
+        job = entry[3]
+        try:
+            if job["future"].cancelled():
+                return
+            result = yield from job["function"](*job["args"], **job["kwargs"])
+
+        except hangups.NetworkError as e:
+            if job["attempt"] >= job["retries"] or not is_transient(e):
+                self.counters["failed"] = self.counters["failed"] + 1
+                if not job["future"].done():
+                    job["future"].set_exception(e)
+                return
+
+            # retry outside of the concurrency limit, the call re-enters the queue after the backoff
+            asyncio.ensure_future(self._retry(entry, e))
+
+        except Exception as e:
+            if not job["future"].done():
+                job["future"].set_exception(e)
+
+        else:
+            self.counters["sent"] = self.counters["sent"] + 1
+            if not job["future"].done():
+                job["future"].set_result(result)
+
+        finally:
+            self._running = self._running - 1
+            if self._wakeup is not None:
+                self._wakeup.set()
+
+    @asyncio.coroutine
+    def _retry(self, entry, error):
+        job = entry[3]
+
+        delay = self._options["backoff"] * 2 ** job["attempt"] * random.uniform(0.5, 1.5)
+        job["attempt"] = job["attempt"] + 1
+        self.counters["retried"] = self.counters["retried"] + 1
+        logger.warning("{} failed, retry {}/{} in {:.1f}s: {}".format(
+            getattr(job["function"], "__name__", job["function"]),
+            job["attempt"], job["retries"], delay, error))
+
+        yield from asyncio.sleep(delay)
+
+        # keep the original sequence, the retry does not lose its place
+        job["queued"] = time.monotonic()
+        self._enqueue(entry)
+
+    def stats(self):
+        """queue depth and counters"""
+        depth = { label: 0 for label in _priority_labels.values() }
+        for entry in self._queue:
+            label = _priority_labels.get(entry[0], str(entry[0]))
+            depth[label] = depth.get(label, 0) + 1
+
+        return { "queued": len(self._queue),
+                 "depth": depth,
+                 "peak": self.peak,
+                 "running": self._running,
+                 "throttled conversations": len([ bucket for bucket in self._conversations.values()
+                                                  if bucket.tokens < 1 ]),
+                 "average wait": self._waited / self._dispatched if self._dispatched else 0.0,
+                 **self.counters }
@@ -1,6 +1,8 @@
 """file imported by utils.py
 more parsers and parser utility functions can be imported here
 """
+import functools
+
 import hangups
 
 import parsers.kludgy_html_parser
@@ -20,4 +22,13 @@ def simple_parse_to_segments(formatted_text):
         # fallback to internal parser
         # supports html
         segments = kludgy_html_parser.simple_parse_to_segments(formatted_text)
-    return segments
\ No newline at end of file
+    return segments
+
+
+@functools.lru_cache(maxsize=512)
+def cached_parse_to_segments(formatted_text):
+    """simple_parse_to_segments() with a bounded LRU cache keyed by the formatted text
+    returns a tuple of (segments, serialised segments), both tuples - treat them as read-only
+    useful when the same message is sent to several conversations"""
+    segments = tuple(simple_parse_to_segments(formatted_text))
+    return segments, tuple(segment.serialize() for segment in segments)
@@ -0,0 +1,61 @@
+"""parser throughput benchmark, built from the kludgy_html_parser test_parser() strings
+usage: benchmark.py [-h] [-r ROUNDS] [-t TARGETS]
+
+optional arguments:
+  -h, --help            show this help message and exit
+  -r ROUNDS, --rounds ROUNDS
+                        number of passes over the test strings
+  -t TARGETS, --targets TARGETS
+                        conversations each message is relayed to (cached parsing)
+
+example usage:
+python3 parsers/benchmark.py --rounds 2000 --targets 5
+"""
+import argparse, os, sys, time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+import parsers
+
+from parsers import kludgy_html_parser
+
+parser = argparse.ArgumentParser()
+parser.add_argument('-r', '--rounds', type=int, default=2000, help="number of passes over the test strings")
+parser.add_argument('-t', '--targets', type=int, default=5, help="conversations each message is relayed to")
+
+args = parser.parse_args()
+
+# markdown variants exercise the ReParser pass as well
+messages = [ test[0] for test in kludgy_html_parser.test_strings ]
+messages = messages + [ "**{}** _relayed_ `{}`".format(message, message) for message in messages ]
+
+
+def parse_and_serialise(message):
+    return [ segment.serialize() for segment in parsers.simple_parse_to_segments(message) ]
+
+def parse_and_serialise_cached(message):
+    return parsers.cached_parse_to_segments(message)[1]
+
+def urlify(message):
+    return kludgy_html_parser.fix_urls(message)
+
+
+results = []
+for label, function, repeat in [ ("fix_urls", urlify, 1),
+                                 ("parse", parse_and_serialise, 1),
+                                 ("parse x{} targets".format(args.targets), parse_and_serialise, args.targets),
+                                 ("cached x{} targets".format(args.targets), parse_and_serialise_cached, args.targets) ]:
+    parsers.cached_parse_to_segments.cache_clear()
+
+    start_time = time.time()
+    for number in range(args.rounds):
+        for message in messages:
+            # unique text per round, as in real traffic
+            message = "{} {}".format(message, number)
+            for target in range(repeat):
+                function(message)
+    interval = time.time() - start_time
+
+    count = args.rounds * len(messages)
+    print("{}: {:.2f}us/message, {:.0f} messages/s".format(
+        label, interval / count * 1000000, count / interval))
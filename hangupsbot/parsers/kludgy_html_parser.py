@@ -192,85 +192,89 @@ def fix_urls(text):
     text = " ".join(urlified)
     return text
 
-def test_parser():
-    test_strings = [
-        ["hello world",
-            'hello world', # expected return by fix_urls()
-            [1]], # expected number of segments returned by simple_parse_to_segments()
-        ["http://www.google.com/",
-            '<a href="http://www.google.com/">http://www.google.com/</a>',
-            [1]],
-        ["https://www.google.com/?a=b&c=d&e=f",
-            '<a href="https://www.google.com/?a=b&c=d&e=f">https://www.google.com/?a=b&c=d&e=f</a>',
-            [1]],
-        ["&lt;html-encoded test&gt;",
-            '&lt;html-encoded test&gt;',
-            [1]],
-        ["A&B&C&D&E",
-            'A&B&C&D&E',
-            [1]],
-        ["A&<b>B</b>&C&D&E",
-            'A&<b>B</b>&C&D&E',
-            [3]],
-        ["A&amp;B&amp;C&amp;D&amp;E",
-            'A&amp;B&amp;C&amp;D&amp;E',
-            [1]],
-        ["C&L",
-            'C&L',
-            [1]],
-        ["<in a fake tag>",
-            '<in a fake tag>',
-            [1]],
-        ['<img src="http://i.imgur.com/E3gxs.gif"/>',
-            '<img src="http://i.imgur.com/E3gxs.gif"/>',
-            [1]],
-        ['<img src="http://i.imgur.com/E3gxs.gif" />',
-            '<img src="http://i.imgur.com/E3gxs.gif" />',
-            [1]],
-        ['<img src="http://i.imgur.com/E3gxs.gif" abc />',
-            '<img src="http://i.imgur.com/E3gxs.gif" abc />',
-            [1]],
-        ['<in "a"="abc" fake tag>',
-            '<in "a"="abc" fake tag>',
-            [1]],
-        ['<in a=abc fake tag>',
-            '<in a=abc fake tag>',
-            [1]],
-        ["abc <some@email.com>",
-            'abc <some@email.com>',
-            [1]],
-        ['</in "a"="xyz" fake tag>', # XXX: fails due to HTMLParser limitations
-            '</in "a"="xyz" fake tag>',
-            [1]],
-        ['<html><html><b></html></b><b>ABC</b>', # XXX: </html> is consumed
-            '<html><html><b></html></b><b>ABC</b>',
-            [2]],
-        ["go here: http://www.google.com/",
-            'go here: <a href="http://www.google.com/">http://www.google.com/</a>',
-            [2]],
-        ['go here: <a href="http://google.com/">http://www.google.com/</a>',
-            'go here: <a href="http://google.com/">http://www.google.com/</a>',
-            [2]],
-        ["go here: http://www.google.com/ abc",
-            'go here: <a href="http://www.google.com/">http://www.google.com/</a> abc',
-            [3]],
-        ['http://i.imgur.com/E3gxs.gif',
-            '<a href="http://i.imgur.com/E3gxs.gif">http://i.imgur.com/E3gxs.gif</a>',
-            [1]],
-        ['(http://i.imgur.com/E3gxs.gif)',
-            '(<a href="http://i.imgur.com/E3gxs.gif">http://i.imgur.com/E3gxs.gif</a>)',
-            [3]],
-        ['(http://i.imgur.com/E3gxs.gif).',
-            '(<a href="http://i.imgur.com/E3gxs.gif">http://i.imgur.com/E3gxs.gif</a>).',
-            [3]],
-        ['XXXXXXXXXXXXXXXXXXXhttp://i.imgur.com/E3gxs.gif)........',
-            'XXXXXXXXXXXXXXXXXXX<a href="http://i.imgur.com/E3gxs.gif">http://i.imgur.com/E3gxs.gif</a>)........',
-            [3]],
-        ["https://www.google.com<br />",
-            '<a href="https://www.google.com">https://www.google.com</a><br />',
-            [2]]
-    ]
 
+"""[ original, expected return by fix_urls(), [ expected number of segments ] ]
+shared by test_parser() and parsers/benchmark.py"""
+test_strings = [
+    ["hello world",
+        'hello world', # expected return by fix_urls()
+        [1]], # expected number of segments returned by simple_parse_to_segments()
+    ["http://www.google.com/",
+        '<a href="http://www.google.com/">http://www.google.com/</a>',
+        [1]],
+    ["https://www.google.com/?a=b&c=d&e=f",
+        '<a href="https://www.google.com/?a=b&c=d&e=f">https://www.google.com/?a=b&c=d&e=f</a>',
+        [1]],
+    ["&lt;html-encoded test&gt;",
+        '&lt;html-encoded test&gt;',
+        [1]],
+    ["A&B&C&D&E",
+        'A&B&C&D&E',
+        [1]],
+    ["A&<b>B</b>&C&D&E",
+        'A&<b>B</b>&C&D&E',
+        [3]],
+    ["A&amp;B&amp;C&amp;D&amp;E",
+        'A&amp;B&amp;C&amp;D&amp;E',
+        [1]],
+    ["C&L",
+        'C&L',
+        [1]],
+    ["<in a fake tag>",
+        '<in a fake tag>',
+        [1]],
+    ['<img src="http://i.imgur.com/E3gxs.gif"/>',
+        '<img src="http://i.imgur.com/E3gxs.gif"/>',
+        [1]],
+    ['<img src="http://i.imgur.com/E3gxs.gif" />',
+        '<img src="http://i.imgur.com/E3gxs.gif" />',
+        [1]],
+    ['<img src="http://i.imgur.com/E3gxs.gif" abc />',
+        '<img src="http://i.imgur.com/E3gxs.gif" abc />',
+        [1]],
+    ['<in "a"="abc" fake tag>',
+        '<in "a"="abc" fake tag>',
+        [1]],
+    ['<in a=abc fake tag>',
+        '<in a=abc fake tag>',
+        [1]],
+    ["abc <some@email.com>",
+        'abc <some@email.com>',
+        [1]],
+    ['</in "a"="xyz" fake tag>', # XXX: fails due to HTMLParser limitations
+        '</in "a"="xyz" fake tag>',
+        [1]],
+    ['<html><html><b></html></b><b>ABC</b>', # XXX: </html> is consumed
+        '<html><html><b></html></b><b>ABC</b>',
+        [2]],
+    ["go here: http://www.google.com/",
+        'go here: <a href="http://www.google.com/">http://www.google.com/</a>',
+        [2]],
+    ['go here: <a href="http://google.com/">http://www.google.com/</a>',
+        'go here: <a href="http://google.com/">http://www.google.com/</a>',
+        [2]],
+    ["go here: http://www.google.com/ abc",
+        'go here: <a href="http://www.google.com/">http://www.google.com/</a> abc',
+        [3]],
+    ['http://i.imgur.com/E3gxs.gif',
+        '<a href="http://i.imgur.com/E3gxs.gif">http://i.imgur.com/E3gxs.gif</a>',
+        [1]],
+    ['(http://i.imgur.com/E3gxs.gif)',
+        '(<a href="http://i.imgur.com/E3gxs.gif">http://i.imgur.com/E3gxs.gif</a>)',
+        [3]],
+    ['(http://i.imgur.com/E3gxs.gif).',
+        '(<a href="http://i.imgur.com/E3gxs.gif">http://i.imgur.com/E3gxs.gif</a>).',
+        [3]],
+    ['XXXXXXXXXXXXXXXXXXXhttp://i.imgur.com/E3gxs.gif)........',
+        'XXXXXXXXXXXXXXXXXXX<a href="http://i.imgur.com/E3gxs.gif">http://i.imgur.com/E3gxs.gif</a>)........',
+        [3]],
+    ["https://www.google.com<br />",
+        '<a href="https://www.google.com">https://www.google.com</a><br />',
+        [2]]
+]
+
+
+def test_parser():
     print("*** TEST: utils.fix_urls() ***")
     DEVIATION = False
     for test in test_strings:
@@ -1,8 +1,9 @@
-import asyncio, datetime, logging, random, re
+import asyncio, bisect, datetime, logging, random, re
 
 import hangups
 
 import hangups_shim
+import outbound
 
 bot = None
 
@@ -55,6 +56,75 @@ class conversation_memory:
         self.bot = bot
         self.catalog = {}
 
+        """secondary indices for get(), maintained by _catalog_set() and _catalog_remove()"""
+        self._indexed = {} # conv_id: (participants, type, title n-grams, participant count)
+        self._index_participants = {} # chat_id: set(conv_id)
+        self._index_type = {} # lowercase type: set(conv_id)
+        self._index_title = {} # title n-gram: set(conv_id)
+        self._index_count = [] # sorted [ (participant count, conv_id) ]
+
+        self._fingerprints = {} # conv_id: fingerprint of the hangups Conversation at the last update()
+
+        """user name index for find_users(), built on first use"""
+        self._users_indexed = None # chat_id: (nickname, name n-grams)
+        self._index_nicknames = {} # lowercase nickname: set(chat_id)
+        self._index_names = {} # name n-gram: set(chat_id)
+
+    @staticmethod
+    def _fingerprint(conv):
+        """hash of every Conversation and User attribute that update() stores"""
+        return hash(( conv.name,
+                      conv._conversation.type,
+                      conv.is_off_the_record,
+                      tuple( ( User.id_.chat_id,
+                               User.full_name,
+                               User.first_name,
+                               User.photo_url,
+                               tuple(User.emails),
+                               User.is_self )
+                             for User in conv.users ) ))
+
+    @staticmethod
+    def _title_ngrams(text, n=3):
+        """n-grams of the lowercase title with spaces stripped, used to narrow down text: searches"""
+        text = text.lower().replace(" ", "")
+        return set(text[i:i+n] for i in range(len(text) - n + 1))
+
+    def _catalog_set(self, conv_id, convdata):
+        self._catalog_remove(conv_id)
+        self.catalog[conv_id] = convdata
+
+        participants = frozenset(convdata["participants"])
+        conv_type = convdata["type"].lower()
+        ngrams = self._title_ngrams(convdata["title"])
+        count = len(convdata["participants"])
+
+        for chat_id in participants:
+            self._index_participants.setdefault(chat_id, set()).add(conv_id)
+        self._index_type.setdefault(conv_type, set()).add(conv_id)
+        for ngram in ngrams:
+            self._index_title.setdefault(ngram, set()).add(conv_id)
+        bisect.insort(self._index_count, (count, conv_id))
+
+        self._indexed[conv_id] = (participants, conv_type, ngrams, count)
+
+    def _catalog_remove(self, conv_id):
+        self.catalog.pop(conv_id, None)
+        if conv_id not in self._indexed:
+            return
+
+        participants, conv_type, ngrams, count = self._indexed.pop(conv_id)
+
+        for key, index in ( [ (chat_id, self._index_participants) for chat_id in participants ]
+                            + [ (conv_type, self._index_type) ]
+                            + [ (ngram, self._index_title) for ngram in ngrams ] ):
+            index[key].discard(conv_id)
+            if not index[key]:
+                del index[key]
+
+        position = bisect.bisect_left(self._index_count, (count, conv_id))
+        del self._index_count[position]
+
     def stats(self):
         logger.info("total conversations: {}".format(len(self.catalog)))
 
@@ -73,6 +143,90 @@ class conversation_memory:
                 count_user, count_user_cached, count_user_cached_definitive))
 
 
+    @staticmethod
+    def _name_forms(text):
+        """normalised forms of a name (or search text) for the user name index:
+        lowercase and accent-folded uppercase, both lowercased without spaces and underscores"""
+        from utils import remove_accents # XXX: needs to be late-imported, utils imports permamem
+
+        forms = set()
+        for form in (text.lower(), remove_accents(text.upper()).lower()):
+            forms.add(form.replace(" ", "").replace("_", ""))
+        return forms
+
+    @staticmethod
+    def _name_ngrams(text, n=2):
+        return set(text[i:i+n] for i in range(len(text) - n + 1))
+
+    def _build_user_index(self):
+        self._users_indexed = {}
+        self._index_nicknames = {}
+        self._index_names = {}
+
+        user_data = self.bot.memory["user_data"] or {}
+        for chat_id in user_data:
+            self.reindex_user(chat_id)
+
+        logger.info("indexed {} user names".format(len(self._users_indexed)))
+
+    def invalidate_user_index(self):
+        """rebuild the user name index on next use, call after reloading memory"""
+        self._users_indexed = None
+
+    def reindex_user(self, chat_id):
+        """update the user name index after the nickname or cached name of chat_id changed"""
+        if self._users_indexed is None:
+            return
+
+        if chat_id in self._users_indexed:
+            nickname, ngrams = self._users_indexed.pop(chat_id)
+            for key, index in ( [ (nickname, self._index_nicknames) ]
+                                + [ (ngram, self._index_names) for ngram in ngrams ] ):
+                if key in index:
+                    index[key].discard(chat_id)
+                    if not index[key]:
+                        del index[key]
+
+        user = self.bot.memory.get_by_path(["user_data", chat_id]) if self.bot.memory.exists(["user_data", chat_id]) else None
+        if not user or "_hangups" not in user:
+            return
+
+        nickname = (user.get("nickname") or "").lower()
+        ngrams = set()
+        for form in self._name_forms(user["_hangups"]["full_name"]):
+            ngrams.update(self._name_ngrams(form))
+
+        if nickname:
+            self._index_nicknames.setdefault(nickname, set()).add(chat_id)
+        for ngram in ngrams:
+            self._index_names.setdefault(ngram, set()).add(chat_id)
+
+        self._users_indexed[chat_id] = (nickname, ngrams)
+
+    def is_user_indexed(self, chat_id):
+        if self._users_indexed is None:
+            self._build_user_index()
+        return chat_id in self._users_indexed
+
+    def find_users(self, text):
+        """candidate chat_ids whose nickname equals text or whose full name may contain text
+        (case-insensitive, ignoring spaces, underscores and accents), callers still apply their
+        own exact matching to the candidates. returns None if text is too short to narrow down"""
+
+        if self._users_indexed is None:
+            self._build_user_index()
+
+        candidates = set(self._index_nicknames.get(text.lower(), ()))
+
+        for form in self._name_forms(text):
+            ngrams = self._name_ngrams(form)
+            if not ngrams:
+                return None
+            postings = sorted((self._index_names.get(ngram, set()) for ngram in ngrams), key=len)
+            candidates.update(postings[0].intersection(*postings[1:]))
+
+        return candidates
+
     @asyncio.coroutine
     def standardise_memory(self):
         """construct the conversation memory keys and standardise the stored structure
@@ -144,7 +298,7 @@ class conversation_memory:
             _users_to_fetch = []
 
             for convid in convs:
-                self.catalog[convid] = convs[convid]
+                self._catalog_set(convid, convs[convid])
 
                 if "participants" in self.catalog[convid] and len(self.catalog[convid]["participants"]) > 0:
                     for _chat_id in self.catalog[convid]["participants"]:
@@ -223,7 +377,9 @@ class conversation_memory:
                     batch_lookup_spec=[ hangups.hangouts_pb2.EntityLookupSpec( gaia_id=chat_id) 
                                         for chat_id in chunk ])
 
-                _response = yield from self.bot._client.get_entity_by_id(_request)
+                _response = yield from self.bot.outbound.run( self.bot._client.get_entity_by_id,
+                                                              _request,
+                                                              priority = outbound.PRIORITY_BULK )
 
                 for _user in _response.entity:
                     UserID = hangups.user.UserID(chat_id=_user.id.chat_id, gaia_id=_user.id.gaia_id)
@@ -326,6 +482,7 @@ class conversation_memory:
         if changed:
             user_dict["updated"] = datetime.datetime.now().strftime("%Y%m%d%H%M%S")
             self.bot.memory.set_by_path(["user_data", User.id_.chat_id, "_hangups"], user_dict)
+            self.reindex_user(User.id_.chat_id)
 
             if automatic_save:
                 self.bot.memory.save()
@@ -344,7 +501,14 @@ class conversation_memory:
         """update conversation memory based on supplied hangups Conversation
         conservative writing: on changed Conversation and/or User attribute changes
         return True on Conversation/User change, False on no changes
+        * skipped entirely if the Conversation fingerprint did not change since the last update
         """
+        fingerprint = self._fingerprint(conv)
+        if conv.id_ in self.catalog and self._fingerprints.get(conv.id_) == fingerprint:
+            if self.log_info_unchanged:
+                logger.info("conv {} unchanged (fingerprint)".format(conv.id_))
+            return False
+
         conv_title = name_from_hangups_conversation(conv)
 
         original = {}
@@ -439,7 +603,7 @@ class conversation_memory:
             memory["updated"] = datetime.datetime.now().strftime("%Y%m%d%H%M%S")
             self.bot.memory.set_by_path(["convmem", conv.id_], memory)
 
-            self.catalog[conv.id_] = memory
+            self._catalog_set(conv.id_, memory)
 
             if automatic_save:
                 # if users_changed this would write those changes as well
@@ -458,6 +622,10 @@ class conversation_memory:
             elif self.log_info_unchanged:
                 logger.info("users from conv {} unchanged".format(conv.id_))
 
+        if not _users_to_fetch:
+            # only once the writes succeeded, unknown users are queried again on the next update
+            self._fingerprints[conv.id_] = fingerprint
+
         return conv_changed or users_changed
 
 
@@ -467,7 +635,8 @@ class conversation_memory:
             if _cached["type"] == "GROUP":
                 logger.info("removing conv: {} {}".format(conv_id, _cached["title"]))
                 self.bot.memory.pop_by_path(["convmem", conv_id])
-                del self.catalog[conv_id]
+                self._catalog_remove(conv_id)
+                self._fingerprints.pop(conv_id, None)
 
             else:
                 logger.warning("cannot remove conv: {} {} {}".format(
@@ -508,85 +677,134 @@ class conversation_memory:
             # second condition is to ensure at least one term, even if blank
             terms.append([operator, raw_filter])
 
-        sourcelist = self.catalog.copy()
-        matched = {}
-
         logger.debug("get(): {}".format(terms))
 
+        """terms joined by "or" form a group, groups are joined by "and"
+        each group is the union of its terms, the result is the intersection of all groups"""
+        groups = []
         for operator, term in terms:
-            if operator == "and":
-                sourcelist = matched
-                matched = {}
-
-            """extra search term types added here"""
-
-            if not term:
-                # return everything
-                matched = sourcelist
-
-            elif term.startswith("id:"):
-                # explicit request for single conv
-                convid = term[3:]
-                matched[convid] = sourcelist[convid]
-
-            elif term in sourcelist:
-                # prioritise exact convid matches
-                matched[term] = sourcelist[term]
-
-            elif term.startswith("text:"):
-                # perform case-insensitive search
-                filter_lower = term[5:].lower()
-                for convid, convdata in sourcelist.items():
-                    title_lower = convdata["title"].lower()
-                    if( filter_lower in title_lower
-                            or filter_lower in title_lower.replace(" ", "") ):
-                        matched[convid] = convdata
-
-            elif term.startswith("chat_id:"):
-                # return all conversations user is in
-                filter_chat_id = term[8:]
-                for convid, convdata in sourcelist.items():
-                    for chat_id in convdata["participants"]:
-                        if filter_chat_id == chat_id:
-                            matched[convid] = convdata
-
-            elif term.startswith("tag:"):
-                # return all conversations with the tag
-                filter_tag = term[4:]
-                if filter_tag in self.bot.tags.indices["tag-convs"]:
-                    for conv_id in self.bot.tags.indices["tag-convs"][filter_tag]:
-                        if conv_id in sourcelist:
-                            matched[conv_id] = sourcelist[conv_id]
-
-            elif term.startswith("type:"):
-                # return all conversations with matching type (case-insensitive)
-                filter_type = term[5:]
-                for convid, convdata in sourcelist.items():
-                    if convdata["type"].lower() == filter_type.lower():
-                        matched[convid] = convdata
-
-            elif term.startswith("minusers:"):
-                # return all conversations with number of users or higher
-                filter_numusers = term[9:]
-                for convid, convdata in sourcelist.items():
-                    if len(convdata["participants"]) >= int(filter_numusers):
-                        matched[convid] = convdata
-
-            elif term.startswith("maxusers:"):
-                # return all conversations with number of users or lower
-                filter_numusers = term[9:]
-                for convid, convdata in sourcelist.items():
-                    if len(convdata["participants"]) <= int(filter_numusers):
-                        matched[convid] = convdata
-
-            elif term.startswith("random:"):
-                # return random conversations based on selection threshold
-                filter_random = term[7:]
-                for convid, convdata in sourcelist.items():
-                    if random.random() <= float(filter_random):
-                        matched[convid] = convdata
-
-        return matched
+            if operator == "and" or not groups:
+                groups.append([])
+            groups[-1].append(term)
+
+        """query planner: evaluate the most selective group first, then narrow down"""
+        groups.sort(key=lambda group: sum(self._estimate(term) for term in group))
+
+        candidates = None
+        for group in groups:
+            matched = set()
+            for term in group:
+                matched.update(self._evaluate(term, candidates))
+            candidates = matched if candidates is None else candidates & matched
+            if not candidates:
+                break
+
+        return { conv_id: self.catalog[conv_id] for conv_id in candidates }
+
+    def _estimate(self, term):
+        """rough number of conversations examined or returned by a single term"""
+        if not term or term.startswith("random:"):
+            return len(self.catalog)
+
+        elif term.startswith("id:") or term in self.catalog:
+            return 1
+
+        elif term.startswith("text:"):
+            ngrams = self._title_ngrams(term[5:])
+            if not ngrams:
+                return len(self.catalog)
+            return min(len(self._index_title.get(ngram, ())) for ngram in ngrams)
+
+        elif term.startswith("chat_id:"):
+            return len(self._index_participants.get(term[8:], ()))
+
+        elif term.startswith("tag:"):
+            return len(self.bot.tags.indices["tag-convs"].get(term[4:], ()))
+
+        elif term.startswith("type:"):
+            return len(self._index_type.get(term[5:].lower(), ()))
+
+        elif term.startswith("minusers:"):
+            return len(self._index_count) - bisect.bisect_left(self._index_count, (int(term[9:]),))
+
+        elif term.startswith("maxusers:"):
+            return bisect.bisect_left(self._index_count, (int(term[9:]) + 1,))
+
+        return 0
+
+    def _evaluate(self, term, candidates):
+        """set of conv_ids matching a single term
+        candidates (set or None for all) restricts terms that have to scan conversations"""
+
+        """extra search term types added here"""
+
+        if not term:
+            # return everything
+            return set(self.catalog) if candidates is None else candidates
+
+        elif term.startswith("id:"):
+            # explicit request for single conv
+            convid = term[3:]
+            self.catalog[convid] # raise KeyError for unknown conversations
+            return { convid }
+
+        elif term in self.catalog:
+            # prioritise exact convid matches
+            return { term }
+
+        elif term.startswith("text:"):
+            # perform case-insensitive search
+            filter_lower = term[5:].lower()
+            ngrams = self._title_ngrams(filter_lower)
+            if ngrams:
+                # any match contains every n-gram of the search text
+                postings = sorted((self._index_title.get(ngram, set()) for ngram in ngrams), key=len)
+                scan = set(postings[0]).intersection(*postings[1:])
+            else:
+                scan = set(self.catalog)
+            if candidates is not None:
+                scan = scan & candidates
+            matched = set()
+            for convid in scan:
+                title_lower = self.catalog[convid]["title"].lower()
+                if( filter_lower in title_lower
+                        or filter_lower in title_lower.replace(" ", "") ):
+                    matched.add(convid)
+            return matched
+
+        elif term.startswith("chat_id:"):
+            # return all conversations user is in
+            return set(self._index_participants.get(term[8:], ()))
+
+        elif term.startswith("tag:"):
+            # return all conversations with the tag
+            filter_tag = term[4:]
+            if filter_tag in self.bot.tags.indices["tag-convs"]:
+                return set( conv_id for conv_id in self.bot.tags.indices["tag-convs"][filter_tag]
+                            if conv_id in self.catalog )
+            return set()
+
+        elif term.startswith("type:"):
+            # return all conversations with matching type (case-insensitive)
+            return set(self._index_type.get(term[5:].lower(), ()))
+
+        elif term.startswith("minusers:"):
+            # return all conversations with number of users or higher
+            position = bisect.bisect_left(self._index_count, (int(term[9:]),))
+            return set(conv_id for count, conv_id in self._index_count[position:])
+
+        elif term.startswith("maxusers:"):
+            # return all conversations with number of users or lower
+            position = bisect.bisect_left(self._index_count, (int(term[9:]) + 1,))
+            return set(conv_id for count, conv_id in self._index_count[:position])
+
+        elif term.startswith("random:"):
+            # return random conversations based on selection threshold
+            filter_random = float(term[7:])
+            return set( convid for convid in (self.catalog if candidates is None else candidates)
+                        if random.random() <= filter_random )
+
+        return set()
 
     def get_name(self, conv, truncate=False, fallback_string=False):
         """drop-in replacement for hangups.ui.utils.get_conv_name
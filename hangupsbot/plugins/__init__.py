@@ -208,11 +208,14 @@ def register_admin_command(command_names, tags=None):
         command_names = [command_names]
     tracking.register_command("admin", command_names, tags=tags)
 
-def register_handler(function, type="message", priority=50, extra_metadata=None):
+def register_handler(function, type="message", priority=50, extra_metadata=None, concurrent=False, timeout=None):
     """register external handler"""
     extra_metadata = extra_metadata or {}
     bot_handlers = tracking.bot._handlers
-    return bot_handlers.register_handler(function, type, priority, extra_metadata=extra_metadata)
+    return bot_handlers.register_handler( function, type, priority,
+                                          extra_metadata=extra_metadata,
+                                          concurrent=concurrent,
+                                          timeout=timeout )
 
 def deregister_handler(function, type="message"):
     """deregister external handler"""
@@ -539,6 +542,8 @@ def unload(bot, module_path):
                         logger.debug("deregistering tagged command {}".format(command_name))
                         del command.command_tagsets[command_name]
 
+            command.invalidate_permissions()
+
             for type in bot._handlers.pluggables:
                 for handler in bot._handlers.pluggables[type]:
                     if handler[2]["module.path"] == module_path:
@@ -1,6 +1,5 @@
 import asyncio
 from collections import defaultdict
-from io import BytesIO
 import json
 import logging
 import mimetypes
@@ -12,6 +11,7 @@ from hangups import hangouts_pb2
 import emoji
 
 from webbridge import WebFramework, FakeEvent
+import media
 import plugins
 
 from .core import HANGOUTS, SLACK, Base, Message
@@ -109,7 +109,8 @@ class BridgeInstance(WebFramework):
             kwargs["attachments"] = json.dumps(attachments)
         if text:
             kwargs["text"] = text
-        msg = yield from Base.slacks[self.team].msg(channel=self.channel, link_names=True, **kwargs)
+        msg = yield from self._send_with_retry(Base.slacks[self.team].msg,
+                                               channel=self.channel, link_names=True, **kwargs)
         # Store the new message ID alongside the original message.
         # We'll receive an RTM event about it shortly.
         self.messages[msg["ts"]] = event.passthru
@@ -153,12 +154,18 @@ class BridgeInstance(WebFramework):
                 mime_type = resp.content_type
                 mime_exts = mimetypes.guess_all_extensions(mime_type)
                 if name_ext.lower() not in [ext.lower() for ext in mime_exts]:
+                    resp.release()
                     raise ValueError(("MIME '{}' does not match extension '{}', we probably didn't get the right file."
                                       " [Attempt {}/3]").format(mime_type, name_ext, retry_count + 1))
-                image = yield from resp.read()
-                image_id = yield from self.bot._client.upload_image(BytesIO(image), filename=filename)
+                # Stream it into a spooled file rather than reading it into memory.
+                image = yield from media.from_response(self.bot, resp)
+                with image:
+                    image_id = yield from image.upload(self.bot, filename)
                 yield from self._relay_msg(msg, conv_id, image_id)
                 break
+            except media.MediaTooLarge as err:
+                logger.error("Slack image '{}' is too large: {}".format(filename, err))
+                break
             except ValueError as err:
                 logger.error(err)
                 yield from asyncio.sleep(2)
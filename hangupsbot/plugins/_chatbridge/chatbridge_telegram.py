@@ -43,7 +43,8 @@ class BridgeInstance(WebFramework):
         message = re.sub(r"(?<!b|a|\")>", "&gt;", message)
 
         for eid in external_ids:
-            yield from self.telegram_api_request(
+            yield from self._send_with_retry(
+                self.telegram_api_request,
                 config["config.json"],
                 "sendMessage",
                     { "chat_id" : eid,
@@ -4,10 +4,19 @@ import hangups
 
 import plugins
 
+from keywords import KeywordAutomaton
+
 
 logger = logging.getLogger(__name__)
 
 
+"""compiled autoreplies per (conv_id, merged), dropped whenever bot.config changes"""
+_matchers = {}
+_matchers_generation = None
+
+_word_character = re.compile(r"\w")
+
+
 def _initialise(bot):
     plugins.register_handler(_handle_autoreply, type="message")
     plugins.register_handler(_handle_autoreply, type="membership")
@@ -39,9 +48,6 @@ def _handle_autoreply(bot, event, command):
     else:
         raise RuntimeError("unhandled event type")
 
-    # get_config_suboption returns the convo specific autoreply settings. If none set, it returns the global settings.
-    autoreplies_list = bot.get_config_suboption(event.conv_id, 'autoreplies')
-
     """option to merge per-conversation and global autoreplies, by:
     * tagging a conversation with "autoreplies-merge" explicitly or by wildcard conv tag
     * setting global config key: autoreplies.merge = true
@@ -51,7 +57,43 @@ def _handle_autoreply(bot, event, command):
     tagged_autoreplies_merge = "autoreplies-merge" in bot.tags.convactive(event.conv_id)
     config_autoreplies_merge = bot.get_config_option('autoreplies.merge') or False
 
-    if tagged_autoreplies_merge or config_autoreplies_merge:
+    matcher = _get_matcher(bot, event.conv_id, tagged_autoreplies_merge or config_autoreplies_merge)
+
+    for kwds, sentences in matcher.match(event.text, event_type):
+
+        if isinstance(sentences, list):
+            message = random.choice(sentences)
+        else:
+            message = sentences
+
+        if isinstance(kwds, list):
+            logger.info("matched chat: {}".format(kwds))
+        else:
+            logger.info("matched event: {}".format(kwds))
+
+        yield from send_reply(bot, event, message)
+
+
+def _get_matcher(bot, conv_id, merge):
+    global _matchers_generation
+
+    if _matchers_generation != bot.config.generation:
+        _matchers.clear()
+        _matchers_generation = bot.config.generation
+
+    if (conv_id, merge) not in _matchers:
+        _matchers[conv_id, merge] = _autoreply_matcher(_resolve_autoreplies(bot, conv_id, merge))
+
+    return _matchers[conv_id, merge]
+
+
+def _resolve_autoreplies(bot, conv_id, merge):
+    """return the list of [ keywords, sentences ] autoreplies for conv_id"""
+
+    # get_config_suboption returns the convo specific autoreply settings. If none set, it returns the global settings.
+    autoreplies_list = list(bot.get_config_suboption(conv_id, 'autoreplies') or [])
+
+    if merge:
 
         # load any global settings as well
         autoreplies_list_global = bot.get_config_option('autoreplies')
@@ -83,24 +125,55 @@ def _handle_autoreply(bot, event, command):
             # Extend original list with non-disgarded entries.
             autoreplies_list.extend( add_to_autoreplies )
 
-    if autoreplies_list:
-        for kwds, sentences in autoreplies_list:
+    return autoreplies_list
 
-            if isinstance(sentences, list):
-                message = random.choice(sentences)
-            else:
-                message = sentences
 
+class _autoreply_matcher:
+    """autoreplies compiled into a single matcher, returns triggered autoreplies in config order
+    * plain keywords are matched in one pass with a KeywordAutomaton, as whole words (case-insensitive)
+    * "regex:" keywords are compiled once
+    * "*" matches everything, event keywords (JOIN, LEAVE, ...) match the event type"""
+
+    def __init__(self, autoreplies_list):
+        self.autoreplies = autoreplies_list
+
+        self.wildcards = set() # indices of autoreplies that always trigger
+        self.literals = {} # lowercase keyword: set of autoreply indices
+        self.patterns = [] # [ (compiled regex, autoreply index) ]
+        self.events = {} # event type: set of autoreply indices
+
+        for index, (kwds, sentences) in enumerate(autoreplies_list):
             if isinstance(kwds, list):
                 for kw in kwds:
-                    if _words_in_text(kw, event.text) or kw == "*":
-                        logger.info("matched chat: {}".format(kw))
-                        yield from send_reply(bot, event, message)
-                        break
+                    if kw == "*":
+                        self.wildcards.add(index)
+                    elif kw.startswith("regex:"):
+                        try:
+                            self.patterns.append((re.compile("(?<!\w)" + kw[6:] + "(?!\w)", re.IGNORECASE), index))
+                        except re.error as e:
+                            logger.warning("invalid autoreply {}: {}".format(kw, e))
+                    elif kw:
+                        self.literals.setdefault(kw.lower(), set()).add(index)
+            else:
+                self.events.setdefault(kwds, set()).add(index)
+
+        self.automaton = KeywordAutomaton(self.literals)
 
-            elif event_type == kwds:
-                logger.info("matched event: {}".format(kwds))
-                yield from send_reply(bot, event, message)
+    def match(self, text, event_type):
+        triggered = set(self.wildcards) | self.events.get(event_type, set())
+
+        text = text or ""
+        text_lower = text.lower()
+        for start, end, kw in self.automaton.find(text_lower):
+            if( (start == 0 or not _word_character.match(text_lower[start - 1]))
+                    and (end == len(text_lower) or not _word_character.match(text_lower[end])) ):
+                triggered.update(self.literals[kw])
+
+        for pattern, index in self.patterns:
+            if index not in triggered and pattern.search(text):
+                triggered.add(index)
+
+        return [ self.autoreplies[index] for index in sorted(triggered) ]
 
 
 @asyncio.coroutine
@@ -168,19 +241,6 @@ def send_reply(bot, event, message):
     return True
 
 
-def _words_in_text(word, text):
-    """Return True if word is in text"""
-
-    if word.startswith("regex:"):
-        word = word[6:]
-    else:
-        word = re.escape(word)
-
-    regexword = "(?<!\w)" + word + "(?!\w)"
-
-    return True if re.search(regexword, text, re.IGNORECASE) else False
-
-
 def autoreply(bot, event, cmd=None, *args):
     """adds or removes an autoreply.
     Format:
@@ -211,6 +271,7 @@ def autoreply(bot, event, cmd=None, *args):
 
     # Reload the config
     bot.config.load()
+    _matchers.clear()
 
     if html == "":
         value = bot.config.get_by_path(path)
@@ -3,6 +3,7 @@ from collections import defaultdict
 
 import hangups
 
+import outbound
 import plugins
 
 from commands import command
@@ -32,14 +33,18 @@ def _batch_add_users(bot, target_conv, chat_ids, batch_max=20):
     for number, partial_list in enumerate(chunks):
         logger.info("batch add users: {}/{} {} user(s) into {}".format(number+1, len(chunks), len(partial_list), target_conv))
 
-        yield from bot._client.add_user(
+        yield from bot.outbound.run(
+            bot._client.add_user,
             hangups.hangouts_pb2.AddUserRequest(
                 request_header = bot._client.get_request_header(),
                 invitee_id = [ hangups.hangouts_pb2.InviteeID(gaia_id = chat_id)
                                for chat_id in partial_list ],
                 event_request_header = hangups.hangouts_pb2.EventRequestHeader(
                     conversation_id = hangups.hangouts_pb2.ConversationId(id = target_conv),
-                    client_generated_id = bot._client.get_client_generated_id() )))
+                    client_generated_id = bot._client.get_client_generated_id() )),
+            conv_id = target_conv,
+            priority = outbound.PRIORITY_BULK,
+            retries = 0 )
 
         users_added = users_added + len(partial_list)
         yield from asyncio.sleep(0.5)
@@ -83,13 +83,16 @@ def _claim_invite(bot, invite_code, user_id):
         try:
             logger.debug("_claim_invite: adding {} to {}".format(user_id, invitation["group_id"]))
 
-            yield from bot._client.add_user(
+            yield from bot.outbound.run(
+                bot._client.add_user,
                 hangups.hangouts_pb2.AddUserRequest(
                     request_header = bot._client.get_request_header(),
                     invitee_id = [ hangups.hangouts_pb2.InviteeID(gaia_id = user_id) ],
                     event_request_header = hangups.hangouts_pb2.EventRequestHeader(
                         conversation_id = hangups.hangouts_pb2.ConversationId(id = invitation["group_id"]),
-                        client_generated_id = bot._client.get_client_generated_id() )))
+                        client_generated_id = bot._client.get_client_generated_id() )),
+                conv_id = invitation["group_id"],
+                retries = 0 )
 
         except hangups.exceptions.NetworkError as e:
             # trying to add a user to a group where the user is already a member raises this
@@ -232,9 +232,11 @@ def reload(bot, event, *args):
 
     yield from bot.coro_send_message(event.conv, "<b>reloading config.json</b>")
     bot.config.load()
+    bot.outbound.configure()
 
     yield from bot.coro_send_message(event.conv, "<b>reloading memory.json</b>")
     bot.memory.load()
+    bot.conversations.invalidate_user_index()
 
 
 def quit(bot, event, *dummys):
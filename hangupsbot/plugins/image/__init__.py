@@ -1,13 +1,16 @@
 import aiohttp
 import asyncio
+import hashlib
 import io
 import logging
 import os
 import re
 import sys
+import time
 
 from asyncio.subprocess import PIPE
 
+import media
 import plugins
 
 
@@ -17,6 +20,18 @@ logger = logging.getLogger(__name__)
 _externals = { "bot": None,
                "ClientSession": aiohttp.ClientSession() }
 
+_cache_defaults = { "ttl": 2592000, # seconds an image id is reused for the same content, 0 disables the cache
+                    "url_ttl": 600, # seconds a url is trusted to still serve the same content, 0: always download
+                    "size": 5000 } # most entries, the oldest are evicted first
+
+_cache_stats = { "hits": 0, # known url, nothing downloaded or uploaded
+                 "content hits": 0, # known content at a new url, downloaded but not uploaded
+                 "misses": 0, # downloaded and uploaded
+                 "shared": 0, # waited for a concurrent request of the same url
+                 "evicted": 0 }
+
+_inflight = {} # image uri: asyncio.Task
+
 
 try:
     aiohttp_clienterror = aiohttp.ClientError
@@ -31,6 +46,19 @@ def _initialise(bot):
     plugins.register_shared('image_upload_single', image_upload_single)
     plugins.register_shared('image_upload_raw', image_upload_raw)
     plugins.register_shared('image_validate_and_upload_single', image_validate_and_upload_single)
+    plugins.register_shared('image_cache_stats', image_cache_stats)
+    plugins.register_admin_command(["imagecache"])
+
+    if not bot.memory.exists(["image_cache"]):
+        bot.memory["image_cache"] = {}
+
+    # url keys are hashed, drop entries that still hold a url in clear text
+    _plain = [ key for key in bot.memory["image_cache"]
+               if key.startswith("url:") and not re.match(r"^url:[0-9a-f]{64}$", key) ]
+    for key in _plain:
+        bot.memory.pop_by_path(["image_cache", key])
+    if _plain:
+        bot.memory.save()
 
 
 def image_validate_link(image_uri, reject_googleusercontent=True):
@@ -86,64 +114,181 @@ def image_validate_link(image_uri, reject_googleusercontent=True):
     return False
 
 
+def _image_handling(downloaded, filename):
+    """image handling logic for specific image types - if necessary, guess by extension
+    returns False if not an image, otherwise "standard" or the name of a custom handler"""
+
+    if downloaded.content_type and downloaded.content_type.startswith('image/'): # the first bytes are a known image format
+        return "standard"
+
+    content_type = downloaded.header_type or ""
+
+    if content_type.startswith('image/'): # If it's identifying itself as an image then just upload it - Google's servers will cope.
+        return "standard"
+
+    elif content_type == "application/octet-stream":
+        ext = filename.split(".")[-1].lower() # Try to guess the type from the extension
+
+        if ext in ("jpg", "jpeg", "jpe", "jif", "jfif", "gif", "png", "webp"): # If we know what the extension is, just upload it.
+            return "standard"
+        else:
+            return "image_convert_to_png" # Only send for processing if the content type doesn't show as image and doesn't match known good extensions.
+
+    return False
+
+
+def _cache_options():
+    options = dict(_cache_defaults)
+    options.update(_externals["bot"].get_config_option("image.cache") or {})
+    return options
+
+
+def _url_key(image_uri):
+    """urls can contain credentials (telegram file links hold the bot api key), only keep a hash"""
+    return "url:" + hashlib.sha256(image_uri.encode("utf-8")).hexdigest()
+
+
+def _cache_get(key):
+    """cached image id for key "url:<sha256 of the uri>" or "sha256:<digest>", None if unknown or expired
+    * url keys expire after url_ttl: the content behind a fixed url can change (webcams, charts),
+      after that the url is downloaded again and usually still hits the content key"""
+    bot = _externals["bot"]
+    options = _cache_options()
+    ttl = options["url_ttl"] if key.startswith("url:") else options["ttl"]
+    if not options["ttl"] or not ttl or not bot.memory.exists(["image_cache", key]):
+        return None
+
+    entry = bot.memory.get_by_path(["image_cache", key])
+    if time.time() - entry["time"] > ttl:
+        bot.memory.pop_by_path(["image_cache", key])
+        bot.memory.save()
+        return None
+
+    return entry["id"]
+
+
+def _cache_set(keys, image_id):
+    bot = _externals["bot"]
+    options = _cache_options()
+    if not options["ttl"] or not image_id:
+        return
+
+    now = time.time()
+    for key in keys:
+        if key.startswith("url:") and not options["url_ttl"]:
+            continue
+        bot.memory.set_by_path(["image_cache", key], { "id": image_id, "time": now })
+
+    cache = bot.memory["image_cache"]
+    if len(cache) > options["size"]:
+        # evict a tenth at once, sorting the cache on every upload is wasteful
+        excess = len(cache) - options["size"] + options["size"] // 10
+        for key in sorted(cache, key=lambda key: cache[key]["time"])[:excess]:
+            bot.memory.pop_by_path(["image_cache", key])
+        _cache_stats["evicted"] = _cache_stats["evicted"] + excess
+
+    bot.memory.save()
+
+
+def image_cache_stats():
+    """hit/miss counters and size of the image id cache"""
+    return dict(_cache_stats, entries=len(_externals["bot"].memory["image_cache"]))
+
+
+def imagecache(bot, event, *args):
+    """show the counters of the image upload cache, /bot imagecache clear empties it"""
+    if args and args[0] == "clear":
+        bot.memory["image_cache"] = {}
+        bot.memory.save()
+
+    stats = image_cache_stats()
+    yield from bot.coro_send_message(event.conv, _(
+        "<b>image cache:</b> {} entries\n"
+        "{} hits, {} content hits, {} misses, {} shared, {} evicted").format(
+            stats["entries"], stats["hits"], stats["content hits"],
+            stats["misses"], stats["shared"], stats["evicted"] ))
+
+
 @asyncio.coroutine
 def image_upload_single(image_uri):
+    """upload the image at image_uri, returns the image id or False
+    * a url or content that was uploaded before reuses the image id
+    * concurrent requests for the same url share one download and upload"""
+    image_id = _cache_get(_url_key(image_uri))
+    if image_id:
+        _cache_stats["hits"] = _cache_stats["hits"] + 1
+        return image_id
+
+    task = _inflight.get(image_uri)
+    if task is not None:
+        _cache_stats["shared"] = _cache_stats["shared"] + 1
+        return (yield from asyncio.shield(task))
+
+    task = _inflight[image_uri] = asyncio.ensure_future(_image_upload_single(image_uri))
+    task.add_done_callback(lambda task: _inflight.pop(image_uri, None))
+    return (yield from asyncio.shield(task))
+
+
+@asyncio.coroutine
+def _image_upload_single(image_uri):
     filename = os.path.basename(image_uri)
     logger.info("fetching {}".format(filename))
     try:
-        r = yield from _externals["ClientSession"].get(image_uri)
-        content_type = r.headers['Content-Type']
-
-        image_handling = False # must == True if valid image, can contain additonal directives
-
-        """image handling logic for specific image types - if necessary, guess by extension"""
-
-        if content_type.startswith('image/'): # If it's identifying itself as an image then just upload it - Google's servers will cope.
-            image_handling = "standard"
-
-        elif content_type == "application/octet-stream":
-            ext = filename.split(".")[-1].lower() # Try to guess the type from the extension
-
-            if ext in ("jpg", "jpeg", "jpe", "jif", "jfif", "gif", "png", "webp"): # If we know what the extension is, just upload it.
-                image_handling = "standard"
-            else:
-                image_handling = "image_convert_to_png" # Only send for processing if the content type doesn't show as image and doesn't match known good extensions.
-
-        if image_handling:
-            logger.debug("reading {}".format(image_uri))
-            raw = yield from r.read()
-            logger.debug("finished {}".format(image_uri))
-            if image_handling is not "standard":
-                try:
-                    results = yield from getattr(sys.modules[__name__], image_handling)(raw)
-                    if results:
-                        # allow custom handlers to fail gracefully
-                        raw = results
-                except Exception as e:
-                    logger.exception("custom image handler failed: {}".format(image_handling))
-        else:
-            logger.warning("not image/image-like, filename={}, headers={}".format(filename, r.headers))
+        """streamed into a spooled file, non-images are dropped once the first bytes are sniffed"""
+        downloaded = yield from media.download( _externals["bot"],
+                                                image_uri,
+                                                _externals["ClientSession"],
+                                                accept = lambda downloaded: _image_handling(downloaded, filename) )
+        if not downloaded:
+            logger.warning("not image/image-like, filename={}".format(filename))
             return False
 
-    except (aiohttp_clienterror) as exc:
+    except (aiohttp_clienterror, media.MediaTooLarge) as exc:
         logger.warning("failed to get {} - {}".format(filename, exc))
         return False
 
-    image_data = io.BytesIO(raw)
-    image_id = yield from image_upload_raw(image_data, filename=filename)
-    return image_id
+    with downloaded:
+        logger.debug("finished {}, {} bytes".format(image_uri, downloaded.size))
+
+        content_key = "sha256:" + downloaded.sha256.hexdigest()
+        image_id = _cache_get(content_key)
+        if image_id:
+            _cache_stats["content hits"] = _cache_stats["content hits"] + 1
+            _cache_set([_url_key(image_uri)], image_id)
+            return image_id
+
+        _cache_stats["misses"] = _cache_stats["misses"] + 1
+        image_data = downloaded.file
+        image_data.seek(0)
+
+        image_handling = _image_handling(downloaded, filename)
+        if image_handling != "standard":
+            try:
+                results = yield from getattr(sys.modules[__name__], image_handling)(downloaded.read())
+                if results:
+                    # allow custom handlers to fail gracefully
+                    image_data = io.BytesIO(results)
+                else:
+                    image_data.seek(0)
+            except Exception as e:
+                logger.exception("custom image handler failed: {}".format(image_handling))
+                image_data.seek(0)
+
+        image_id = yield from image_upload_raw(image_data, filename=filename)
+        _cache_set([_url_key(image_uri), content_key], image_id)
+        return image_id
 
 
 @asyncio.coroutine
 def image_upload_raw(image_data, filename):
     image_id = False
     try:
-        image_id = yield from _externals["bot"]._client.upload_image(image_data, filename=filename)
+        image_id = yield from _externals["bot"].coro_upload_image(image_data, filename=filename)
     except Exception:
         image_data.seek(0)
         try:
             filename = "{}.gif".format(filename)
-            image_id = yield from _externals["bot"]._client.upload_image(image_data, filename=filename)
+            image_id = yield from _externals["bot"].coro_upload_image(image_data, filename=filename)
         except Exception as exc:
             logger.warning("_client.upload_image failed", exc_info=exc)
     return image_id
@@ -10,7 +10,7 @@ logger = logging.getLogger(__name__)
 
 
 def _initialise(bot):
-    plugins.register_handler(_watch_image_link, type="message")
+    plugins.register_handler(_watch_image_link, type="message", concurrent=True)
 
 
 @asyncio.coroutine
@@ -184,7 +184,17 @@ def mention(bot, event, *args):
     exact_nickname_matches = []
     exact_fragment_matches = []
     mention_list = []
+
+    """narrow down with the user name index, users missing from the index are always checked"""
+    candidates = None
+    if username_lower != "all":
+        candidates = bot.conversations.find_users(username)
+
     for u in users_in_chat:
+        if( candidates is not None
+                and u.id_.chat_id not in candidates
+                and bot.conversations.is_user_indexed(u.id_.chat_id) ):
+            continue
 
         # mentions also checks nicknames if one is configured
         #  exact matches only! see following IF block
@@ -493,6 +503,8 @@ def setnickname(bot, event, *args):
 
     bot.memory.save()
 
+    bot.conversations.reindex_user(event.user.id_.chat_id)
+
     if(nickname == ''):
         yield from bot.coro_send_message(event.conv, _("Removing nickname"))
     else:
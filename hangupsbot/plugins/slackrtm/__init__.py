@@ -57,31 +57,44 @@ from .commands_hangouts import ( slacks,
                                  slack_showslackrealnames,
                                  slack_showhorealnames,
                                  slack_identify )
-from .core import SlackRTMThread
+from .client import close_session
+from .core import SlackRTMRunner
 from .utils import _slackrtms
 
 
 logger = logging.getLogger(__name__)
 
 
+_runner_tasks = []
+
+
+@asyncio.coroutine
+def _finalise(bot):
+    # stop the runners first, they would open a new session to reconnect
+    for task in _runner_tasks:
+        task.cancel()
+    if _runner_tasks:
+        yield from asyncio.wait(_runner_tasks)
+    del _runner_tasks[:]
+    yield from close_session()
+
+
 def _initialise(bot):
     # unbreak slackrtm memory.json usage
     #   previously, this plugin wrote into "user_data" key to store its internal team settings
     _slackrtm_conversations_migrate_20170319(bot)
 
-    # Start and asyncio event loop
+    # one rtm connection per team, all on the bot event loop
     loop = asyncio.get_event_loop()
     slack_sink = bot.get_config_option('slackrtm')
-    threads = []
+    runners = []
     if isinstance(slack_sink, list):
         for sinkConfig in slack_sink:
-            # start up slack listener in a separate thread
-            t = SlackRTMThread(bot, loop, sinkConfig)
-            t.daemon = True
-            t.start()
-            t.isFullyLoaded.wait()
-            threads.append(t)
-    logger.info("%d sink thread(s) started", len(threads))
+            # tracked task: cancelled when the plugin is unloaded
+            runner = SlackRTMRunner(bot, loop, sinkConfig)
+            _runner_tasks.append(plugins.start_asyncio_task(runner.run()))
+            runners.append(runner)
+    logger.info("%d sink connection(s) started", len(runners))
 
     plugins.register_handler(_handle_membership_change, type="membership")
     plugins.register_handler(_handle_rename, type="rename")
@@ -68,7 +68,7 @@ class BridgeInstance(WebFramework):
         channel_id = config["config.json"]["slackrtm"][0]
         team_name = config["config.json"]["name"]
 
-        """slackrtm uses one thread per team, identify slackclient to handle the hangouts message.
+        """slackrtm uses one connection per team, identify slackclient to handle the hangouts message.
         since the config is further separated by hangouts conv_id for relay, we also supply extra info
             to the handler, so it can decide for itself whether/where the message should be forwarded"""
 
@@ -76,7 +76,7 @@ class BridgeInstance(WebFramework):
 
         for slackrtm in _slackrtms:
             try:
-                # identify the correct thread, then send the message
+                # identify the correct team, then send the message
                 if slackrtm.name == team_name:
                     yield from slackrtm.handle_ho_message(event, conv_id, channel_id)
             except Exception as e:
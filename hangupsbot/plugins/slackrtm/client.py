@@ -0,0 +1,107 @@
+"""asyncio transport for the slack web and rtm apis, runs on the bot event loop"""
+
+import aiohttp
+import asyncio
+import json
+import logging
+
+from .exceptions import ( ConnectionFailedError,
+                          IncompleteLoginError )
+
+
+logger = logging.getLogger(__name__)
+
+
+_api_url = "https://slack.com/api/{}"
+
+_session = None # shared by all teams, http requests and websockets use one connection pool
+
+
+def get_session():
+    global _session
+    if _session is None or _session.closed:
+        _session = aiohttp.ClientSession()
+    return _session
+
+
+@asyncio.coroutine
+def close_session():
+    """close the shared session, when the plugin is unloaded"""
+    global _session
+    if _session is not None and not _session.closed:
+        yield from _session.close()
+    _session = None
+
+
+def _form_value(value):
+    """slack expects form values, not python literals"""
+    if isinstance(value, bool):
+        return "true" if value else "false"
+    if isinstance(value, (dict, list)):
+        return json.dumps(value)
+    return str(value)
+
+
+class SlackClient(object):
+    def __init__(self, token):
+        self.token = token
+        self.login_data = None
+        self.websocket = None
+
+    @asyncio.coroutine
+    def api_call(self, method, **kwargs):
+        """call a web api method, returns the parsed response
+        * failures are reported by slack with "ok": false, as the old slackclient did"""
+        data = { key: _form_value(value) for key, value in kwargs.items() if value is not None }
+        data["token"] = self.token
+
+        response = yield from get_session().post(_api_url.format(method), data=data)
+        try:
+            result = yield from response.json()
+        finally:
+            response.release()
+
+        if not result.get("ok"):
+            logger.warning("{} failed: {}".format(method, result.get("error")))
+
+        return result
+
+    @asyncio.coroutine
+    def rtm_connect(self):
+        """rtm.connect only returns the websocket url, the team and the bot user, users and
+        channels come from .directory.SlackDirectory instead of being downloaded on every connect"""
+        response = yield from self.api_call("rtm.connect")
+        if not response.get("ok"):
+            raise ConnectionFailedError(response.get("error"))
+
+        for key in ['self', 'team', 'url']:
+            if key not in response:
+                raise IncompleteLoginError
+
+        self.login_data = response
+
+        # aiohttp answers pings and sends its own, no need to poll for them
+        self.websocket = yield from get_session().ws_connect(response["url"], heartbeat=30.0)
+
+    @asyncio.coroutine
+    def rtm_read(self):
+        """wait for the next rtm event"""
+        while True:
+            message = yield from self.websocket.receive()
+
+            if message.type == aiohttp.WSMsgType.TEXT:
+                return json.loads(message.data)
+
+            if message.type in ( aiohttp.WSMsgType.CLOSE,
+                                 aiohttp.WSMsgType.CLOSING,
+                                 aiohttp.WSMsgType.CLOSED ):
+                raise ConnectionResetError("websocket closed: {}".format(message.extra))
+
+            if message.type == aiohttp.WSMsgType.ERROR:
+                raise ConnectionResetError("websocket error: {}".format(self.websocket.exception()))
+
+    @asyncio.coroutine
+    def close(self):
+        if self.websocket is not None:
+            yield from self.websocket.close()
+            self.websocket = None
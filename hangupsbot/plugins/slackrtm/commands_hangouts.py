@@ -83,14 +83,14 @@ def slack_channels(bot, event, *args):
 
     lines = ["**Channels:**"]
 
-    slackrtm.update_channelinfos()
+    yield from slackrtm.refresh_channelinfos()
     for cid in slackrtm.channelinfos:
         if not slackrtm.channelinfos[cid]['is_archived']:
             lines.append("* {1} {0}".format(slackrtm.channelinfos[cid]['name'], cid))
 
     lines.append("**Private groups:**")
 
-    slackrtm.update_groupinfos()
+    yield from slackrtm.refresh_groupinfos()
     for gid in slackrtm.groupinfos:
         if not slackrtm.groupinfos[gid]['is_archived']:
             lines.append("* {1} {0}".format(slackrtm.groupinfos[gid]['name'], gid))
@@ -121,7 +121,8 @@ def slack_users(bot, event, *args):
         yield from bot.coro_send_message(event.conv_id, "there is no slack team with name **{}**, use _/bot slacks_ to list all teams".format(slackname))
         return
 
-    slackrtm.update_channelinfos()
+    yield from slackrtm.refresh_channelinfos()
+    yield from slackrtm.refresh_groupinfos()
     channelid = args[1]
     channelname = slackrtm.get_channelgroupname(channelid)
     if not channelname:
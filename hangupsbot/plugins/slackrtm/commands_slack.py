@@ -1,3 +1,4 @@
+import asyncio
 import logging
 import re
 import sys
@@ -10,6 +11,7 @@ from .utils import _slackrtm_link_profiles
 logger = logging.getLogger(__name__)
 
 
+@asyncio.coroutine
 def slackCommandHandler(slackbot, msg):
     tokens = msg.text.strip().split()
     if not msg.user:
@@ -23,10 +25,10 @@ def slackCommandHandler(slackbot, msg):
         command = tokens.pop(0).lower()
         args = tokens
         if command in commands_user:
-            return getattr(sys.modules[__name__], command)(slackbot, msg, args)
+            return (yield from _run_command(command, slackbot, msg, args))
         elif command in commands_admin:
             if msg.user in slackbot.admins:
-                return getattr(sys.modules[__name__], command)(slackbot, msg, args)
+                return (yield from _run_command(command, slackbot, msg, args))
             else:
                 slackbot.api_call(
                     'chat.postMessage',
@@ -42,6 +44,13 @@ def slackCommandHandler(slackbot, msg):
                 as_user = True,
                 link_names = True )
 
+@asyncio.coroutine
+def _run_command(command, slackbot, msg, args):
+    result = getattr(sys.modules[__name__], command)(slackbot, msg, args)
+    if asyncio.iscoroutine(result):
+        result = yield from result
+    return result
+
 """
 command definitions
 
@@ -68,6 +77,7 @@ commands_admin = [ "hangouts",
                    "showslackrealnames",
                    "showhorealnames" ]
 
+@asyncio.coroutine
 def help(slackbot, msg, args):
     """list help for all available commands"""
     lines = ["*user commands:*\n"]
@@ -86,7 +96,7 @@ def help(slackbot, msg, args):
 
     slackbot.api_call(
         'chat.postMessage',
-        channel = slackbot.get_slackDM(msg.user),
+        channel = (yield from slackbot.get_slackDM(msg.user)),
         text = "\n".join(lines),
         as_user = True,
         link_names = True )
@@ -101,10 +111,11 @@ def whereami(slackbot, msg, args):
         as_user=True,
         link_names=True )
 
+@asyncio.coroutine
 def whoami(slackbot, msg, args):
     """tells you your own user id"""
 
-    userID = slackbot.get_slackDM(msg.user)
+    userID = yield from slackbot.get_slackDM(msg.user)
     slackbot.api_call(
         'chat.postMessage',
         channel=userID,
@@ -112,6 +123,7 @@ def whoami(slackbot, msg, args):
         as_user=True,
         link_names=True )
 
+@asyncio.coroutine
 def whois(slackbot, msg, args):
     """whois @username tells you the user id of @username"""
 
@@ -134,7 +146,7 @@ def whois(slackbot, msg, args):
         else:
             message = u'@%s: the user id of _%s_ is %s' % (msg.username, slackbot.get_username(user), user)
 
-    userID = slackbot.get_slackDM(msg.user)
+    userID = yield from slackbot.get_slackDM(msg.user)
     slackbot.api_call(
         'chat.postMessage',
         channel=userID,
@@ -142,13 +154,14 @@ def whois(slackbot, msg, args):
         as_user=True,
         link_names=True )
 
+@asyncio.coroutine
 def admins(slackbot, msg, args):
     """lists the slack users with admin privileges"""
 
     message = '@%s: my admins are:\n' % msg.username
     for a in slackbot.admins:
         message += '@%s: _%s_\n' % (slackbot.get_username(a), a)
-    userID = slackbot.get_slackDM(msg.user)
+    userID = yield from slackbot.get_slackDM(msg.user)
     slackbot.api_call(
         'chat.postMessage',
         channel=userID,
@@ -156,6 +169,7 @@ def admins(slackbot, msg, args):
         as_user=True,
         link_names=True )
 
+@asyncio.coroutine
 def hangoutmembers(slackbot, msg, args):
     """lists the users of the hangouts synced to this channel"""
 
@@ -171,7 +185,7 @@ def hangoutmembers(slackbot, msg, args):
         message += '%s aka %s (%s):\n' % (hangoutname, sync.hotag if sync.hotag else 'untagged', sync.hangoutid)
         for u in conv.users:
             message += ' + <https://plus.google.com/%s|%s>\n' % (u.id_.gaia_id, u.full_name)
-    userID = slackbot.get_slackDM(msg.user)
+    userID = yield from slackbot.get_slackDM(msg.user)
     slackbot.api_call(
         'chat.postMessage',
         channel=userID,
@@ -223,13 +237,14 @@ def identify(slackbot, msg, args):
         as_user = True,
         link_names = True )
 
+@asyncio.coroutine
 def hangouts(slackbot, msg, args):
     """admin-only: lists all connected hangouts, suggested: use only in direct message"""
 
     message = '@%s: list of active hangouts:\n' % msg.username
     for c in slackbot.bot.list_conversations():
         message += '*%s:* _%s_\n' % (slackbot.bot.conversations.get_name(c, truncate=True), c.id_)
-    userID = slackbot.get_slackDM(msg.user)
+    userID = yield from slackbot.get_slackDM(msg.user)
     slackbot.api_call(
         'chat.postMessage',
         channel=userID,
@@ -237,6 +252,7 @@ def hangouts(slackbot, msg, args):
         as_user=True,
         link_names=True)
 
+@asyncio.coroutine
 def listsyncs(slackbot, msg, args):
     """admin-only: lists all runnging sync connections, suggested: use only in direct message"""
 
@@ -254,7 +270,7 @@ def listsyncs(slackbot, msg, args):
             sync.hangoutid,
             sync.getPrintableOptions()
             )
-    userID = slackbot.get_slackDM(msg.user)
+    userID = yield from slackbot.get_slackDM(msg.user)
     slackbot.api_call(
         'chat.postMessage',
         channel=userID,
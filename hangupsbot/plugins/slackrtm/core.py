@@ -1,25 +1,23 @@
 import asyncio
-import json
 import html
 import logging
-import mimetypes
 import os
 import pprint
+import random
 import re
-import threading
 import time
-import urllib.request
-import hangups
+import aiohttp
 import emoji
 
 import hangups_shim as hangups
-
-from slackclient import SlackClient
-from websocket import WebSocketConnectionClosedException
+import media
 
 from .bridgeinstance import ( BridgeInstance,
                               FakeEvent )
+from .client import ( SlackClient,
+                      get_session )
 from .commands_slack import slackCommandHandler
+from .directory import SlackDirectory
 from .exceptions import ( AlreadySyncingError,
                           ConnectionFailedError,
                           NotSyncingError,
@@ -39,6 +37,10 @@ logger = logging.getLogger(__name__)
 emoji.EMOJI_UNICODE[':simple_smile:'] = emoji.EMOJI_UNICODE[':smiling_face:']
 emoji.EMOJI_ALIAS_UNICODE[':simple_smile:'] = emoji.EMOJI_UNICODE[':smiling_face:']
 
+# references to users and channels in slack message text, see SlackRTM.matchReference()
+_user_reference = re.compile(r'<@([UW][A-Z0-9]+)')
+_channel_reference = re.compile(r'<#([CG][A-Z0-9]+)')
+
 
 class SlackMessage(object):
     def __init__(self, slackrtm, reply):
@@ -266,48 +268,36 @@ class SlackRTMSync(object):
 
 
 class SlackRTM(object):
-    def __init__(self, sink_config, bot, loop, threaded=False):
+    def __init__(self, sink_config, bot, loop, slack, directory):
+        """slack: connected .client.SlackClient, directory: .directory.SlackDirectory of the team"""
         self.bot = bot
         self.loop = loop
         self.config = sink_config
         self.apikey = self.config['key']
-        self.threadname = None
         self.lastimg = ''
 
-        self.slack = SlackClient(self.apikey)
-        if not self.slack.rtm_connect():
-            raise ConnectionFailedError
-        for key in ['self', 'team', 'users', 'channels', 'groups']:
-            if key not in self.slack.server.login_data:
-                raise IncompleteLoginError
-        if threaded:
-            if 'name' in self.config:
-                self.name = self.config['name']
-            else:
-                self.name = '%s@%s' % (self.slack.server.login_data['self']['name'], self.slack.server.login_data['team']['domain'])
-                logger.warning('no name set in config file, using computed name %s', self.name)
-            self.threadname = 'SlackRTM:' + self.name
-            threading.current_thread().name = self.threadname
-            logger.info('started RTM connection for SlackRTM thread %s', pprint.pformat(threading.current_thread()))
-            for t in threading.enumerate():
-                if t.name == self.threadname and t != threading.current_thread():
-                    logger.info('old thread found: %s - killing it', pprint.pformat(t))
-                    t.stop()
-
-        self.update_userinfos(self.slack.server.login_data['users'])
-        self.update_channelinfos(self.slack.server.login_data['channels'])
-        self.update_groupinfos(self.slack.server.login_data['groups'])
-        self.update_teaminfos(self.slack.server.login_data['team'])
-        self.dminfos = {}
-        self.my_uid = self.slack.server.login_data['self']['id']
-
-        self.admins = []
-        if 'admins' in self.config:
-            for a in self.config['admins']:
-                if a not in self.userinfos:
-                    logger.warning('userid %s not found in user list, ignoring', a)
-                else:
-                    self.admins.append(a)
+        self.slack = slack
+        login_data = self.slack.login_data
+        if 'name' in self.config:
+            self.name = self.config['name']
+        else:
+            self.name = '%s@%s' % (login_data['self']['name'], login_data['team']['domain'])
+            logger.warning('no name set in config file, using computed name %s', self.name)
+        logger.info('started RTM connection for SlackRTM %s', self.name)
+
+        # web api calls are sent in order by a single worker, callers never wait for them
+        self._api_calls = asyncio.Queue()
+        self._api_worker = asyncio.ensure_future(self._run_api_calls())
+
+        # users and channels survive reconnects and restarts, only stale lists are reloaded
+        self.directory = directory
+        self.directory.slack = slack
+        self.directory.team.update(login_data['team'])
+        self.directory.refresh_stale()
+        self.my_uid = login_data['self']['id']
+
+        # the directory may still be loading, admins are not checked against it
+        self.admins = list(self.config.get('admins', []))
         if not len(self.admins):
             logger.warning('no admins specified in config file')
 
@@ -345,48 +335,77 @@ class SlackRTM(object):
                 _new_sync.team_name = self.name # chatbridge needs this for context
                 self.syncs.append(_new_sync)
 
-    # As of https://github.com/slackhq/python-slackclient/commit/ac343caf6a3fd8f4b16a79246264a05a7d257760
-    # SlackClient.api_call returns a pre-parsed json object (a dict).
-    # Wrap this call in a compatibility duck-hunt.
-    def api_call(self, *args, **kwargs):
-        response = self.slack.api_call(*args, **kwargs)
-        if isinstance(response, str):
+    def api_call(self, method, **kwargs):
+        """queue a web api call without blocking, returns an asyncio.Future of the response
+        * use yield from self.slack.api_call() if the response is needed right away"""
+        future = asyncio.Future()
+        self._api_calls.put_nowait((method, kwargs, future))
+        return future
+
+    @asyncio.coroutine
+    def _run_api_calls(self):
+        while True:
+            method, kwargs, future = yield from self._api_calls.get()
             try:
-                response = response.decode('utf-8')
-            except:
-                pass
-            response = json.loads(response)
+                response = yield from self.slack.api_call(method, **kwargs)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.exception('%s: api call %s failed', self.name, method)
+                # same shape as a failure reported by slack, most callers never look at it
+                if not future.cancelled():
+                    future.set_result({ "ok": False, "error": str(e) })
+            else:
+                if not future.cancelled():
+                    future.set_result(response)
+
+    @property
+    def userinfos(self):
+        return self.directory.users
+
+    @property
+    def channelinfos(self):
+        return self.directory.channels
+
+    @property
+    def groupinfos(self):
+        return self.directory.groups
 
-        return response
+    @property
+    def team(self):
+        return self.directory.team
 
+    @property
+    def dminfos(self):
+        return self.directory.dms
+
+    @asyncio.coroutine
     def get_slackDM(self, userid):
-        if not userid in self.dminfos:
-            self.dminfos[userid] = self.api_call('im.open', user = userid)['channel']
-        return self.dminfos[userid]['id']
+        return (yield from self.directory.get_dm(userid))
+
+    @asyncio.coroutine
+    def refresh_userinfos(self):
+        yield from self.directory.refresh('users')
 
     def update_userinfos(self, users=None):
         if users is None:
-            response = self.api_call('users.list')
-            users = response['members']
-        userinfos = {}
-        for u in users:
-            userinfos[u['id']] = u
-        self.userinfos = userinfos
+            # never block the event loop, reload in the background
+            self.directory.refresh('users')
+            return
+        self.directory.replace('users', users)
 
     def get_channel_users(self, channelid, default=None):
         channelinfo = None
         if channelid.startswith('C'):
             if not channelid in self.channelinfos:
-                self.update_channelinfos()
-            if not channelid in self.channelinfos:
+                self.directory.lookup('channels', channelid)
                 logger.error('get_channel_users: Failed to find channel %s' % channelid)
                 return None
             else:
                 channelinfo = self.channelinfos[channelid]
         else:
             if not channelid in self.groupinfos:
-                self.update_groupinfos()
-            if not channelid in self.groupinfos:
+                self.directory.lookup('groups', channelid)
                 logger.error('get_channel_users: Failed to find private group %s' % channelid)
                 return None
             else:
@@ -402,27 +421,31 @@ class SlackRTM(object):
 
         return users
 
+    @asyncio.coroutine
+    def refresh_teaminfos(self):
+        response = yield from self.slack.api_call('team.info')
+        if response.get('ok'):
+            self.update_teaminfos(response['team'])
+
     def update_teaminfos(self, team=None):
         if team is None:
-            response = self.api_call('team.info')
-            team = response['team']
-        self.team = team
+            asyncio.ensure_future(self.refresh_teaminfos())
+            return
+        self.directory.team.update(team)
 
     def get_teamname(self):
-        # team info is static, no need to update
+        # kept current by team_rename events
         return self.team['name']
 
     def get_slack_domain(self):
-        # team info is static, no need to update
+        # kept current by team_domain_change events
         return self.team['domain']
 
     def get_realname(self, user, default=None):
         if user not in self.userinfos:
-            logger.debug('user not found, reloading users')
-            self.update_userinfos()
-            if user not in self.userinfos:
-                logger.warning('could not find user "%s" although reloaded', user)
-                return default
+            logger.warning('could not find user "%s", looking it up', user)
+            self.directory.lookup('users', user)
+            return default
         if not self.userinfos[user]['real_name']:
             return default
         return self.userinfos[user]['real_name']
@@ -430,21 +453,20 @@ class SlackRTM(object):
 
     def get_username(self, user, default=None):
         if user not in self.userinfos:
-            logger.debug('user not found, reloading users')
-            self.update_userinfos()
-            if user not in self.userinfos:
-                logger.warning('could not find user "%s" although reloaded', user)
-                return default
+            logger.warning('could not find user "%s", looking it up', user)
+            self.directory.lookup('users', user)
+            return default
         return self.userinfos[user]['name']
 
+    @asyncio.coroutine
+    def refresh_channelinfos(self):
+        yield from self.directory.refresh('channels')
+
     def update_channelinfos(self, channels=None):
         if channels is None:
-            response = self.api_call('channels.list')
-            channels = response['channels']
-        channelinfos = {}
-        for c in channels:
-            channelinfos[c['id']] = c
-        self.channelinfos = channelinfos
+            self.directory.refresh('channels')
+            return
+        self.directory.replace('channels', channels)
 
     def get_channelgroupname(self, channel, default=None):
         if channel.startswith('C'):
@@ -457,29 +479,26 @@ class SlackRTM(object):
 
     def get_channelname(self, channel, default=None):
         if channel not in self.channelinfos:
-            logger.debug('channel not found, reloading channels')
-            self.update_channelinfos()
-            if channel not in self.channelinfos:
-                logger.warning('could not find channel "%s" although reloaded', channel)
-                return default
+            logger.warning('could not find channel "%s", looking it up', channel)
+            self.directory.lookup('channels', channel)
+            return default
         return self.channelinfos[channel]['name']
 
+    @asyncio.coroutine
+    def refresh_groupinfos(self):
+        yield from self.directory.refresh('groups')
+
     def update_groupinfos(self, groups=None):
         if groups is None:
-            response = self.api_call('groups.list')
-            groups = response['groups']
-        groupinfos = {}
-        for c in groups:
-            groupinfos[c['id']] = c
-        self.groupinfos = groupinfos
+            self.directory.refresh('groups')
+            return
+        self.directory.replace('groups', groups)
 
     def get_groupname(self, group, default=None):
         if group not in self.groupinfos:
-            logger.debug('group not found, reloading groups')
-            self.update_groupinfos()
-            if group not in self.groupinfos:
-                logger.warning('could not find group "%s" although reloaded', group)
-                return default
+            logger.warning('could not find group "%s", looking it up', group)
+            self.directory.lookup('groups', group)
+            return default
         return self.groupinfos[group]['name']
 
     def get_syncs(self, channelid=None, hangoutid=None):
@@ -491,11 +510,26 @@ class SlackRTM(object):
                 syncs.append(sync)
         return syncs
 
-    def rtm_read(self):
-        return self.slack.rtm_read()
-
-    def ping(self):
-        return self.slack.server.ping()
+    @asyncio.coroutine
+    def _prefetch(self, reply):
+        """look up users and channels that reply refers to but are unknown yet, parsing the reply
+        and its references only reads the cached directory"""
+        message = reply.get('message') or {}
+        users = set(_user_reference.findall(reply.get('text') or ''))
+        users.update([ reply.get('user'),
+                       (message.get('edited') or {}).get('user'),
+                       (reply.get('comment') or {}).get('user') ])
+        channels = set(_channel_reference.findall(reply.get('text') or ''))
+        channels.update([ reply.get('channel'), reply.get('group') ])
+
+        lookups = [ self.directory.lookup('users', user)
+                    for user in users if user and user not in self.userinfos ]
+        lookups.extend([ self.directory.lookup('channels', channel)
+                         for channel in channels if channel and channel.startswith('C') and channel not in self.channelinfos ])
+        lookups.extend([ self.directory.lookup('groups', channel)
+                         for channel in channels if channel and channel.startswith('G') and channel not in self.groupinfos ])
+        if lookups:
+            yield from asyncio.wait(lookups)
 
     def matchReference(self, match):
         out = ""
@@ -528,25 +562,30 @@ class SlackRTM(object):
         token = self.apikey
         logger.info('downloading %s', image_uri)
         filename = os.path.basename(image_uri)
-        request = urllib.request.Request(image_uri)
-        request.add_header("Authorization", "Bearer %s" % token)
-        image_response = urllib.request.urlopen(request)
-        content_type = image_response.info().get_content_type()
-
-        filename_extension = mimetypes.guess_extension(content_type).lower() # returns with "."
-        physical_extension = "." + filename.rsplit(".", 1).pop().lower()
-
-        if physical_extension == filename_extension:
-            pass
-        elif filename_extension == ".jpe" and physical_extension in [ ".jpg", ".jpeg", ".jpe", ".jif", ".jfif" ]:
-            # account for mimetypes idiosyncrancy to return jpe for valid jpeg
-            pass
-        else:
-            logger.warning("unable to determine extension: {} {}".format(filename_extension, physical_extension))
-            filename += filename_extension
+        try:
+            downloaded = yield from media.download( self.bot,
+                                                    image_uri,
+                                                    get_session(),
+                                                    headers = { "Authorization": "Bearer %s" % token } )
+        except (aiohttp.ClientError, media.MediaTooLarge) as e:
+            logger.warning('failed to download %s: %s', image_uri, str(e))
+            return
+
+        with downloaded:
+            filename_extension = media.guess_extension(downloaded.type).lower() # returns with "."
+            physical_extension = "." + filename.rsplit(".", 1).pop().lower()
+
+            if physical_extension == filename_extension:
+                pass
+            elif filename_extension == ".jpg" and physical_extension in [ ".jpg", ".jpeg", ".jpe", ".jif", ".jfif" ]:
+                # account for the many extensions of a valid jpeg
+                pass
+            else:
+                logger.warning("unable to determine extension: {} {}".format(filename_extension, physical_extension))
+                filename += filename_extension
 
-        logger.info('uploading as %s', filename)
-        image_id = yield from self.bot._client.upload_image(image_response, filename=filename)
+            logger.info('uploading as %s', filename)
+            image_id = yield from downloaded.upload(self.bot, filename)
 
         logger.info('sending HO message, image_id: %s', image_id)
         yield from sync._bridgeinstance._send_to_internal_chat(
@@ -728,9 +767,16 @@ class SlackRTM(object):
         _slackrtm_conversations_set(self.bot, self.name, syncs)
         return
 
+    @asyncio.coroutine
     def handle_reply(self, reply):
         """handle incoming replies from slack"""
 
+        if self.directory.apply_event(reply):
+            return
+
+        self.directory.refresh_stale()
+        yield from self._prefetch(reply)
+
         try:
             msg = SlackMessage(self, reply)
         except ParseError as e:
@@ -741,7 +787,7 @@ class SlackRTM(object):
 
         # commands can be processed even from unsynced channels
         try:
-            slackCommandHandler(self, msg)
+            yield from slackCommandHandler(self, msg)
         except Exception as e:
             logger.exception('error in handleCommands: %s(%s)', type(e), str(e))
 
@@ -765,8 +811,7 @@ class SlackRTM(object):
                 if msg.file_attachment:
                     if sync.image_upload:
 
-                        self.loop.call_soon_threadsafe(
-                            asyncio.ensure_future,
+                        asyncio.ensure_future(
                             self.upload_image(
                                 msg.file_attachment,
                                 sync,
@@ -779,16 +824,18 @@ class SlackRTM(object):
                         # we should not upload the images, so we have to send the url instead
                         response += msg.file_attachment
 
-                self.loop.call_soon_threadsafe(
-                    asyncio.ensure_future,
-                    sync._bridgeinstance._send_to_internal_chat(
+                # relayed in order: the runner handles the next reply once this one is delivered
+                try:
+                    yield from sync._bridgeinstance._send_to_internal_chat(
                         sync.hangoutid,
                         message,
                         {   "sync": sync,
                             "source_user": username,
                             "source_uid": msg.user,
                             "source_gid": sync.channelid,
-                            "source_title": channel_name }))
+                            "source_title": channel_name })
+                except Exception as e:
+                    logger.exception('error relaying to %s: %s', sync.hangoutid, str(e))
 
     @asyncio.coroutine
     def _send_deferred_media(self, image_link, sync, full_name, link_names, photo_url, fragment):
@@ -954,39 +1001,70 @@ class SlackRTM(object):
 
     def close(self):
         logger.debug("closing all bridge instances")
+        self._api_worker.cancel()
         for s in self.syncs:
             s._bridgeinstance.close()
 
 
-class SlackRTMThread(threading.Thread):
+class SlackRTMRunner(object):
+    """keeps the rtm connection of a slack team alive on the bot event loop:
+    events are pushed by the websocket, a lost connection is re-established with
+    exponential backoff
+
+    the reader only reads: replies are handled in order by a worker, a slow relay into
+    hangouts (throttling, retries) must not stop the websocket from answering pings"""
     def __init__(self, bot, loop, config):
-        super(SlackRTMThread, self).__init__()
-        self._stop = threading.Event()
         self._bot = bot
         self._loop = loop
         self._config = config
         self._listener = None
-        self.isFullyLoaded = threading.Event()
+        self._directory = None
+        self._replies = asyncio.Queue() # survives reconnects, nothing read is dropped
 
+    def _replace_listener(self, listener):
+        if self._listener and self._listener in _slackrtms:
+            self._listener.close()
+            _slackrtms.remove(self._listener)
+        self._listener = listener
+        if listener:
+            _slackrtms.append(listener)
+
+    @asyncio.coroutine
+    def _handle_replies(self):
+        while True:
+            reply = yield from self._replies.get()
+            try:
+                yield from self._listener.handle_reply(reply)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.exception('error during handle_reply(): %s\n%s', str(e), pprint.pformat(reply))
+
+    @asyncio.coroutine
     def run(self):
-        logger.debug('SlackRTMThread.run()')
-        asyncio.set_event_loop(self._loop)
+        logger.debug('SlackRTMRunner.run()')
 
-        start_ts = time.time()
+        worker = None
+        backoff = 1
         try:
-            if self._listener and self._listener in _slackrtms:
-                self._listener.close()
-                _slackrtms.remove(self._listener)
-            self._listener = SlackRTM(self._config, self._bot, self._loop, threaded=True)
-            _slackrtms.append(self._listener)
-            last_ping = int(time.time())
-            self.isFullyLoaded.set()
             while True:
-                if self.stopped():
-                    return
-                replies = self._listener.rtm_read()
-                if replies:
-                    for reply in replies:
+                slack = SlackClient(self._config['key'])
+                start_ts = time.time()
+                try:
+                    yield from slack.rtm_connect()
+                    if self._directory is None:
+                        self._directory = SlackDirectory(
+                            slack,
+                            SlackDirectory.snapshot_path(self._bot, self._config.get('name') or slack.login_data['team']['id']),
+                            self._config.get('directory_ttl', 21600))
+                    self._replace_listener(SlackRTM(self._config, self._bot, self._loop, slack, self._directory))
+                    backoff = 1
+
+                    if worker is None:
+                        worker = asyncio.ensure_future(self._handle_replies())
+
+                    while True:
+                        reply = yield from slack.rtm_read()
                         if "type" not in reply:
                             logger.warning("no type available for {}".format(reply))
                             continue
@@ -994,44 +1072,31 @@ class SlackRTMThread(threading.Thread):
                             # discard the initial api reply
                             continue
                         if reply["type"] == "message" and float(reply["ts"]) < start_ts:
-                            # discard messages in the queue older than the thread start timestamp
+                            # discard messages in the queue older than the connection start timestamp
                             continue
-                        try:
-                            self._listener.handle_reply(reply)
-                        except Exception as e:
-                            logger.exception('error during handle_reply(): %s\n%s', str(e), pprint.pformat(reply))
-                now = int(time.time())
-                if now > last_ping + 30:
-                    self._listener.ping()
-                    last_ping = now
-                time.sleep(.1)
-        except KeyboardInterrupt:
-            # close, nothing to do
-            return
-        except WebSocketConnectionClosedException as e:
-            logger.exception('WebSocketConnectionClosedException(%s)', str(e))
-            return self.run()
-        except IncompleteLoginError:
-            logger.exception('IncompleteLoginError, restarting')
-            time.sleep(1)
-            return self.run()
-        except (ConnectionFailedError, TimeoutError):
-            logger.exception('Connection failed or Timeout, waiting 10 sec trying to restart')
-            time.sleep(10)
-            return self.run()
-        except ConnectionResetError:
-            logger.exception('ConnectionResetError, attempting to restart')
-            time.sleep(1)
-            return self.run()
-        except Exception as e:
-            logger.exception('SlackRTMThread: unhandled exception: %s', str(e))
-        return
-
-    def stop(self):
-        if self._listener and self._listener in _slackrtms:
-            self._listener.close()
-            _slackrtms.remove(self._listener)
-        self._stop.set()
-
-    def stopped(self):
-        return self._stop.isSet()
+                        self._replies.put_nowait(reply)
+
+                except asyncio.CancelledError:
+                    # before python 3.8 this is an Exception, do not reconnect after an unload
+                    raise
+                except IncompleteLoginError:
+                    logger.exception('IncompleteLoginError, restarting')
+                except (ConnectionFailedError, ConnectionResetError, TimeoutError, asyncio.TimeoutError, aiohttp.ClientError) as e:
+                    logger.exception('connection failed or lost: %s', str(e))
+                except Exception as e:
+                    logger.exception('SlackRTMRunner: unhandled exception: %s', str(e))
+                finally:
+                    yield from slack.close()
+
+                delay = backoff * random.uniform(0.5, 1.5)
+                logger.info('reconnecting %s in %.1f sec', self._config.get('name'), delay)
+                yield from asyncio.sleep(delay)
+                backoff = min(backoff * 2, 300)
+
+        finally:
+            # cancelled: the plugin was unloaded
+            if worker is not None:
+                worker.cancel()
+            self._replace_listener(None)
+            if self._directory is not None:
+                self._directory.close()
@@ -0,0 +1,209 @@
+"""cached directory of a slack team: users, channels, private groups, team info and dm channels
+
+* kept current by rtm events, full lists are only downloaded in the background when the
+  cache is older than its ttl, and then page by page
+* unknown ids are looked up one by one (users.info, channels.info, groups.info)
+* a snapshot is written next to the bot memory, restarts start from it
+"""
+
+import asyncio
+import logging
+import os
+import re
+import time
+
+import config
+
+
+logger = logging.getLogger(__name__)
+
+
+_lists = { "users": ( "users.list", "members" ),
+           "channels": ( "channels.list", "channels" ),
+           "groups": ( "groups.list", "groups" ) }
+
+_infos = { "users": ( "users.info", "user", "user" ),
+           "channels": ( "channels.info", "channel", "channel" ),
+           "groups": ( "groups.info", "channel", "group" ) }
+
+_page_size = 200
+
+
+def _slim(kind, item):
+    """keep only what the plugin reads, full user profiles make the snapshot huge"""
+    if kind == "users":
+        return { "id": item["id"],
+                 "name": item.get("name"),
+                 "real_name": item.get("real_name") or (item.get("profile") or {}).get("real_name"),
+                 "deleted": item.get("deleted", False),
+                 "is_bot": item.get("is_bot", False) }
+    return { "id": item["id"],
+             "name": item.get("name"),
+             "is_archived": item.get("is_archived", False),
+             "members": list(item.get("members") or []) }
+
+
+class SlackDirectory(object):
+    def __init__(self, slack, filename, ttl=21600):
+        """slack: .client.SlackClient, filename: snapshot file, ttl: seconds until a list is reloaded"""
+        self.slack = slack
+        self.ttl = ttl
+
+        self._snapshot = config.Config(filename, save_delay=60)
+        for key in [ "users", "channels", "groups", "team", "dms", "refreshed" ]:
+            if not isinstance(self._snapshot.config.get(key), dict):
+                self._snapshot.config[key] = {}
+
+        self.users = self._snapshot.config["users"]
+        self.channels = self._snapshot.config["channels"]
+        self.groups = self._snapshot.config["groups"]
+        self.team = self._snapshot.config["team"]
+        self.dms = self._snapshot.config["dms"] # user id: { "id": dm channel id }
+        self._refreshed = self._snapshot.config["refreshed"] # kind: timestamp of the last full list
+
+        self._tasks = {} # key: asyncio.Task, one request per list or id at a time
+
+        self.lookups = 0
+        self.events = 0
+
+    @staticmethod
+    def snapshot_path(bot, team_name):
+        directory = os.path.dirname(os.path.abspath(bot.memory.filename))
+        return os.path.join(directory, "slackrtm-{}.json".format(re.sub(r"[^\w.-]", "_", team_name)))
+
+    def _changed(self):
+        self._snapshot.force_taint()
+        self._snapshot.save()
+
+    def _single_flight(self, key, coroutine_function, *args):
+        task = self._tasks.get(key)
+        if task is None or task.done():
+            task = self._tasks[key] = asyncio.ensure_future(coroutine_function(*args))
+            task.add_done_callback(self._finished)
+        return task
+
+    def _finished(self, task):
+        if not task.cancelled() and task.exception():
+            logger.error("directory request failed", exc_info=task.exception())
+
+    def replace(self, kind, items):
+        """swap in a complete list, the dicts stay the same objects"""
+        entries = getattr(self, kind)
+        entries.clear()
+        entries.update({ item["id"]: _slim(kind, item) for item in items })
+        self._refreshed[kind] = time.time()
+        self._changed()
+
+    def refresh(self, kind):
+        """start a background download of a full list, returns the task"""
+        return self._single_flight(kind, self._download, kind)
+
+    @asyncio.coroutine
+    def _download(self, kind):
+        method, key = _lists[kind]
+        items = []
+        cursor = None
+        while True:
+            response = yield from self.slack.api_call(method, limit=_page_size, cursor=cursor)
+            if not response.get("ok"):
+                return
+            items.extend(response.get(key) or [])
+            cursor = (response.get("response_metadata") or {}).get("next_cursor")
+            if not cursor:
+                break
+
+        logger.info("{}: {} entries".format(method, len(items)))
+        self.replace(kind, items)
+
+    def refresh_stale(self):
+        """reload lists that are older than the ttl"""
+        now = time.time()
+        for kind in _lists:
+            if now - self._refreshed.get(kind, 0) > self.ttl:
+                self.refresh(kind)
+
+    def lookup(self, kind, id_):
+        """start a background request for a single unknown id, returns the task"""
+        return self._single_flight((kind, id_), self._fetch, kind, id_)
+
+    @asyncio.coroutine
+    def _fetch(self, kind, id_):
+        method, parameter, key = _infos[kind]
+        self.lookups = self.lookups + 1
+        response = yield from self.slack.api_call(method, **{ parameter: id_ })
+        if response.get("ok") and key in response:
+            getattr(self, kind)[id_] = _slim(kind, response[key])
+            self._changed()
+
+    @asyncio.coroutine
+    def get_dm(self, user):
+        if user not in self.dms:
+            response = yield from self.slack.api_call('im.open', user = user)
+            self.dms[user] = { "id": response['channel']['id'] }
+            self._changed()
+        return self.dms[user]['id']
+
+    def apply_event(self, event):
+        """update the directory from an rtm event, returns True if the event was used"""
+        type_ = event.get("type")
+
+        if type_ in ( "team_join", "user_change" ):
+            self.users[event["user"]["id"]] = _slim("users", event["user"])
+
+        elif type_ in ( "channel_created", "channel_joined", "group_joined" ):
+            kind = "groups" if type_ == "group_joined" else "channels"
+            entry = _slim(kind, event["channel"])
+            if type_ == "channel_created":
+                # only id and name are sent, keep what is known already
+                entry = dict(self.channels.get(entry["id"]) or entry, name=entry["name"])
+            getattr(self, kind)[entry["id"]] = entry
+
+        elif type_ in ( "channel_rename", "group_rename" ):
+            entries = self.groups if type_ == "group_rename" else self.channels
+            channel = event["channel"]
+            if channel["id"] in entries:
+                entries[channel["id"]]["name"] = channel["name"]
+            else:
+                entries[channel["id"]] = _slim("channels", channel)
+
+        elif type_ in ( "channel_archive", "channel_unarchive", "group_archive", "group_unarchive" ):
+            entries = self.groups if type_.startswith("group") else self.channels
+            if event["channel"] in entries:
+                entries[event["channel"]]["is_archived"] = type_.endswith("_archive")
+
+        elif type_ in ( "channel_deleted", "group_left" ):
+            entries = self.groups if type_ == "group_left" else self.channels
+            entries.pop(event["channel"], None)
+
+        elif type_ in ( "member_joined_channel", "member_left_channel" ):
+            entries = self.groups if event.get("channel_type") == "G" else self.channels
+            entry = entries.get(event["channel"])
+            if entry is None:
+                return False
+            members = entry["members"]
+            if type_ == "member_joined_channel" and event["user"] not in members:
+                members.append(event["user"])
+            elif type_ == "member_left_channel" and event["user"] in members:
+                members.remove(event["user"])
+
+        elif type_ == "im_created":
+            channel = event["channel"]
+            self.dms[event["user"]] = { "id": channel["id"] if isinstance(channel, dict) else channel }
+
+        elif type_ == "team_rename":
+            self.team["name"] = event["name"]
+
+        elif type_ == "team_domain_change":
+            self.team["domain"] = event["domain"]
+
+        else:
+            return False
+
+        self.events = self.events + 1
+        self._changed()
+        return True
+
+    def close(self):
+        for task in self._tasks.values():
+            task.cancel()
+        self._snapshot.save(delay=False)
@@ -5,6 +5,7 @@ import sys
 
 import plugins
 
+from keywords import KeywordAutomaton, is_word_boundary
 from utils import remove_accents
 
 
@@ -16,6 +17,11 @@ class __internal_vars():
         """ Cache to keep track of what keywords are being watched. Listed by user_id """
         self.keywords = {}
 
+        """ Reverse lookup of keywords to subscribed user_ids, see _update_subscribers() """
+        self.subscribers = {}
+        self.subscribed = {} # user_id: set of keywords currently in self.subscribers
+        self.automaton = None # matcher over all subscribed keywords, None when outdated
+
 _internal = __internal_vars()
 
 
@@ -32,6 +38,14 @@ def _handle_keyword(bot, event, command, include_event_user=False):
 
     _populate_keywords(bot, event)
 
+    event_text = re.sub(r"\s+", " ", event.text)
+    event_text_lower = event.text.lower()
+
+    """scan the message once for all subscribed phrases, then notify their subscribers"""
+    matched_phrases = _match_phrases(event_text)
+    if not matched_phrases:
+        return
+
     users_in_chat = event.conv.users
 
     """check if synced room and syncing is enabled
@@ -46,43 +60,83 @@ def _handle_keyword(bot, event, command, include_event_user=False):
                         users_in_chat += bot.get_users_in_conversation(syncedroom)
                 users_in_chat = list(set(users_in_chat)) # make unique
 
-    event_text = re.sub(r"\s+", " ", event.text)
-    event_text_lower = event.text.lower()
-    for user in users_in_chat:
-        chat_id = user.id_.chat_id
-        try:
-            if _internal.keywords[chat_id] and ( not chat_id in event.user.id_.chat_id
-                                                 or include_event_user ):
-                for phrase in _internal.keywords[chat_id]:
-                    regexphrase = r"(^|\b| )" + re.escape(phrase) + r"($|\b)"
-                    if re.search(regexphrase, event_text, re.IGNORECASE):
-
-                        """XXX: suppress alerts if it appears to be a valid mention to same user
-                        logic condensed from the detection function in the mentions plugin, we may
-                        miss some use-cases, but this should account for "most" of them"""
-                        if 'plugins.mentions' in sys.modules:
-                            _phrase_lower = phrase.lower()
-                            _mention = "@" + _phrase_lower
-                            if (_mention + " ") in event_text_lower or event_text_lower.endswith(_mention):
-                                user = bot.get_hangups_user(chat_id)
-                                _normalised_full_name_lower = remove_accents(user.full_name.lower())
-                                if( _phrase_lower in _normalised_full_name_lower
-                                        or _phrase_lower in _normalised_full_name_lower.replace(" ", "")
-                                        or _phrase_lower in _normalised_full_name_lower.replace(" ", "_") ):
-                                    # part of name mention: skip
-                                    logger.debug("subscription matched full name fragment {}, skipping".format(user.full_name))
-                                    continue
-                                if bot.memory.exists(['user_data', chat_id, "nickname"]):
-                                    _nickname = bot.memory.get_by_path(['user_data', chat_id, "nickname"])
-                                    if _phrase_lower == _nickname.lower():
-                                        # nickname mention: skip
-                                        logger.debug("subscription matched exact nickname {}, skipping".format(_nickname))
-                                        continue
-
-                        yield from _send_notification(bot, event, phrase, user)
-        except KeyError:
-            # User probably hasn't subscribed to anything
+    users_by_chat_id = { user.id_.chat_id: user for user in users_in_chat }
+
+    for phrase in matched_phrases:
+        for chat_id in list(_internal.subscribers.get(phrase, ())):
+            if chat_id not in users_by_chat_id:
+                continue
+            if chat_id in event.user.id_.chat_id and not include_event_user:
+                continue
+            user = users_by_chat_id[chat_id]
+
+            """XXX: suppress alerts if it appears to be a valid mention to same user
+            logic condensed from the detection function in the mentions plugin, we may
+            miss some use-cases, but this should account for "most" of them"""
+            if 'plugins.mentions' in sys.modules:
+                _phrase_lower = phrase.lower()
+                _mention = "@" + _phrase_lower
+                if (_mention + " ") in event_text_lower or event_text_lower.endswith(_mention):
+                    user = bot.get_hangups_user(chat_id)
+                    _normalised_full_name_lower = remove_accents(user.full_name.lower())
+                    if( _phrase_lower in _normalised_full_name_lower
+                            or _phrase_lower in _normalised_full_name_lower.replace(" ", "")
+                            or _phrase_lower in _normalised_full_name_lower.replace(" ", "_") ):
+                        # part of name mention: skip
+                        logger.debug("subscription matched full name fragment {}, skipping".format(user.full_name))
+                        continue
+                    if bot.memory.exists(['user_data', chat_id, "nickname"]):
+                        _nickname = bot.memory.get_by_path(['user_data', chat_id, "nickname"])
+                        if _phrase_lower == _nickname.lower():
+                            # nickname mention: skip
+                            logger.debug("subscription matched exact nickname {}, skipping".format(_nickname))
+                            continue
+
+            yield from _send_notification(bot, event, phrase, user)
+
+
+def _match_phrases(text):
+    """return the subscribed phrases found in text, same rules as the regex
+    (^|\b| )<phrase>($|\b) with re.IGNORECASE"""
+
+    if not _internal.subscribers:
+        return set()
+
+    if _internal.automaton is None:
+        _internal.automaton = KeywordAutomaton(_internal.subscribers)
+        logger.debug("compiled {} phrases".format(len(_internal.automaton)))
+
+    text = text.lower()
+    matched = set()
+    for start, end, phrase in _internal.automaton.find(text):
+        if phrase in matched:
             continue
+        if( (start == 0 or text[start - 1] == " " or is_word_boundary(text, start))
+                and (end == len(text) or is_word_boundary(text, end)) ):
+            matched.add(phrase)
+    return matched
+
+
+def _update_subscribers(chat_id):
+    """sync the reverse lookup with _internal.keywords[chat_id]
+    the matcher is only recompiled if a phrase gained its first or lost its last subscriber"""
+
+    current = set(_internal.keywords.get(chat_id) or [])
+    previous = _internal.subscribed.get(chat_id, set())
+
+    for phrase in previous - current:
+        _internal.subscribers[phrase].discard(chat_id)
+        if not _internal.subscribers[phrase]:
+            del _internal.subscribers[phrase]
+            _internal.automaton = None
+
+    for phrase in current - previous:
+        if phrase not in _internal.subscribers:
+            _internal.subscribers[phrase] = set()
+            _internal.automaton = None
+        _internal.subscribers[phrase].add(chat_id)
+
+    _internal.subscribed[chat_id] = current
 
 
 def _populate_keywords(bot, event):
@@ -99,6 +153,8 @@ def _populate_keywords(bot, event):
             else:
                 _internal.keywords[userchatid] = []
 
+            _update_subscribers(userchatid)
+
 
 @asyncio.coroutine
 def _send_notification(bot, event, phrase, user):
@@ -181,6 +237,8 @@ def subscribe(bot, event, *args):
             _("Note: You will not be able to trigger your own subscriptions. To test, please ask somebody else to test this for you."))
 
 
+    _update_subscribers(event.user.id_.chat_id)
+
     # Save to file
     bot.memory.set_by_path(["user_data", event.user.id_.chat_id, "keywords"], _internal.keywords[event.user.id_.chat_id])
     bot.memory.save()
@@ -209,6 +267,8 @@ def unsubscribe(bot, event, *args):
         yield from bot.coro_send_message(
             event.conv,_("Error: keyword not found"))
 
+    _update_subscribers(event.user.id_.chat_id)
+
     # Save to file
     bot.memory.set_by_path(["user_data", event.user.id_.chat_id, "keywords"], _internal.keywords[event.user.id_.chat_id])
     bot.memory.save()
@@ -4,6 +4,8 @@ import hangups
 
 import plugins
 
+from coalesce import RelayCoalescer
+
 
 logger = logging.getLogger(__name__)
 
@@ -18,8 +20,13 @@ class __registers(object):
 
 _registers=__registers()
 
+_coalescer = None
+
 
 def _initialise(bot):
+    global _coalescer
+    _coalescer = RelayCoalescer(bot, __name__)
+
     _migrate_syncroom_v1(bot)
 
     plugins.register_handler(_broadcast, type="sending")
@@ -174,15 +181,22 @@ def _repeat(bot, event, command):
                                          "segments": event.conv_event.segments,
                                          "user": event.user }
 
+    # consecutive lines of the same user can be merged into one message per room
+    coalesce_key = ( event.conv_id,
+                     user if isinstance(user, str) else user.id_.chat_id,
+                     tuple(passthru["norelay"]) )
+
     # relay messages to other rooms only
     for relay_id in syncout:
         if event.conv_id != relay_id:
             logger.info("REPEATING: {} - {}".format(message, passthru))
-            yield from bot.coro_send_message(
+            yield from _coalescer.send(
                 relay_id,
-                message = "{}: {}".format(_format_source(bot, event.user.id_), message),
-                image_id = image_id,
-                context = { "passthru": passthru })
+                "{}: {}".format(_format_source(bot, event.user.id_), message),
+                passthru,
+                key = coalesce_key,
+                original = message,
+                image_id = image_id )
 
 
 def _format_source(bot, user_id):
@@ -15,6 +15,7 @@ from telepot.aio.loop import MessageLoop
 
 import hangups
 
+import media
 import plugins
 
 from webbridge import ( WebFramework,
@@ -51,24 +52,29 @@ def convert_online_mp4_to_gif(source_url, fallback_url=False):
         # XXX: demo api key from https://gifs.com/
         api_key = "gifs56d63999f0f34"
 
-    # retrieve the source image
-    api_request = yield from client_session.get(source_url)
-    raw_image = yield from api_request.read()
+    # retrieve the source image, spooled to disk if large
+    try:
+        source = yield from media.download(tg_bot.ho_bot, source_url, client_session)
+    except (aiohttp.ClientError, media.MediaTooLarge) as e:
+        logger.warning("failed to retrieve {}: {}".format(source_url, e))
+        return fallback_url or source_url
 
-    # upload it to gifs.com for conversion
+    # upload it to gifs.com for conversion, streamed from the file
 
     url = "https://api.gifs.com/media/upload"
 
-    headers = { "Gifs-Api-Key": api_key }
-    data = aiohttp.formdata.FormData()
-    data.add_field('file', raw_image)
-    data.add_field('title', 'example.mp4')
+    with source:
+        headers = { "Gifs-Api-Key": api_key }
+        data = aiohttp.formdata.FormData()
+        data.add_field('file', (yield from source.reader()), filename='example.mp4')
+        data.add_field('title', 'example.mp4')
 
-    response = yield from client_session.post(url, data=data, headers=headers)
-    if response.status != 200:
-        return fallback_url or source_url
+        response = yield from client_session.post(url, data=data, headers=headers)
+        if response.status != 200:
+            return fallback_url or source_url
+
+        results = yield from response.json()
 
-    results = yield from response.json()
     if "success" not in results:
         return fallback_url or source_url
 
@@ -993,7 +999,8 @@ class BridgeInstance(WebFramework):
                     media_link = event.passthru["original_request"]["attachments"][0]
                     logger.info("media link in original request: {}".format(media_link))
 
-                    yield from self._send_deferred_media(media_link, eid, bridge_user["preferred_name"])
+                    yield from self._send_with_retry(
+                        self._send_deferred_media, media_link, eid, bridge_user["preferred_name"])
 
                 elif isinstance(event, FakeEvent):
                     if( "image_id" in event.passthru["original_request"]
@@ -1018,7 +1025,8 @@ class BridgeInstance(WebFramework):
                     media_link = event.conv_event.attachments[0]
                     logger.info("media link in original event: {}".format(media_link))
 
-                    yield from self._send_deferred_media(media_link, eid, bridge_user["preferred_name"])
+                    yield from self._send_with_retry(
+                        self._send_deferred_media, media_link, eid, bridge_user["preferred_name"])
 
                 """standard message relay"""
 
@@ -1037,10 +1045,11 @@ class BridgeInstance(WebFramework):
                                                      message)
 
                 logger.info("sending {}: {}".format(eid, formatted_text))
-                yield from tg_bot.sendMessage( eid,
-                                               formatted_text,
-                                               parse_mode = 'Markdown',
-                                               disable_web_page_preview = True )
+                yield from self._send_with_retry( tg_bot.sendMessage,
+                                                  eid,
+                                                  formatted_text,
+                                                  parse_mode = 'Markdown',
+                                                  disable_web_page_preview = True )
 
             except telepot.exception.BotWasKickedError as exc:
                 logger.error("telesync bot was kicked from the telegram chat id {}".format(eid))
@@ -0,0 +1,90 @@
+import collections, time
+
+
+class ExpiringRegistry(collections.MutableMapping):
+    """bounded mapping for short-lived ids: entries expire ttl seconds after they were last
+    stored or read, and the least recently used entry is evicted once maxsize is reached
+    * expired entries are treated as missing on access, call sweep() periodically to drop
+      entries that are never accessed again
+    """
+    def __init__(self, name, ttl=3600, maxsize=10000):
+        self.name = name
+        self.ttl = ttl
+        self.maxsize = maxsize
+
+        self._entries = collections.OrderedDict() # id: (timestamp, value), least recent first
+
+        self.hits = 0
+        self.misses = 0
+        self.expired = 0
+        self.evicted = 0
+
+    def __getitem__(self, key):
+        try:
+            timestamp, value = self._entries[key]
+        except KeyError:
+            self.misses = self.misses + 1
+            raise
+
+        now = time.time()
+        if now - timestamp > self.ttl:
+            del self._entries[key]
+            self.expired = self.expired + 1
+            self.misses = self.misses + 1
+            raise KeyError(key)
+
+        self._entries[key] = (now, value)
+        self._entries.move_to_end(key)
+        self.hits = self.hits + 1
+        return value
+
+    def __setitem__(self, key, value):
+        self._entries[key] = (time.time(), value)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.maxsize:
+            self._entries.popitem(last=False)
+            self.evicted = self.evicted + 1
+
+    def __delitem__(self, key):
+        del self._entries[key]
+
+    def __contains__(self, key):
+        try:
+            timestamp, value = self._entries[key]
+        except KeyError:
+            return False
+        if time.time() - timestamp > self.ttl:
+            del self._entries[key]
+            self.expired = self.expired + 1
+            return False
+        return True
+
+    def __iter__(self):
+        return iter(list(self._entries))
+
+    def __len__(self):
+        return len(self._entries)
+
+    def clear(self):
+        self._entries.clear()
+
+    def sweep(self):
+        """drop expired entries, returns number of entries removed"""
+        removed = 0
+        threshold = time.time() - self.ttl
+        while self._entries:
+            key, (timestamp, value) = next(iter(self._entries.items()))
+            if timestamp >= threshold:
+                # entries are ordered by last use, everything after this is newer
+                break
+            del self._entries[key]
+            removed = removed + 1
+        self.expired = self.expired + removed
+        return removed
+
+    def stats(self):
+        return { "size": len(self._entries),
+                 "hits": self.hits,
+                 "misses": self.misses,
+                 "expired": self.expired,
+                 "evicted": self.evicted }
@@ -1,10 +1,12 @@
-import asyncio, base64, io, imghdr, json, logging, time
+import asyncio, json, logging, time
 
 from http.server import BaseHTTPRequestHandler
 from urllib.parse import urlparse, parse_qs
 
 from aiohttp import web
 
+import media
+
 logger = logging.getLogger(__name__)
 
 
@@ -57,7 +59,7 @@ class BaseBotRequestHandler(BaseHTTPRequestHandler):
             echo                text string
             image 
                 base64encoded   base64-encoded image data
-                filename        optional filename (else determined automatically via imghdr)
+                filename        optional filename (else determined automatically from the content)
         """
         # parse incoming data
         payload = json.loads(content)
@@ -76,14 +78,13 @@ class BaseBotRequestHandler(BaseHTTPRequestHandler):
         image_filename = None
         if "image" in payload:
             if "base64encoded" in payload["image"]:
-                image_raw = base64.b64decode(payload["image"]["base64encoded"])
-                image_data = io.BytesIO(image_raw)
+                # decoded into a spooled file, large payloads are kept on disk
+                image_data = yield from media.from_base64(self._bot, payload["image"]["base64encoded"])
 
             if "filename" in payload["image"]:
                 image_filename = payload["image"]["filename"]
-            else:
-                image_type = imghdr.what('ignore', image_raw)
-                image_filename = str(int(time.time())) + "." + image_type
+            elif image_data:
+                image_filename = str(int(time.time())) + media.guess_extension(image_data.type)
                 logger.info("automatic image filename: {}".format(image_filename))
 
         if not text and not image_data:
@@ -105,7 +106,11 @@ class BaseBotRequestHandler(BaseHTTPRequestHandler):
                 image_filename = str(int(time.time())) + ".jpg"
                 logger.warning("fallback image filename: {}".format(image_filename))
 
-            image_id = yield from self._bot._client.upload_image(image_data, filename=image_filename)
+            if isinstance(image_data, media.Media):
+                with image_data:
+                    image_id = yield from image_data.upload(self._bot, image_filename)
+            else:
+                image_id = yield from self._bot.coro_upload_image(image_data, filename=image_filename)
 
         if not text and not image_id:
             logger.error("{}: nothing to send".format(self.sinkname))
@@ -169,14 +174,13 @@ class AsyncRequestHandler:
         image_filename = None
         if "image" in payload:
             if "base64encoded" in payload["image"]:
-                image_raw = base64.b64decode(payload["image"]["base64encoded"])
-                image_data = io.BytesIO(image_raw)
+                # decoded into a spooled file, large payloads are kept on disk
+                image_data = yield from media.from_base64(self.bot, payload["image"]["base64encoded"])
 
             if "filename" in payload["image"]:
                 image_filename = payload["image"]["filename"]
-            else:
-                image_type = imghdr.what('ignore', image_raw)
-                image_filename = str(int(time.time())) + "." + image_type
+            elif image_data:
+                image_filename = str(int(time.time())) + media.guess_extension(image_data.type)
                 logger.info("automatic image filename: {}".format(image_filename))
 
         if not text and not image_data:
@@ -198,7 +202,11 @@ class AsyncRequestHandler:
                 image_filename = str(int(time.time())) + ".jpg"
                 logger.warning("fallback image filename: {}".format(image_filename))
 
-            image_id = yield from self.bot._client.upload_image(image_data, filename=image_filename)
+            if isinstance(image_data, media.Media):
+                with image_data:
+                    image_id = yield from image_data.upload(self.bot, image_filename)
+            else:
+                image_id = yield from self.bot.coro_upload_image(image_data, filename=image_filename)
 
         if not text and not image_id:
             raise ValueError("nothing to send")
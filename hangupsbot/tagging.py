@@ -17,8 +17,16 @@ class tags:
     bot = None
     indices = {}
 
+    effective_maxsize = 50000
+
     def __init__(self, bot):
         self.bot = bot
+
+        """cached useractive() results, see _invalidate_effective()"""
+        self._effective = {} # (chat_id, conv_id): tuple of active tags
+        self._effective_by_chat = {} # chat_id: set(conv_id)
+        self._effective_by_conv = {} # conv_id: set(chat_id)
+
         self.refresh_indices()
 
     def _load_from_memory(self, key, type):
@@ -30,6 +38,7 @@ class tags:
 
     def refresh_indices(self):
         self.indices = { "user-tags": {}, "tag-users":{}, "conv-tags": {}, "tag-convs": {} }
+        self._clear_effective()
 
         self._load_from_memory("user_data", "user")
         self._load_from_memory("conv_data", "conv")
@@ -42,6 +51,8 @@ class tags:
                         for tag in tags:
                             self.add_to_index("user", tag, conv_id + "|" + chat_id)
 
+        command.invalidate_permissions()
+
         logger.info("refreshed")
 
     def add_to_index(self, type, tag, id):
@@ -49,32 +60,70 @@ class tags:
         object_to_tag = "{}-tags".format(type)
 
         if tag not in self.indices[tag_to_object]:
-            self.indices[tag_to_object][tag] = []
-        if id not in self.indices[tag_to_object][tag]:
-            self.indices[tag_to_object][tag].append(id)
+            self.indices[tag_to_object][tag] = set()
+        self.indices[tag_to_object][tag].add(id)
 
         if id not in self.indices[object_to_tag]:
-            self.indices[object_to_tag][id] = []
-        if tag not in self.indices[object_to_tag][id]:
-            self.indices[object_to_tag][id].append(tag)
+            self.indices[object_to_tag][id] = set()
+        self.indices[object_to_tag][id].add(tag)
+
+        if type == "user":
+            self._invalidate_effective(id)
 
     def remove_from_index(self, type, tag, id):
         tag_to_object = "tag-{}s".format(type)
         object_to_tag = "{}-tags".format(type)
 
         if tag in self.indices[tag_to_object]:
-            if id in self.indices[tag_to_object][tag]:
-                self.indices[tag_to_object][tag].remove(id)
-                if len(self.indices[tag_to_object][tag]) == 0:
-                    # remove key entirely it its empty
-                    del(self.indices[tag_to_object][tag])
+            self.indices[tag_to_object][tag].discard(id)
+            if len(self.indices[tag_to_object][tag]) == 0:
+                # remove key entirely it its empty
+                del(self.indices[tag_to_object][tag])
 
         if id in self.indices[object_to_tag]:
-            if tag in self.indices[object_to_tag][id]:
-                self.indices[object_to_tag][id].remove(tag)
-                if len(self.indices[object_to_tag][id]) == 0:
-                    # remove key entirely it its empty
-                    del(self.indices[object_to_tag][id])
+            self.indices[object_to_tag][id].discard(tag)
+            if len(self.indices[object_to_tag][id]) == 0:
+                # remove key entirely it its empty
+                del(self.indices[object_to_tag][id])
+
+        if type == "user":
+            self._invalidate_effective(id)
+
+    def _clear_effective(self):
+        self._effective = {}
+        self._effective_by_chat = {}
+        self._effective_by_conv = {}
+
+    def _invalidate_effective(self, id):
+        """drop cached useractive() results that depend on the user-tags index entry id
+        id formats: chat_id, *, conv_id|chat_id, conv_id|*, GROUP|chat_id, ONE_TO_ONE|*, ..."""
+
+        if "|" in id:
+            conv_id, chat_id = id.split("|", 1)
+        else:
+            conv_id, chat_id = None, id
+
+        if conv_id in (self.wildcard["group"], self.wildcard["one2one"]):
+            # conversation type overrides
+            conv_id = None
+
+        if chat_id == self.wildcard["user"]:
+            if conv_id is None:
+                self._clear_effective()
+            else:
+                for _chat_id in self._effective_by_conv.pop(conv_id, ()):
+                    self._effective.pop((_chat_id, conv_id), None)
+                    self._effective_by_chat[_chat_id].discard(conv_id)
+
+        elif conv_id is None:
+            for _conv_id in self._effective_by_chat.pop(chat_id, ()):
+                self._effective.pop((chat_id, _conv_id), None)
+                self._effective_by_conv[_conv_id].discard(chat_id)
+
+        elif (chat_id, conv_id) in self._effective:
+            del self._effective[chat_id, conv_id]
+            self._effective_by_chat[chat_id].discard(conv_id)
+            self._effective_by_conv[conv_id].discard(chat_id)
 
     def update(self, type, id, action, tag):
         updated = False
@@ -167,6 +216,8 @@ class tags:
             else:
                 raise TypeError("unhandled update type {}".format(type))
 
+            command.invalidate_permissions()
+
             logger.info("{}/{} action={} value={}".format(type, id, action, tag))
         else:
             logger.info("{}/{} action={} value={} [NO CHANGE]".format(type, id, action, tag))
@@ -262,21 +313,21 @@ class tags:
         return active_tags
 
 
-    def useractive(self, chat_id, conv_id="*"):
-        """return active tags of user for current conv_id if supplied, globally if not"""
+    def _useractive(self, chat_id, conv_id, conv_type, user_data):
+        """resolve active tags of user, conv_type is the catalog type of conv_id (or None)"""
 
         active_tags = []
         check_keys = []
 
-        if self.bot.memory.exists(["user_data", chat_id]):
+        if chat_id in user_data and user_data[chat_id] is not None:
             if conv_id != "*":
-                if conv_id in self.bot.conversations.catalog:
+                if conv_type is not None:
                     # per_conversation_user_override_keys
                     check_keys.extend([ conv_id + "|" + chat_id,
                                         conv_id + "|" + self.wildcard["user"] ])
 
                     # additional overrides based on type of conversation
-                    if self.bot.conversations.catalog[conv_id]["type"] == "GROUP":
+                    if conv_type == "GROUP":
                         check_keys.extend([ self.wildcard["group"] + "|" + chat_id,
                                             self.wildcard["group"] + "|" + self.wildcard["user"] ])
                     else:
@@ -291,16 +342,52 @@ class tags:
 
         else:
             logger.warning("useractive: user {} does not exist".format(chat_id))
+            return active_tags
 
+        user_tags = self.indices["user-tags"]
         for _key in check_keys:
-            if _key in self.indices["user-tags"]:
-                active_tags.extend(self.indices["user-tags"][_key])
+            if _key in user_tags:
+                active_tags.extend(user_tags[_key])
                 active_tags = list(set(active_tags))
                 if "tagging-merge" not in active_tags:
                     break
 
+        if conv_id == "*" or conv_type is not None:
+            # only cache results for known users and conversations
+            if len(self._effective) >= self.effective_maxsize:
+                self._clear_effective()
+            self._effective[chat_id, conv_id] = tuple(active_tags)
+            self._effective_by_chat.setdefault(chat_id, set()).add(conv_id)
+            self._effective_by_conv.setdefault(conv_id, set()).add(chat_id)
+
         return active_tags
 
+    def useractive(self, chat_id, conv_id="*"):
+        """return active tags of user for current conv_id if supplied, globally if not"""
+
+        if (chat_id, conv_id) in self._effective:
+            return list(self._effective[chat_id, conv_id])
+
+        return self.useractive_many([chat_id], conv_id)[chat_id]
+
+    def useractive_many(self, chat_ids, conv_id="*"):
+        """return dict of chat_id: active tags for several users in the same conv_id
+        conversation and user lookups are shared across all supplied users"""
+
+        conv_type = None
+        if conv_id != "*" and conv_id in self.bot.conversations.catalog:
+            conv_type = self.bot.conversations.catalog[conv_id]["type"]
+
+        user_data = self.bot.memory["user_data"] or {}
+
+        results = {}
+        for chat_id in chat_ids:
+            if (chat_id, conv_id) in self._effective:
+                results[chat_id] = list(self._effective[chat_id, conv_id])
+            else:
+                results[chat_id] = self._useractive(chat_id, conv_id, conv_type, user_data)
+        return results
+
 
     def userlist(self, conv_id, tags=False):
         """return dict of participating chat_ids to tags, optionally filtered by tag/list of tags"""
@@ -314,10 +401,9 @@ class tags:
         except KeyError:
             logger.warning("userlist: conversation {} does not exist".format(conv_id))
 
-        results = {}
-        for chat_id in userlist:
-            user_tags = self.useractive(chat_id, conv_id)
-            if tags and not set(tags).issubset(set(user_tags)):
-                continue
-            results[chat_id] = user_tags
+        results = self.useractive_many(userlist, conv_id)
+        if tags:
+            tags = set(tags)
+            results = { chat_id: user_tags for chat_id, user_tags in results.items()
+                        if tags.issubset(user_tags) }
         return results
@@ -0,0 +1,132 @@
+"""command detection benchmark: per-message cost of EventHandler.handle_command for regular chat
+usage: benchmark-chatter.py [-h] [-m MESSAGES] [-c COMMANDS]
+
+optional arguments:
+  -h, --help            show this help message and exit
+  -m MESSAGES, --messages MESSAGES
+                        number of synthetic messages
+  -c COMMANDS, --commands COMMANDS
+                        fraction of messages that are bot commands
+
+example usage:
+python3 benchmark-chatter.py --messages 100000 --commands 0.05
+"""
+import argparse, asyncio, json, os, random, sys, tempfile, time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+import config
+import handlers
+import plugins
+
+from commands import command
+from exceptions import HangupsBotExceptions
+from tagging import tags
+
+parser = argparse.ArgumentParser()
+parser.add_argument('-m', '--messages', type=int, default=100000, help="number of synthetic messages")
+parser.add_argument('-c', '--commands', type=float, default=0.05, help="fraction of messages that are bot commands")
+
+args = parser.parse_args()
+
+directory = tempfile.mkdtemp()
+
+config_file = os.path.join(directory, "config.json")
+with open(config_file, "w") as f:
+    json.dump({ "admins": [ "1" ],
+                "commands_enabled": True,
+                "auto_alias_one_to_one": True,
+                "conversations": { "CONV{}".format(i): { "commands_enabled": bool(i % 2) }
+                                   for i in range(50) }}, f)
+
+memory_file = os.path.join(directory, "memory.json")
+with open(memory_file, "w") as f:
+    json.dump({ "user_data": { str(i): { "tags": [ "tag{}".format(i % 7) ] } for i in range(100) },
+                "conv_data": { "CONV1": { "tags-users": { "1": [ "ignore" ] } } } }, f)
+
+
+class SyntheticConversations:
+    def __init__(self):
+        self.catalog = { "CONV{}".format(i): { "type": "ONE_TO_ONE" if i == 0 else "GROUP" }
+                         for i in range(50) }
+
+
+class SyntheticBot:
+    def __init__(self):
+        self.Exceptions = HangupsBotExceptions()
+        self.shared = {}
+        self._handlers = None
+        self.config = config.Config(config_file, cache_suboptions=True)
+        self.memory = config.Config(memory_file)
+        self.conversations = SyntheticConversations()
+        self.tags = tags(self)
+        self.commands_run = 0
+
+    def register_shared(self, id, objectref, forgiving=False):
+        self.shared[id] = objectref
+
+    def get_config_option(self, option):
+        return self.config.get_option(option)
+
+    def get_config_suboption(self, conv_id, option):
+        return self.config.get_suboption("conversations", conv_id, option)
+
+    def get_config_suboptions(self, conv_id, options):
+        return self.config.get_suboptions("conversations", conv_id, options)
+
+
+class SyntheticUser:
+    def __init__(self, chat_id):
+        self.id_ = self
+        self.chat_id = chat_id
+        self.full_name = "User {}".format(chat_id)
+
+
+class SyntheticEvent:
+    def __init__(self, number, text):
+        self.conv_id = "CONV{}".format(1 + number % 49)
+        self.conv = self
+        self.id_ = self.conv_id
+        self.user = SyntheticUser(str(number % 100))
+        self.user_id = self.user
+        self.text = text
+
+
+chatter = [ "hello everyone",
+            "did anyone see the game last night? http://example.com/highlights",
+            "lol",
+            "/me waves",
+            "I'll be there in 10 minutes, botany class ran late",
+            "ok" ]
+
+random.seed(0)
+events = []
+for number in range(args.messages):
+    if random.random() < args.commands:
+        text = "/bot echo message {}".format(number)
+    else:
+        text = random.choice(chatter)
+    events.append(SyntheticEvent(number, text))
+
+bot = SyntheticBot()
+plugins.tracking.set_bot(bot)
+command.bot = bot
+event_handler = bot._handlers = handlers.EventHandler(bot)
+
+@command.register(final=True)
+def echo(bot, event, *args):
+    bot.commands_run = bot.commands_run + 1
+
+@asyncio.coroutine
+def dispatch():
+    for event in events:
+        yield from event_handler.handle_command(event)
+
+loop = asyncio.get_event_loop()
+
+start_time = time.time()
+loop.run_until_complete(dispatch())
+interval = time.time() - start_time
+
+print("{} messages, {} commands run: {:.2f}us/message".format(
+    args.messages, bot.commands_run, interval / args.messages * 1000000))
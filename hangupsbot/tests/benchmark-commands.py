@@ -0,0 +1,102 @@
+"""command permission benchmark: get_available_commands() with and without the compiled permission cache
+usage: benchmark-commands.py [-h] [-c COMMANDS] [-t TAGS] [-u USERS] [-i INVOCATIONS]
+
+optional arguments:
+  -h, --help            show this help message and exit
+  -c COMMANDS, --commands COMMANDS
+                        number of registered commands, every other command is tagged
+  -t TAGS, --tags TAGS  number of distinct tags assigned to users
+  -u USERS, --users USERS
+                        number of users in the conversation
+  -i INVOCATIONS, --invocations INVOCATIONS
+                        number of simulated command invocations
+
+example usage:
+python3 benchmark-commands.py --commands 300 --tags 1000 --invocations 20000
+"""
+import argparse, json, os, sys, tempfile, time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+import config
+import handlers # resolves the commands <-> plugins import cycle the same way the bot does
+
+from tagging import tags
+
+parser = argparse.ArgumentParser()
+parser.add_argument('-c', '--commands', type=int, default=300, help="number of registered commands")
+parser.add_argument('-t', '--tags', type=int, default=1000, help="number of distinct tags assigned to users")
+parser.add_argument('-u', '--users', type=int, default=200, help="number of users in the conversation")
+parser.add_argument('-i', '--invocations', type=int, default=20000, help="number of simulated command invocations")
+
+args = parser.parse_args()
+
+directory = tempfile.mkdtemp()
+
+conv_id = "CONV"
+chat_ids = [ str(100000000000000000000 + i) for i in range(args.users) ]
+command_names = [ "command{}".format(i) for i in range(args.commands) ]
+tag_names = [ "tag{}".format(i) for i in range(args.tags) ]
+
+config_file = os.path.join(directory, "config.json")
+with open(config_file, "w") as f:
+    json.dump({ "admins": chat_ids[:2],
+                "commands_admin": command_names[:10],
+                "commands_tagged": { name: [ tag_names[i % args.tags],
+                                             [ tag_names[(i * 7) % args.tags],
+                                               tag_names[(i * 13) % args.tags] ] ]
+                                     for i, name in enumerate(command_names) if i % 2 } }, f)
+
+memory_file = os.path.join(directory, "memory.json")
+with open(memory_file, "w") as f:
+    json.dump({ "user_data": { chat_id: { "tags": [ tag_names[(i * step) % args.tags]
+                                                    for step in (1, 3, 17, 31, 101) ] }
+                               for i, chat_id in enumerate(chat_ids) },
+                "conv_data": { conv_id: { "tags": [ tag_names[0] ] } } }, f)
+
+
+class SyntheticConversations:
+    def __init__(self):
+        self.catalog = { conv_id: { "title": "synthetic", "type": "GROUP", "participants": chat_ids } }
+
+
+class SyntheticBot:
+    def __init__(self):
+        self.config = config.Config(config_file, cache_suboptions=True)
+        self.memory = config.Config(memory_file)
+        self.conversations = SyntheticConversations()
+        self.tags = tags(self)
+
+    def get_config_option(self, option):
+        return self.config.get_option(option)
+
+    def get_config_suboptions(self, conv_id, options):
+        return self.config.get_suboptions("conversations", conv_id, options)
+
+
+def command_function(bot, event, *args):
+    pass
+
+bot = SyntheticBot()
+
+# the CommandDispatcher singleton the EventHandler dispatches to, no plugins are loaded
+dispatcher = handlers.command
+dispatcher.bot = bot
+for number, name in enumerate(command_names):
+    dispatcher.register(command_function, admin=(number % 20 == 0), final=True, name=name)
+
+invocations = [ chat_ids[i % args.users] for i in range(args.invocations) ]
+
+results = {}
+for label, cached in [ ("uncached", False), ("cached", True) ]:
+    start_time = time.time()
+    for chat_id in invocations:
+        if not cached:
+            dispatcher.invalidate_permissions()
+        available = dispatcher.get_available_commands(bot, chat_id, conv_id)
+        results.setdefault(chat_id, {})[label] = { key: sorted(value) for key, value in available.items() }
+    interval = time.time() - start_time
+
+    print("{}: {:.2f}us/invocation".format(label, interval / args.invocations * 1000000))
+
+assert all(result["uncached"] == result["cached"] for result in results.values()), "cached permissions differ"
@@ -0,0 +1,51 @@
+"""per-message config resolution benchmark: get_suboption() with and without the resolved-options cache
+usage: benchmark-config.py [-h] [-c CONVERSATIONS] [-m MESSAGES]
+
+optional arguments:
+  -h, --help            show this help message and exit
+  -c CONVERSATIONS, --conversations CONVERSATIONS
+                        number of conversations with overrides in config.conversations
+  -m MESSAGES, --messages MESSAGES
+                        number of simulated messages
+
+example usage:
+python3 benchmark-config.py --conversations 500 --messages 100000
+"""
+import argparse, json, os, sys, tempfile, time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+import config
+
+parser = argparse.ArgumentParser()
+parser.add_argument('-c', '--conversations', type=int, default=500, help="number of conversations with overrides in config.conversations")
+parser.add_argument('-m', '--messages', type=int, default=100000, help="number of simulated messages")
+
+args = parser.parse_args()
+
+# options typically resolved while handling a single message
+per_message_options = [ "commands_enabled", "admins", "silentmode", "autoreplies_enabled",
+                        "autoreplies", "forwarding_enabled", "mentionquidproquo", "commands_admin",
+                        "commands_user", "commands_tagged" ]
+
+config_file = os.path.join(tempfile.mkdtemp(), "config.json")
+with open(config_file, "w") as f:
+    json.dump({ "admins": [ "1" ],
+                "commands_enabled": True,
+                "silentmode": False,
+                "conversations": { "CONV{}".format(i): { "commands_enabled": bool(i % 2),
+                                                         "silentmode": True }
+                                   for i in range(args.conversations) }}, f)
+
+conv_ids = [ "CONV{}".format(i % args.conversations) for i in range(args.messages) ]
+
+for label, cached in [ ("uncached", False), ("cached", True) ]:
+    bot_config = config.Config(config_file, cache_suboptions=cached)
+
+    start_time = time.time()
+    for conv_id in conv_ids:
+        for option in per_message_options:
+            bot_config.get_suboption("conversations", conv_id, option)
+    interval = time.time() - start_time
+
+    print("{}: {:.2f}us/message".format(label, interval / args.messages * 1000000))
@@ -0,0 +1,138 @@
+"""handler dispatch benchmark: replays synthetic chat events through EventHandler.run_pluggable_omnibus
+and, as the baseline, through the same handlers with the signature inspection and log formatting
+done for every event as before the dispatch plans
+usage: benchmark-dispatch.py [-h] [-p PLUGINS] [-e EVENTS] [-d]
+
+optional arguments:
+  -h, --help            show this help message and exit
+  -p PLUGINS, --plugins PLUGINS
+                        number of synthetic plugins, each registers a "message" and an
+                        "allmessages" handler
+  -e EVENTS, --events EVENTS
+                        number of synthetic events to dispatch
+  -d, --debug           enable debug logging (to a null handler) while dispatching
+
+example usage:
+python3 benchmark-dispatch.py --plugins 40 --events 20000
+"""
+import argparse, asyncio, inspect, logging, os, sys, time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+import handlers
+import plugins
+
+from exceptions import HangupsBotExceptions
+
+parser = argparse.ArgumentParser()
+parser.add_argument('-p', '--plugins', type=int, default=40, help="number of synthetic plugins")
+parser.add_argument('-e', '--events', type=int, default=20000, help="number of synthetic events to dispatch")
+parser.add_argument('-d', '--debug', action='store_true', help="enable debug logging while dispatching")
+
+args = parser.parse_args()
+
+
+class SyntheticBot:
+    def __init__(self):
+        self.Exceptions = HangupsBotExceptions()
+        self.shared = {}
+        self._handlers = None
+
+    def register_shared(self, id, objectref, forgiving=False):
+        self.shared[id] = objectref
+
+    def get_config_option(self, option):
+        return None
+
+
+class SyntheticEvent:
+    """minimal stand-in for event.ConversationEvent, carries what handlers usually inspect"""
+    def __init__(self, number):
+        self.conv_id = "CONV{}".format(number % 25)
+        self.text = "message number {} with a link http://example.com/{}".format(number, number)
+        self.from_bot = False
+        self.passthru = {}
+        self.context = {}
+
+
+"""handler signatures found in the bundled plugins"""
+
+def handler_function(bot, event):
+    "http" in event.text
+
+def handler_function_context(bot, event, command):
+    event.conv_id in bot.shared
+
+@asyncio.coroutine
+def handler_coroutine(bot, event, command):
+    event.text.lower()
+
+@asyncio.coroutine
+def handler_coroutine_short(bot, event):
+    event.text.split()
+
+signatures = [ handler_function, handler_function_context, handler_coroutine, handler_coroutine_short ]
+
+
+bot = SyntheticBot()
+plugins.tracking.set_bot(bot)
+event_handler = bot._handlers = handlers.EventHandler(bot)
+
+for number in range(args.plugins):
+    plugins.tracking.start({ "module": "synthetic{}".format(number),
+                             "module.path": "plugins.synthetic{}".format(number) })
+    for type in [ "message", "allmessages" ]:
+        event_handler.register_handler( signatures[number % len(signatures)],
+                                        type=type,
+                                        priority=(number * 7) % 100 )
+    plugins.tracking.end()
+
+if args.debug:
+    logging.getLogger().addHandler(logging.NullHandler())
+    logging.getLogger().setLevel(logging.DEBUG)
+
+events = [ SyntheticEvent(number) for number in range(args.events) ]
+
+logger = logging.getLogger("benchmark-dispatch")
+
+@asyncio.coroutine
+def reflective_omnibus(name, *args):
+    """baseline: run_pluggable_omnibus() as it was, everything resolved per event and handler"""
+    for function, priority, plugin_metadata in event_handler.pluggables[name]:
+        message = ["{}: {}.{}".format(name, plugin_metadata["module.path"], function.__name__)]
+        try:
+            _expected = list(inspect.signature(function).parameters)
+            _passed = args[0:len(_expected)]
+            if asyncio.iscoroutinefunction(function):
+                message.append("coroutine")
+                logger.debug(" : ".join(message))
+                yield from function(*_passed)
+            else:
+                message.append("function")
+                logger.debug(" : ".join(message))
+                function(*_passed)
+        except bot.Exceptions.SuppressHandler:
+            message.append("SuppressHandler")
+            logger.debug(" : ".join(message))
+        except:
+            logger.exception(" : ".join(message))
+
+@asyncio.coroutine
+def dispatch(omnibus):
+    for event in events:
+        yield from omnibus("allmessages", bot, event, None)
+        yield from omnibus("message", bot, event, None)
+
+loop = asyncio.get_event_loop()
+
+results = {}
+for label, omnibus in [ ("per-event reflection", reflective_omnibus),
+                        ("dispatch plan", event_handler.run_pluggable_omnibus) ]:
+    start_time = time.time()
+    loop.run_until_complete(dispatch(omnibus))
+    results[label] = time.time() - start_time
+
+    print("{}: {} handlers, {} events: {:.2f}us/event".format(
+        label, args.plugins * 2, args.events, results[label] / args.events * 1000000))
+
+print("speedup: {:.1f}x".format(results["per-event reflection"] / results["dispatch plan"]))
@@ -0,0 +1,89 @@
+"""memory storage benchmark: json (full rewrite) vs sqlite (changed rows only)
+usage: benchmark-memory.py [-h] [-u USERS] [-s SAVES]
+
+optional arguments:
+  -h, --help            show this help message and exit
+  -u USERS, --users USERS
+                        number of synthetic user_data entries
+  -s SAVES, --saves SAVES
+                        number of single-user updates to save
+
+example usage:
+python3 benchmark-memory.py --users 50000 --saves 20
+"""
+import argparse, os, shutil, sys, tempfile, time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+import config
+
+parser = argparse.ArgumentParser()
+parser.add_argument('-u', '--users', type=int, default=50000, help="number of synthetic user_data entries")
+parser.add_argument('-s', '--saves', type=int, default=20, help="number of single-user updates to save")
+
+args = parser.parse_args()
+
+directory = tempfile.mkdtemp()
+json_file = os.path.join(directory, "memory.json")
+sqlite_file = os.path.join(directory, "memory.sqlite")
+
+memory = config.Config(json_file)
+memory["user_data"] = {}
+for i in range(args.users):
+    chat_id = str(100000000000000000000 + i)
+    memory.set_by_path(["user_data", chat_id], {
+        "_hangups": { "chat_id": chat_id,
+                      "gaia_id": chat_id,
+                      "full_name": "User Number {}".format(i),
+                      "first_name": "User",
+                      "photo_url": "//lh3.googleusercontent.com/{}/photo.jpg".format(i),
+                      "emails": [],
+                      "is_self": False,
+                      "is_definitive": True },
+        "nickname": "user{}".format(i) })
+memory.save(delay=False)
+
+# a change that only exists in the journal must survive the migration
+journalled = config.Config(json_file, journal=True)
+journalled.set_by_path(["user_data", "100000000000000000000", "nickname"], "journalled")
+journalled.save(delay=False)
+assert os.path.isfile(json_file + ".journal")
+
+start_time = time.time()
+migrated = config.migrate_to_sqlite(json_file, sqlite_file)
+print("migrate: {:.3f}s".format(time.time() - start_time))
+
+assert migrated.get_by_path(["user_data", "100000000000000000000", "nickname"]) == "journalled"
+
+# a failsafe backup is recovered together with the journal of its snapshot
+recovery_file = os.path.join(directory, "recovery.json")
+shutil.copy2(json_file, recovery_file)
+recovered = config.Config(recovery_file, journal=True, failsafe_backups=2)
+recovered.set_by_path(["user_data", "100000000000000000001", "nickname"], "backed up")
+recovered.save(delay=False)
+recovered.force_taint()
+recovered.save(delay=False) # full snapshot, backs up the previous one and its journal
+recovered.set_by_path(["user_data", "100000000000000000002", "nickname"], "after backup")
+recovered.save(delay=False)
+with open(recovery_file, "w") as f:
+    f.write("{ corrupted")
+
+recovered = config.Config(recovery_file, journal=True, failsafe_backups=2)
+assert recovered.get_by_path(["user_data", "100000000000000000001", "nickname"]) == "backed up"
+assert recovered.get_by_path(["user_data", "100000000000000000002", "nickname"]) == "user2"
+
+for engine, memory_class, filename in [ ("json", config.Config, json_file),
+                                        ("sqlite", config.SQLiteConfig, sqlite_file) ]:
+    start_time = time.time()
+    memory = memory_class(filename)
+    interval_load = time.time() - start_time
+
+    start_time = time.time()
+    for i in range(args.saves):
+        chat_id = str(100000000000000000000 + (i * 7919) % args.users)
+        memory.set_by_path(["user_data", chat_id, "nickname"], "renamed{}".format(i))
+        memory.save(delay=False)
+    interval_save = (time.time() - start_time) / args.saves
+
+    print("{}: load {:.3f}s, save {:.2f}ms/change, size {} bytes".format(
+        engine, interval_load, interval_save * 1000, os.path.getsize(filename)))
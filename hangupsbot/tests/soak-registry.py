@@ -0,0 +1,128 @@
+"""soak test for the EventHandler id registries (passthrus, contexts, image ids, ...)
+simulates sent messages that register ids through EventHandler.register_passthru() and
+register_context(), of which only some return from Google through handle_chat_message(),
+and asserts that memory use stays flat once the registries went through a full ttl or
+lru cycle
+usage: soak-registry.py [-h] [-m MESSAGES] [-r RETURNED] [-i INTERVAL]
+
+optional arguments:
+  -h, --help            show this help message and exit
+  -m MESSAGES, --messages MESSAGES
+                        number of synthetic messages to send
+  -r RETURNED, --returned RETURNED
+                        fraction of messages that round-trip and release their ids
+  -i INTERVAL, --interval INTERVAL
+                        simulated seconds between two messages
+
+example usage:
+python3 soak-registry.py --messages 1000000 --returned 0.9
+"""
+import argparse, asyncio, os, random, sys, tracemalloc, types
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+import handlers
+import registry
+
+from exceptions import HangupsBotExceptions
+
+parser = argparse.ArgumentParser()
+parser.add_argument('-m', '--messages', type=int, default=1000000, help="number of synthetic messages to send")
+parser.add_argument('-r', '--returned', type=float, default=0.9, help="fraction of messages that round-trip")
+parser.add_argument('-i', '--interval', type=float, default=0.1, help="simulated seconds between two messages")
+
+args = parser.parse_args()
+
+ttl = 3600
+maxsize = 10000
+
+
+class SyntheticClock:
+    """stands in for the time module of the registries, a soak of hours runs in seconds"""
+    def __init__(self):
+        self.now = 0.0
+
+    def time(self):
+        return self.now
+
+
+class SyntheticBot:
+    def __init__(self):
+        self.Exceptions = HangupsBotExceptions()
+        self.shared = {}
+        self._handlers = None
+
+    def register_shared(self, id, objectref, forgiving=False):
+        self.shared[id] = objectref
+
+    def get_config_option(self, option):
+        return { "handlers.registry.ttl": ttl,
+                 "handlers.registry.maxsize": maxsize }.get(option)
+
+
+def returned_event(passthru_id, context_id):
+    """message sent by the bot coming back from Google with its annotations"""
+    annotations = [ types.SimpleNamespace(type=1026, value=passthru_id),
+                    types.SimpleNamespace(type=1027, value=context_id) ]
+    conv_event = types.SimpleNamespace(
+        _event=types.SimpleNamespace(chat_message=types.SimpleNamespace(annotation=annotations)),
+        segments=[],
+        attachments=[])
+    return types.SimpleNamespace( text="returned",
+                                  user=types.SimpleNamespace(is_self=True),
+                                  conv_id="CONV",
+                                  conv_event=conv_event )
+
+
+clock = registry.time = SyntheticClock()
+
+bot = SyntheticBot()
+
+@asyncio.coroutine
+def soak():
+    event_handler = bot._handlers = handlers.EventHandler(bot)
+    passthrus = event_handler._passthrus
+    contexts = event_handler._contexts
+
+    tracemalloc.start()
+    baseline = None
+    checkpoints = []
+
+    for number in range(args.messages):
+        clock.now = clock.now + args.interval
+
+        passthru_id = event_handler.register_passthru(
+            { "original_request": { "message": "message {}".format(number),
+                                    "image_id": None } })
+        context_id = event_handler.register_context(
+            { "base": { "source": "soak", "importance": 50, "tags": [] } })
+
+        if random.random() < args.returned:
+            # handle_chat_message() pops both ids
+            event = returned_event(passthru_id, context_id)
+            yield from event_handler.handle_chat_message(event)
+            assert event.passthru and event.context, "ids did not survive the round-trip"
+
+        if number and number % (args.messages // 20) == 0:
+            event_handler.sweep_registries()
+            current, peak = tracemalloc.get_traced_memory()
+            stats = passthrus.stats()
+            warm = stats["expired"] or stats["evicted"]
+            if baseline is None and warm:
+                # registries went through their first ttl or lru cycle, from here on they are full
+                baseline = current
+            elif baseline is not None:
+                checkpoints.append(current)
+            print("{:>9} messages: {:>7.1f} KiB{}, {}".format(
+                number, current / 1024, "" if warm else " (warm-up)", stats))
+
+    assert len(passthrus) <= maxsize and len(contexts) <= maxsize, "registry exceeded maxsize"
+    assert checkpoints, "no ttl or lru cycle completed, send more messages or raise --interval"
+    return baseline, checkpoints
+
+loop = asyncio.get_event_loop()
+baseline, checkpoints = loop.run_until_complete(soak())
+
+assert max(checkpoints) < baseline * 1.1, "memory grew from {} to {} bytes".format(baseline, max(checkpoints))
+
+print("OK: memory flat at ~{:.1f} KiB after warm-up".format(baseline / 1024))
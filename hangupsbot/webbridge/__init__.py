@@ -1,7 +1,12 @@
 import asyncio
+import copy
 import logging
+import random
 import uuid
 
+import aiohttp
+import hangups
+
 from collections import namedtuple
 
 from hangups import ChatMessageEvent
@@ -9,6 +14,8 @@ from hangups import ChatMessageEvent
 import plugins
 import threadmanager
 
+from coalesce import RelayCoalescer
+
 from parsers.markdown import html_to_hangups_markdown
 
 from sinks import aiohttp_start
@@ -17,6 +24,16 @@ from sinks.base_bot_request_handler import AsyncRequestHandler as IncomingReques
 
 logger = logging.getLogger(__name__)
 
+
+_relay_defaults = { "queue": 200, # relays waiting per bridge instance
+                    "drop": "oldest", # relay dropped when the queue is full: "oldest" or "newest"
+                    "retries": 3, # retries of a send to a target that failed with a transient error
+                    "backoff": 1.0, # seconds, doubled for each retry and jittered
+                    "drain": 10.0 } # seconds close() waits for queued relays
+
+_transient_errors = ( aiohttp.ClientError, asyncio.TimeoutError, hangups.NetworkError )
+
+
 class FakeEvent:
     def __init__(self, text, user, passthru, conv_id=None):
         self.text = text
@@ -42,6 +59,18 @@ class WebFramework:
         self.configkey = configkey
         self.RequestHandler = RequestHandler
 
+        self._coalescer = RelayCoalescer(bot, configkey)
+
+        """relays to the external chat are queued and sent by a worker, the handlers
+        only queue them and return so one slow external service does not hold up
+        the other bridges and handlers
+        config.json "relay_queue" overrides the keys of _relay_defaults"""
+        self._relay_options = dict(_relay_defaults)
+        self._relay_options.update(bot.get_config_option("relay_queue") or {})
+        self._relay_queue = asyncio.Queue(maxsize=self._relay_options["queue"])
+        self._relay_worker = None
+        self.relay_stats = { "queued": 0, "sent": 0, "retried": 0, "failed": 0, "dropped": 0 }
+
         self.load_configuration(configkey)
 
         self.setup_plugin()
@@ -65,9 +94,94 @@ class WebFramework:
         self.start_listening(bot)
 
     def close(self):
+        self._coalescer.flush_all()
         plugins.deregister_handler(self._handler_broadcast, type="sending")
         plugins.deregister_handler(self._handler_repeat, type="allmessages")
         del self.bot.bridges[self.uid]
+        if self._relay_worker is not None:
+            # relays already queued are still sent, for a while
+            asyncio.ensure_future(self._drain_relays())
+
+    def _queue_relay(self, config, event):
+        """queue a relay to the external chat, the worker starts on demand
+        * the event is copied as it is now: later handlers of the same dispatch may still change
+          it before the worker sends it, e.g. handle_command() rewrites event.text"""
+        if self._relay_queue.full():
+            self.relay_stats["dropped"] = self.relay_stats["dropped"] + 1
+            logger.warning("{}:{}:relay queue full, dropping the {} relay, {} dropped".format(
+                self.plugin_name, self.uid, self._relay_options["drop"], self.relay_stats["dropped"]))
+            if self._relay_options["drop"] == "newest":
+                return
+            self._relay_queue.get_nowait()
+            self._relay_queue.task_done()
+
+        snapshot = copy.copy(event)
+        snapshot.passthru = dict(event.passthru)
+        self._relay_queue.put_nowait((config, snapshot))
+        self.relay_stats["queued"] = self.relay_stats["queued"] + 1
+
+        if self._relay_worker is None or self._relay_worker.done():
+            self._relay_worker = asyncio.ensure_future(self._run_relays())
+
+    def relay_status(self):
+        """relays waiting in the queue and counters"""
+        return dict(self.relay_stats, waiting=self._relay_queue.qsize())
+
+    @asyncio.coroutine
+    def _run_relays(self):
+        """send queued relays one after the other, in order"""
+        while True:
+            config, event = yield from self._relay_queue.get()
+            try:
+                yield from self._relay(config, event)
+            finally:
+                self._relay_queue.task_done()
+
+    @asyncio.coroutine
+    def _relay(self, config, event):
+        """one attempt, _send_to_external_chat() retries each target with _send_with_retry()"""
+        try:
+            yield from self._send_to_external_chat(config, event)
+            self.relay_stats["sent"] = self.relay_stats["sent"] + 1
+
+        except asyncio.CancelledError:
+            raise
+
+        except Exception:
+            self.relay_stats["failed"] = self.relay_stats["failed"] + 1
+            logger.exception("{}:{}:relay failed".format(self.plugin_name, self.uid))
+
+    @asyncio.coroutine
+    def _send_with_retry(self, coroutine_function, *args, **kwargs):
+        """send to a single target, retried with backoff on transient errors only
+
+        other errors are raised at once: the request may have reached the target
+        and a retry would send it twice"""
+        attempt = 0
+        while True:
+            try:
+                return (yield from coroutine_function(*args, **kwargs))
+
+            except _transient_errors as e:
+                if attempt >= self._relay_options["retries"]:
+                    raise
+
+                delay = self._relay_options["backoff"] * 2 ** attempt * random.uniform(0.5, 1.5)
+                attempt = attempt + 1
+                self.relay_stats["retried"] = self.relay_stats["retried"] + 1
+                logger.warning("{}:{}:send failed, retry {}/{} in {:.1f}s: {}".format(
+                    self.plugin_name, self.uid, attempt, self._relay_options["retries"], delay, repr(e)))
+
+                yield from asyncio.sleep(delay)
+
+    @asyncio.coroutine
+    def _drain_relays(self):
+        try:
+            yield from asyncio.wait_for(self._relay_queue.join(), self._relay_options["drain"])
+        except asyncio.TimeoutError:
+            logger.warning("{}:{}:closed with {} relay(s) unsent".format(
+                self.plugin_name, self.uid, self._relay_queue.qsize()))
+        self._relay_worker.cancel()
 
     def load_configuration(self, configkey):
         self.configuration = self.bot.get_config_option(self.configkey) or []
@@ -169,7 +283,7 @@ class WebFramework:
 
         # for messages from other plugins, relay them
         for config in applicable_configurations:
-            yield from self._send_to_external_chat(
+            self._queue_relay(
                 config,
                 FakeEvent(
                     text = message,
@@ -258,7 +372,7 @@ class WebFramework:
                                        "source_plugin": self.plugin_name }
 
         for config in applicable_configurations:
-            yield from self._send_to_external_chat(config, event)
+            self._queue_relay(config, event)
 
     @asyncio.coroutine
     def send_to_external_1to1(self, user_id, message):
@@ -313,11 +427,21 @@ class WebFramework:
 
         logger.info("{}:receive:{}".format(self.plugin_name, passthru))
 
-        yield from self.bot.coro_send_message(
+        # consecutive plain lines from one external user and chat can share a message
+        coalesce_key = None
+        if not ( linked_hangups_user
+                 or image_id
+                 or external_context.get("source_edited")
+                 or external_context.get("source_action") ):
+            coalesce_key = (source_gid, source_uid, source_user, source_title)
+
+        yield from self._coalescer.send(
             conv_id,
             formatted_message,
-            image_id = image_id,
-            context = { "passthru": passthru })
+            passthru,
+            key = coalesce_key,
+            original = message,
+            image_id = image_id )
 
     def map_external_uid_with_hangups_user(self, source_uid, external_context):
         return False